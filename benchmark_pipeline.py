@@ -0,0 +1,790 @@
+#!/bin/env python
+"""
+Time every stage of the processing chain on synthetic data
+
+ERA5-like raw hourly files (packed t2m with the land-sea mask, and tp, with
+the final month a mixture of ERA5 and ERA5T on an "expver" axis) are made for
+a global grid of the given resolution and years, in a temporary DATALOC.
+Each stage is then run on them in its own process, reporting the wall time,
+throughput (GB of input read per second, and millions of grid-point-days of
+the record per second) and peak memory: of the whole process tree (the stage
+and any workers it starts, sampled every SAMPLE_SECONDS), and of the largest
+single process.
+Climpact is replaced by a stand-in which writes index files for each tile
+(TXx, TNn, PRCPTOT, R95p) in the same form, so merging and the derived indices
+can be timed.  Nothing is downloaded, so this runs on any Linux machine with
+the Python dependencies, to catch slow-downs before a production run.
+
+With --check, the stages a check needs are run and then the check (see CHECKS),
+which fails the run if the results are wrong:
+
+  append    calculate_indices.py over the whole record, against the record
+            without its last year with that year added by --append, for every
+            index (needs at least utils.APPEND_LOOKBACK_YEARS + 2 years)
+  download  get_era5.py's download queue, with a fake CDS client which fails a set
+            number of times for each file: retries, backoff, the limit on attempts
+            and resuming from the saved queue (nothing is downloaded)
+
+Run as::
+
+  python benchmark_pipeline.py [--resolution DEG] [--start YEAR] [--years N] [--stages combine ...]
+                               [--profile NAME] [--no_expver] [--dataloc DIR] [--keep] [--check NAME]
+
+--resolution  Grid spacing in degrees (ERA5 is 0.25)
+--start       First year of data
+--years       Number of years of data
+--stages      Stages to run (default, all of them, in order)
+--profile     Storage profile for the output files (utils.STORAGE_PROFILES)
+--no_expver   Don't put an ERA5/ERA5T mixture in the final month
+--dataloc     Directory to use as DATALOC (default, a new temporary directory)
+--keep        Keep the files afterwards
+--check       Check the results of a part of the chain, rather than time every stage
+"""
+
+#*******************************************
+# START
+#*******************************************
+import os
+import sys
+import glob
+import time
+import shutil
+import calendar
+import tempfile
+import json
+import warnings
+import subprocess
+import datetime as dt
+import numpy as np
+import netCDF4 as ncdf
+
+# stage : input files (the first pattern with files is used) for the throughput
+#   generate and the Climpact stand-in make inputs for later stages, rather than being part of the chain
+STAGES = {"generate" : [], \
+          "combine" : ["raw/*.nc"], \
+          "make_dailies" : ["hourlies/*_hourly.nc", "raw/*.nc"], \
+          "make_years" : ["dailies/??????_daily.nc"], \
+          "make_tiles" : ["dailies/????_daily.nc"], \
+          "climpact" : ["tiles/era5_tile_*.nc"], \
+          "merge_tiles" : ["indices/*.nc"], \
+          "extra_indices" : ["final/ERA5_TXx_*[0-9].nc", "final/ERA5_TNn_*[0-9].nc", "final/ERA5_R95p_*[0-9].nc", "final/ERA5_PRCPTOT_*[0-9].nc"]}
+
+# checks : stages to run first
+CHECKS = {"append" : ["generate", "combine", "make_dailies", "make_years"], \
+          "download" : []}
+
+# download queue for the download check: attempts, backoff (s), longest backoff (s)
+#   the longest is less than the doubled backoff, so that the cap is checked
+DOWNLOAD_CHECK = (3, 1., 1.5)
+
+# indices the Climpact stand-in makes : (periods, units), enough for ETR and R95pTOT
+INDICES = {"TXx" : (["ANN", "MON"], "degrees_C"), \
+           "TNn" : (["ANN", "MON"], "degrees_C"), \
+           "PRCPTOT" : (["ANN"], "mm"), \
+           "R95p" : (["ANN"], "mm")}
+
+# tiles written at once by make_tiles (keeps the number of open files down)
+TILE_BATCH = 100
+
+# interval between samples of the memory of a stage's processes
+SAMPLE_SECONDS = 0.1
+
+# raw files, variable : name in the file (the land-sea mask is in the temperature file)
+RAW_FILES = {"2m_temperature" : "t2m", "total_precipitation" : "tp"}
+
+# packing of the raw files (as the CDS netCDF files), name : (long name, units, scale factor, offset)
+PACKING = {"t2m" : ("2 metre temperature", "K", 0.0025, 260.), \
+           "tp" : ("Total precipitation", "m", 2.e-6, 0.065), \
+           "lsm" : ("Land-sea mask", "(0 - 1)", 2.e-5, 0.5)}
+
+#****************************************
+def grid(resolution):
+    '''
+    Global grid, latitudes north to south and longitudes from 0, as ERA5
+
+    :param float resolution: spacing in degrees
+
+    :returns: latitudes, longitudes
+    '''
+
+    lats = np.linspace(90, -90, int(round(180 / resolution)) + 1)
+    lons = np.arange(0, 360, resolution)
+
+    return lats, lons # grid
+
+#****************************************
+def synthetic_hours(lats, lons, hours, rng):
+    '''
+    Hourly temperature (K) and precipitation (m), with seasonal and diurnal cycles and noise
+
+    :param array lats: latitudes
+    :param array lons: longitudes
+    :param array hours: hours since 1900-01-01
+    :param obj rng: numpy random Generator
+
+    :returns: t2m, tp (time, latitude, longitude)
+    '''
+
+    phi = np.radians(lats)[None, :, None]
+    day = (hours / 24. % 365.25)[:, None, None]
+    solar_hour = (hours[:, None, None] % 24 + lons[None, None, :] / 15.) % 24
+
+    shape = (len(hours), len(lats), len(lons))
+    t2m = 300 - 45 * np.sin(phi)**2 - 15 * np.sin(phi) * np.cos(2 * np.pi * (day - 15) / 365.25) \
+        + 5 * np.cos(2 * np.pi * (solar_hour - 15) / 24) + rng.normal(0, 2, shape)
+
+    tp = np.where(rng.random(shape) < 0.1, rng.exponential(0.001, shape), 0)
+
+    return t2m.astype(np.float32), tp.astype(np.float32) # synthetic_hours
+
+#****************************************
+def create_raw_file(filename, name, lats, lons, times, expver):
+    '''
+    Set up a raw hourly file laid out as a CDS download
+
+    :param str filename: output file
+    :param str name: variable name ("t2m" or "tp"; "lsm" is added to the t2m file)
+    :param array lats: latitudes
+    :param array lons: longitudes
+    :param array times: hours since 1900-01-01
+    :param bool expver: add the ERA5/ERA5T axis
+
+    :returns: open netCDF4 Dataset
+    '''
+
+    outfile = ncdf.Dataset(filename, "w", format="NETCDF3_64BIT_OFFSET")
+    outfile.Conventions = "CF-1.6"
+    outfile.history = "{} synthetic ERA5-like data from benchmark_pipeline.py".format(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+    outfile.createDimension("longitude", len(lons))
+    outfile.createDimension("latitude", len(lats))
+    if expver:
+        outfile.createDimension("expver", 2)
+    outfile.createDimension("time", len(times))
+
+    for coord, values, units in [("longitude", lons, "degrees_east"), ("latitude", lats, "degrees_north")]:
+        var = outfile.createVariable(coord, "f4", (coord,))
+        var.units = units
+        var.long_name = coord
+        var[:] = values
+
+    if expver:
+        var = outfile.createVariable("expver", "i4", ("expver",))
+        var.long_name = "expver"
+        var[:] = [1, 5]
+
+    var = outfile.createVariable("time", "i4", ("time",))
+    var.units = "hours since 1900-01-01 00:00:00.0"
+    var.long_name = "time"
+    var.calendar = "gregorian"
+    var[:] = times
+
+    dims = ("time", "expver", "latitude", "longitude") if expver else ("time", "latitude", "longitude")
+    for var_name in [name] + (["lsm"] if name == "t2m" else []):
+        long_name, units, scale, offset = PACKING[var_name]
+        var = outfile.createVariable(var_name, "i2", dims, fill_value=np.int16(-32767))
+        var.scale_factor = scale
+        var.add_offset = offset
+        var.missing_value = np.int16(-32767)
+        var.units = units
+        var.long_name = long_name
+
+    return outfile # create_raw_file
+
+#****************************************
+def write_month(dataloc, year, month, lats, lons, expver = False, seed = 0, variables = RAW_FILES.keys()):
+    '''
+    Write the raw hourly t2m (with lsm) and tp files for a month, a day at a time
+
+    :param str dataloc: DATALOC
+    :param int year: year
+    :param int month: month
+    :param array lats: latitudes
+    :param array lons: longitudes
+    :param bool expver: make the month a mixture of ERA5 (first half) and ERA5T (second half)
+    :param int seed: random seed
+    :param list variables: write the files of only these variables (from RAW_FILES)
+    '''
+
+    rng = np.random.default_rng(seed + 100 * year + month)
+
+    ndays = calendar.monthrange(year, month)[1]
+    first = int((dt.datetime(year, month, 1) - dt.datetime(1900, 1, 1)).total_seconds() // 3600)
+    times = first + np.arange(24 * ndays)
+
+    outfiles = {name : create_raw_file(os.path.join(dataloc, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable)), \
+                                       name, lats, lons, times, expver) \
+                for variable, name in RAW_FILES.items() if variable in variables}
+
+    # static land fraction, with some coasts either side of the threshold
+    phi, lam = np.meshgrid(np.radians(lats), np.radians(lons), indexing="ij")
+    land = np.clip(0.5 + 0.8 * np.sin(3 * lam) * np.cos(2 * phi), 0, 1).astype(np.float32)
+
+    for day in range(ndays):
+        hours = slice(24 * day, 24 * (day + 1))
+        t2m, tp = synthetic_hours(lats, lons, times[hours], rng)
+        lsm = np.broadcast_to(land, t2m.shape)
+
+        for name, values, target in [("t2m", t2m, "t2m"), ("tp", tp, "tp"), ("lsm", lsm, "t2m")]:
+            if target not in outfiles:
+                continue
+            outfile = outfiles[target]
+            if expver:
+                # each hour is in one of ERA5 and ERA5T, the other is missing
+                era5t = day >= ndays // 2
+                mixed = np.ma.masked_all((values.shape[0], 2) + values.shape[1:], dtype=np.float32)
+                mixed[:, int(era5t)] = values
+                values = mixed
+            outfile.variables[name][hours] = values
+
+    for outfile in outfiles.values():
+        outfile.close()
+
+    return # write_month
+
+#****************************************
+def generate(dataloc, start, end, resolution, expver = True):
+    '''
+    Write raw hourly files for every month
+
+    :param str dataloc: DATALOC
+    :param int start: first year
+    :param int end: last year
+    :param float resolution: grid spacing in degrees
+    :param bool expver: make the final month a mixture of ERA5 and ERA5T
+    '''
+
+    lats, lons = grid(resolution)
+
+    for year in range(start, end + 1):
+        for month in range(1, 13):
+            print("{}-{:02d}".format(year, month))
+            write_month(dataloc, year, month, lats, lons, expver = expver and (year, month) == (end, 12))
+
+    return # generate
+
+#****************************************
+def write_climpact_file(filename, index, values, dates, lats, lons, units):
+    '''
+    Write an index for a tile as Climpact does
+
+    :param str filename: output file
+    :param str index: index name
+    :param array values: (time, latitude, longitude)
+    :param list dates: date of each time
+    :param array lats: latitudes
+    :param array lons: longitudes
+    :param str units: units of the index
+    '''
+
+    with ncdf.Dataset(filename, "w") as outfile:
+        outfile.createDimension("time", len(dates))
+        outfile.createDimension("lat", len(lats))
+        outfile.createDimension("lon", len(lons))
+
+        var = outfile.createVariable("time", "f8", ("time",))
+        var.units = "days since {}-01-01 00:00:00".format(dates[0].year)
+        var.calendar = "standard"
+        var[:] = ncdf.date2num(dates, var.units, calendar=var.calendar)
+
+        for name, coords, coord_units in [("lat", lats, "degrees_north"), ("lon", lons, "degrees_east")]:
+            var = outfile.createVariable(name, "f4", (name,))
+            var.units = coord_units
+            var[:] = coords
+
+        var = outfile.createVariable(index.lower(), "f4", ("time", "lat", "lon"), fill_value=-99.9)
+        var.units = units
+        var.long_name = index
+        var[:] = np.ma.masked_invalid(values)
+
+    return # write_climpact_file
+
+#****************************************
+def write_indices():
+    '''
+    Stand-in for Climpact - calculate a few indices from each tile and write them
+    in the same files as Climpact, recording them in the catalog
+    '''
+
+    # only imported here, as DATALOC is set for the stage processes alone
+    import utils
+    import catalog
+
+    for row in catalog.lookup("tile"):
+        with ncdf.Dataset(row["path"], "r") as infile:
+            lats = infile.variables["latitude"][:]
+            lons = infile.variables["longitude"][:]
+            time = infile.variables["time"]
+            dates = ncdf.num2date(time[:], time.units, calendar=getattr(time, "calendar", "standard"))
+            data = {name : np.ma.filled(infile.variables[name][:].astype(np.float32), np.nan) for name in ["tx2m", "tn2m", "tp"]}
+
+        years = np.array([d.year for d in dates])
+        months = np.array([d.month for d in dates])
+        wet = np.where(data["tp"] >= 1, data["tp"], np.nan)
+
+        periods = {"ANN" : [(dt.datetime(y, 1, 1), years == y) for y in np.unique(years)], \
+                   "MON" : [(dt.datetime(y, m, 1), (years == y) & (months == m)) for y in np.unique(years) for m in range(1, 13)]}
+
+        with warnings.catch_warnings():
+            # all-missing points (e.g. no wet days) give NaN, as Climpact
+            warnings.simplefilter("ignore", RuntimeWarning)
+            threshold = np.nanpercentile(wet, 95, axis=0)
+            functions = {"TXx" : lambda p: np.nanmax(data["tx2m"][p], axis=0), \
+                         "TNn" : lambda p: np.nanmin(data["tn2m"][p], axis=0), \
+                         "PRCPTOT" : lambda p: np.nansum(wet[p], axis=0), \
+                         "R95p" : lambda p: np.nansum(np.where(wet[p] > threshold, wet[p], 0), axis=0)}
+
+            for index, (timescales, units) in INDICES.items():
+                for timescale in timescales:
+                    values = np.array([functions[index](p) for d, p in periods[timescale]])
+                    filename = os.path.join(utils.DATALOC, "indices", "{}_{}_climpact.era5_historical_{}_{}-{}.nc".format( \
+                        index.lower(), timescale, row["tile"], utils.base_period_start, utils.base_period_end))
+                    write_climpact_file(filename, index, values, [d for d, p in periods[timescale]], lats, lons, units)
+
+        catalog.record_climpact(row["tile"])
+
+    return # write_indices
+
+#****************************************
+class FakeClient:
+    '''
+    Stand-in for the CDS API client, which fails the first requests for each file
+    and then writes it as synthetic data
+
+    :param dict failures: target file : number of requests to fail (shared by all the clients)
+    :param dict requests: target file : time of each request (shared by all the clients)
+    :param array lats: latitudes
+    :param array lons: longitudes
+    '''
+    def __init__(self, failures, requests, lats, lons):
+        self.failures = failures
+        self.requests = requests
+        self.lats = lats
+        self.lons = lons
+
+    def retrieve(self, name, request, target):
+        '''As cdsapi.Client.retrieve'''
+        self.requests.setdefault(target, []).append(time.time())
+        if len(self.requests[target]) <= self.failures.get(target, 0):
+            raise RuntimeError("fake failure {} of {}".format(len(self.requests[target]), self.failures[target]))
+
+        write_month(os.path.dirname(os.path.dirname(target)), int(request["year"]), int(request["month"]), \
+                    self.lats, self.lons, variables = [request["variable"][0]])
+
+#****************************************
+def check_download(start, resolution):
+    '''
+    Run the get_era5.py download queue with a fake CDS client, which fails a set number
+    of times for each file, and check the retries, their backoff and its cap, the limit
+    on attempts, and that a second run carries on from the state the first left.
+
+    :param int start: year to "download"
+    :param float resolution: grid spacing in degrees
+    '''
+
+    # only imported here, as DATALOC is set for the stage processes alone
+    import utils
+    import catalog
+    import get_era5
+
+    max_attempts, backoff, max_backoff = DOWNLOAD_CHECK
+    state_file = os.path.join(utils.DATALOC, "download_queue.json")
+    lats, lons = grid(resolution)
+
+    def target(year, month, variable):
+        return os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable))
+
+    failures, requests = {}, {}
+
+    def run(jobs):
+        # one worker per download, so none waits for another to finish before retrying
+        scheduler = get_era5.DownloadScheduler(state_file, nworkers = len(jobs), max_attempts = max_attempts, backoff = backoff, \
+                                               max_backoff = max_backoff, client_factory = lambda: FakeClient(failures, requests, lats, lons))
+        for (year, month, variable), nfail in jobs.items():
+            failures[target(year, month, variable)] = nfail
+            scheduler.add(year, month, variable)
+        scheduler.start()
+        return {(year, month, variable) : status for year, month, variable, status in scheduler.results()}
+
+    # (year, month, variable) : failures in total over both runs
+    first = {(start, 1, "2m_temperature") : 0, \
+             (start, 1, "total_precipitation") : 2, \
+             (start, 2, "2m_temperature") : max_attempts + 1}
+    statuses = run(first)
+
+    # as left by a run stopped after two failed attempts at a download
+    with open(state_file, "r") as infile:
+        state = json.load(infile)
+    state[get_era5.DownloadScheduler.key(start, 2, "total_precipitation")] = \
+        {"year" : start, "month" : 2, "variable" : "total_precipitation", "attempts" : max_attempts - 1, "status" : "pending"}
+    with open(state_file, "w") as outfile:
+        json.dump(state, outfile)
+
+    # the failed download gets a fresh set of attempts, the stopped one only those it has left
+    second = {(start, 2, "2m_temperature") : max_attempts + 1, \
+              (start, 2, "total_precipitation") : 1}
+    statuses.update(run(second))
+
+    # (year, month, variable) : status, attempts in the final run, requests over both runs
+    expected = {(start, 1, "2m_temperature") : ("done", 1, 1), \
+                (start, 1, "total_precipitation") : ("done", 3, 3), \
+                (start, 2, "2m_temperature") : ("done", 2, max_attempts + 2), \
+                (start, 2, "total_precipitation") : ("failed", max_attempts, 1)}
+
+    with open(state_file, "r") as infile:
+        state = json.load(infile)
+
+    failed = []
+    for (year, month, variable), (status, attempts, nrequests) in expected.items():
+        key = get_era5.DownloadScheduler.key(year, month, variable)
+        filename = target(year, month, variable)
+        found = (statuses[(year, month, variable)], state[key]["status"], state[key]["attempts"], len(requests.get(filename, [])))
+        print("{}: {}, {} attempts, {} requests".format(key, found[0], found[2], found[3]))
+        if found != (status, status, attempts, nrequests):
+            print("{}: expected {}, {} attempts, {} requests".format(key, status, attempts, nrequests))
+            failed += [key]
+        elif (status == "done") != (get_era5.check_success(year, month, variable) and catalog.is_done("raw", path=filename)):
+            print("{}: file {} in the catalog".format(key, "not" if status == "done" else "wrongly"))
+            failed += [key]
+
+    # waits between the requests of the first run, doubling from the backoff up to its cap
+    for year, month, variable in first:
+        filename = target(year, month, variable)
+        times = requests[filename][:max_attempts]
+        for attempt, wait in enumerate(np.diff(times)):
+            delay = min(backoff * 2**attempt, max_backoff)
+            print("{}: retry {} after {:.2f}s (backoff {}s)".format(os.path.basename(filename), attempt + 1, wait, delay))
+            # allow for the workers waking up, but not for a wait as long as the next doubling
+            if not delay - 0.01 <= wait < delay + backoff / 2.:
+                failed += [get_era5.DownloadScheduler.key(year, month, variable)]
+
+    if len(failed) > 0:
+        raise Exception("Download queue went wrong for {}".format(sorted(set(failed))))
+    print("download queue retried, backed off, gave up and resumed as expected")
+
+    return # check_download
+
+#****************************************
+def check_append(start, end, profile = "default"):
+    '''
+    Calculate every index in calculate_indices.py for the whole record, and again for
+    the record without its last year and then with that year appended, and compare
+    the final files.  The base period is the first two years.
+
+    :param int start: first year
+    :param int end: last year
+    :param str profile: storage profile for the output files
+    '''
+
+    # only imported here, as DATALOC is set for the stage processes alone, and the base
+    #   period set before calculate_indices (and the kernels) are imported
+    import utils
+    import catalog
+    utils.STARTYEAR = start
+    utils.base_period_start, utils.base_period_end = start, start + 1
+    import calculate_indices
+
+    if end - start + 1 < utils.APPEND_LOOKBACK_YEARS + 2:
+        raise Exception("Checking --append needs at least {} years".format(utils.APPEND_LOOKBACK_YEARS + 2))
+
+    indices = list(calculate_indices.INDICES.keys()) + list(calculate_indices.DROUGHT_INDICES.keys())
+    outputs = [(index, land) for index in indices for land in [False, True]]
+
+    # the whole record, kept aside
+    utils.ENDYEAR = end
+    calculate_indices.main(indices, str(start), profile = profile)
+    full = os.path.join(utils.DATALOC, "check_full")
+    os.makedirs(full, exist_ok=True)
+    for index, land in outputs:
+        shutil.copy(utils.final_filename(index, land = land), full)
+        catalog.remove(utils.final_filename(index, land = land))
+
+    # without the last year, then appending it
+    utils.ENDYEAR = end - 1
+    calculate_indices.main(indices, str(start), profile = profile)
+    utils.ENDYEAR = end
+    calculate_indices.main(indices, str(start), profile = profile, append = True)
+
+    failures = []
+    for index, land in outputs:
+        filename = utils.final_filename(index, land = land)
+        with ncdf.Dataset(os.path.join(full, os.path.basename(filename)), "r") as expected, ncdf.Dataset(filename, "r") as appended:
+            for name, variable in expected.variables.items():
+                if variable.ndim < 2:
+                    continue
+                ours = np.ma.filled(appended.variables[name][:].astype(np.float64), np.nan)
+                theirs = np.ma.filled(variable[:].astype(np.float64), np.nan)
+                if ours.shape != theirs.shape:
+                    print("{} {}: shape {} rather than {}".format(os.path.basename(filename), name, ours.shape, theirs.shape))
+                    failures += [(index, name)]
+                    continue
+                # thresholds are used as stored when appending, so allow for their rounding
+                different = ~np.isclose(ours, theirs, rtol=1.e-4, atol=1.e-4, equal_nan=True)
+                if different.any():
+                    print("{} {}: {} values differ, by up to {}".format(os.path.basename(filename), name, different.sum(), \
+                                                                       np.nanmax(np.abs(ours - theirs)[different])))
+                    failures += [(index, name)]
+
+    if len(failures) > 0:
+        raise Exception("Appending differs from the whole record for {}".format(sorted(set([index for index, name in failures]))))
+    print("appending matches the whole record for {} indices".format(len(indices)))
+
+    return # check_append
+
+#****************************************
+def run_stage(stage, dataloc, start, end, resolution, expver = True, profile = "default"):
+    '''
+    Run one stage on the synthetic data (in the process started by time_stage)
+
+    :param str stage: stage name, from STAGES, or "check_" and the name of a check
+    :param str dataloc: DATALOC
+    :param int start: first year
+    :param int end: last year
+    :param float resolution: grid spacing in degrees
+    :param bool expver: make the final month a mixture of ERA5 and ERA5T
+    :param str profile: storage profile for the output files
+    '''
+
+    # only imported here, as DATALOC is set for the stage processes alone
+    import utils
+
+    years = range(start, end + 1)
+
+    if stage == "generate":
+        generate(dataloc, start, end, resolution, expver = expver)
+
+    elif stage == "combine":
+        import get_era5
+        for year in years:
+            for month in range(1, 13):
+                get_era5.combine(year, month, profile = profile)
+
+    elif stage == "make_dailies":
+        import convert_era5
+        for year in years:
+            for month in range(1, 13):
+                convert_era5.make_dailies(year, month, profile = profile)
+
+    elif stage == "make_years":
+        import convert_era5
+        for year in years:
+            convert_era5.make_years(year, profile = profile)
+
+    elif stage == "make_tiles":
+        import make_tiles
+        n_tiles = (len(utils.box_edge_lats)-1) * (len(utils.box_edge_lons)-1)
+        for batch in utils.chunks(list(range(1, n_tiles+1)), TILE_BATCH):
+            make_tiles.main(batch, profile = profile)
+
+    elif stage == "climpact":
+        write_indices()
+
+    elif stage == "merge_tiles":
+        import merge_tiles
+        merge_tiles.main(list(INDICES.keys()), str(start), profile = profile)
+
+    elif stage == "extra_indices":
+        import registry
+        import extra_indices
+        # those the stand-in makes the inputs for
+        derived = [index for index, (inputs, _, _, _) in registry.DERIVED.items() if all([name in INDICES for name in inputs])]
+        extra_indices.main(derived, lsm_year = str(start), profile = profile)
+
+    elif stage == "check_append":
+        check_append(start, end, profile = profile)
+
+    elif stage == "check_download":
+        check_download(start, resolution)
+
+    return # run_stage
+
+#****************************************
+def input_size(dataloc, patterns):
+    '''
+    Total size (bytes) of the files of the first pattern which has any
+
+    :param str dataloc: DATALOC
+    :param list patterns: glob patterns, relative to DATALOC
+
+    :returns: int
+    '''
+
+    for pattern in patterns:
+        files = glob.glob(os.path.join(dataloc, pattern))
+        if len(files) > 0:
+            return sum([os.path.getsize(filename) for filename in files])
+
+    return 0 # input_size
+
+#****************************************
+def tree_memory(pid):
+    '''
+    Resident set of a process and all its descendants, from /proc
+
+    :param int pid: process id
+
+    :returns: MB
+    '''
+
+    children, pages = {}, {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", entry, "stat"), "r") as stat:
+                # fields after the command name, from the state (field 3)
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            # finished in the meantime
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        pages[int(entry)] = int(fields[21])
+
+    total, pending = 0, [pid]
+    while len(pending) > 0:
+        process = pending.pop()
+        total += pages.get(process, 0)
+        pending += children.get(process, [])
+
+    return total * os.sysconf("SC_PAGE_SIZE") / 1024.**2 # tree_memory
+
+#****************************************
+def time_stage(stage, dataloc, arguments):
+    '''
+    Run a stage in a new process with DATALOC set, logging its output to DATALOC
+
+    :param str stage: stage name
+    :param str dataloc: DATALOC
+    :param list arguments: command line arguments to pass on
+
+    :returns: seconds taken, peak resident set (MB) of the process tree, and of the
+              largest single process, exit status
+    '''
+
+    environment = dict(os.environ, ERA5_DATALOC=dataloc)
+    command = [sys.executable, os.path.abspath(__file__), "--run_stage", stage, "--dataloc", dataloc] + arguments
+
+    with open(os.path.join(dataloc, "benchmark_{}.log".format(stage)), "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=environment, \
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        # wait4 rather than wait, for the resource use of the process
+        peak = 0.
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            peak = max(peak, tree_memory(process.pid))
+            time.sleep(SAMPLE_SECONDS)
+        elapsed = time.perf_counter() - start
+
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    # ru_maxrss (kB on Linux) is the largest of the process and its waited-for children
+    return elapsed, peak, usage.ru_maxrss / 1024., process.returncode # time_stage
+
+#****************************************
+def main(resolution = 2.0, start = 2000, nyears = 2, stages = None, profile = "default", expver = True, dataloc = None, keep = False, \
+         check = None):
+    '''
+    Make the synthetic data and time each stage on it
+
+    :param float resolution: grid spacing in degrees
+    :param int start: first year
+    :param int nyears: number of years
+    :param list stages: stages to run (default all, in order)
+    :param str profile: storage profile for the output files
+    :param bool expver: make the final month a mixture of ERA5 and ERA5T
+    :param str dataloc: directory to use as DATALOC (default, a new temporary directory)
+    :param bool keep: keep the files afterwards
+    :param str check: run this check (and the stages it needs) instead, from CHECKS
+    '''
+
+    if check is not None:
+        stages = CHECKS[check] + ["check_{}".format(check)]
+    else:
+        if stages is None:
+            stages = list(STAGES.keys())
+        stages = [stage for stage in STAGES if stage in stages]
+
+    if dataloc is None:
+        dataloc = tempfile.mkdtemp(prefix="era5_benchmark_")
+    elif not os.path.exists(dataloc):
+        os.makedirs(dataloc)
+    print("DATALOC {}".format(dataloc))
+
+    end = start + nyears - 1
+    lats, lons = grid(resolution)
+    point_days = len(lats) * len(lons) * ((dt.date(end, 12, 31) - dt.date(start, 1, 1)).days + 1)
+    print("{} x {} grid, {}-{} ({:.1f} million grid-point-days)".format(len(lats), len(lons), start, end, point_days / 1.e6))
+
+    arguments = ["--resolution", str(resolution), "--start", str(start), "--years", str(nyears), "--profile", profile] + \
+        ([] if expver else ["--no_expver"])
+
+    print("{:15s} {:>10s} {:>10s} {:>8s} {:>12s} {:>10s} {:>12s}".format("stage", "time (s)", "input (GB)", "GB/s", "Mpt-days/s", \
+                                                                        "peak (MB)", "1 proc (MB)"))
+    try:
+        for stage in stages:
+            size = input_size(dataloc, STAGES.get(stage, [])) / 1024.**3
+            elapsed, peak, largest, status = time_stage(stage, dataloc, arguments)
+            if stage == "generate":
+                # report what was written instead
+                size = input_size(dataloc, ["raw/*.nc"]) / 1024.**3
+
+            print("{:15s} {:10.1f} {:10.3f} {:8.3f} {:12.2f} {:10.0f} {:12.0f}".format(stage, elapsed, size, size / elapsed, \
+                                                                                   point_days / elapsed / 1.e6, peak, largest))
+            if status != 0:
+                print("{} failed, see {}".format(stage, os.path.join(dataloc, "benchmark_{}.log".format(stage))))
+                keep = True
+                break
+        else:
+            if check is not None:
+                print("{} check passed".format(check))
+    finally:
+        if keep:
+            print("files kept in {}".format(dataloc))
+        else:
+            shutil.rmtree(dataloc)
+
+    return # main
+
+#****************************************
+if __name__ == "__main__":
+
+    import argparse
+
+    # set up keyword arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolution', dest='resolution', action='store', default=2.0, type=float,
+                        help='Grid spacing in degrees [2.0]')
+    parser.add_argument('--start', dest='start', action='store', default=2000, type=int,
+                        help='First year [2000]')
+    parser.add_argument('--years', dest='years', action='store', default=2, type=int,
+                        help='Number of years [2]')
+    parser.add_argument('--stages', dest='stages', action='store', nargs='+', default=None, choices=list(STAGES.keys()),
+                        help='Stages to run [all]')
+    parser.add_argument('--profile', dest='profile', action='store', default="default",
+                        help='Storage profile for output files [default]')
+    parser.add_argument('--no_expver', dest='expver', action='store_false', default=True,
+                        help='No ERA5/ERA5T mixture in the final month')
+    parser.add_argument('--dataloc', dest='dataloc', action='store', default=None,
+                        help='Directory to use as DATALOC [new temporary directory]')
+    parser.add_argument('--keep', dest='keep', action='store_true', default=False,
+                        help='Keep the files afterwards')
+    parser.add_argument('--check', dest='check', action='store', default=None, choices=list(CHECKS.keys()),
+                        help='Check the results of part of the chain, rather than time every stage')
+    parser.add_argument('--run_stage', dest='run_stage', action='store', default=None, \
+                        choices=list(STAGES.keys()) + ["check_{}".format(check) for check in CHECKS], help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run_stage is not None:
+        run_stage(args.run_stage, args.dataloc, args.start, args.start + args.years - 1, args.resolution, \
+                  expver = args.expver, profile = args.profile)
+    else:
+        main(resolution = args.resolution, start = args.start, nyears = args.years, stages = args.stages, \
+             profile = args.profile, expver = args.expver, dataloc = args.dataloc, keep = args.keep, check = args.check)
+
+#*******************************************
+# END
+#*******************************************
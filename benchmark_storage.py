@@ -0,0 +1,140 @@
+#!/bin/env python
+"""
+Compare the storage profiles (utils.STORAGE_PROFILES) on a sample of real data
+
+A block of days is read from a daily (or any other) file, then written and read
+back with each profile, reporting the file size, compression ratio, write and
+read throughput, and the largest change to the values (from quantization).
+
+Run as::
+
+  python benchmark_storage.py [--file FILE] [--variable tx2m] [--days N] [--profiles default zstd ...]
+
+--file       netCDF file to sample (default, the latest annual file of daily values)
+--variable   Variable to sample
+--days       Number of time steps to sample
+--profiles   Profiles to compare (default, all of them)
+"""
+
+#*******************************************
+# START
+#*******************************************
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import netCDF4 as ncdf
+
+import utils
+import catalog
+
+#****************************************
+def write_sample(filename, data, profile):
+    '''
+    Write the sample with a given storage profile
+
+    :param str filename: output file
+    :param array data: sample (time, latitude, longitude)
+    :param str profile: storage profile
+
+    :returns: seconds taken
+    '''
+
+    start = time.perf_counter()
+
+    outfile = ncdf.Dataset(filename, "w")
+    for name, length in zip(["time", "latitude", "longitude"], data.shape):
+        outfile.createDimension(name, length)
+    var = outfile.createVariable("sample", "f4", ("time", "latitude", "longitude"), fill_value=utils.MDI, \
+                                 **utils.storage_options(data.shape, profile))
+    var[:] = data
+    outfile.close()
+
+    return time.perf_counter() - start # write_sample
+
+#****************************************
+def read_sample(filename):
+    '''
+    Read the sample back
+
+    :param str filename: file to read
+
+    :returns: data, seconds taken
+    '''
+
+    start = time.perf_counter()
+
+    with ncdf.Dataset(filename, "r") as infile:
+        data = infile.variables["sample"][:]
+
+    return data, time.perf_counter() - start # read_sample
+
+#****************************************
+def main(filename, variable = "tx2m", ndays = 31, profiles = None):
+    '''
+    Write and read back a sample of data with each storage profile and report
+    the size/throughput trade-off
+
+    :param str filename: netCDF file to sample
+    :param str variable: variable to sample
+    :param int ndays: number of time steps to sample
+    :param list profiles: profiles to compare (default all)
+    '''
+
+    if profiles is None:
+        profiles = list(utils.STORAGE_PROFILES.keys())
+
+    with ncdf.Dataset(filename, "r") as infile:
+        data = infile.variables[variable][:ndays]
+
+    raw_mb = data.size * 4 / 1024**2
+    print("{} {} {} ({:.1f} MB uncompressed)".format(os.path.basename(filename), variable, data.shape, raw_mb))
+    print("{:10s} {:>10s} {:>7s} {:>12s} {:>12s} {:>10s}".format("profile", "size (MB)", "ratio", "write MB/s", "read MB/s", "max error"))
+
+    tmpdir = tempfile.mkdtemp(dir=utils.DATALOC)
+    try:
+        for profile in profiles:
+            outfile = os.path.join(tmpdir, "{}.nc".format(profile))
+
+            write_time = write_sample(outfile, data, profile)
+            result, read_time = read_sample(outfile)
+            size_mb = os.path.getsize(outfile) / 1024**2
+
+            error = np.ma.max(np.ma.abs(result - data))
+
+            print("{:10s} {:10.1f} {:7.2f} {:12.1f} {:12.1f} {:10.4f}".format(profile, size_mb, raw_mb / size_mb, \
+                                                                              raw_mb / write_time, raw_mb / read_time, error))
+            os.remove(outfile)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return # main
+
+#****************************************
+if __name__ == "__main__":
+
+    import argparse
+
+    # set up keyword arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', dest='file', action='store', default=None,
+                        help='File to sample [latest annual daily file]')
+    parser.add_argument('--variable', dest='variable', action='store', default="tx2m",
+                        help='Variable to sample [tx2m]')
+    parser.add_argument('--days', dest='days', action='store', default=31, type=int,
+                        help='Number of time steps to sample [31]')
+    parser.add_argument('--profiles', dest='profiles', action='store', nargs='+', default=None,
+                        choices=list(utils.STORAGE_PROFILES.keys()), help='Profiles to compare [all]')
+
+    args = parser.parse_args()
+
+    filename = args.file
+    if filename is None:
+        filename = sorted(catalog.lookup("daily", month=None, window="00UTC"), key=lambda row: row["year"])[-1]["path"]
+
+    main(filename, variable = args.variable, ndays = args.days, profiles = args.profiles)
+
+#*******************************************
+# END
+#*******************************************
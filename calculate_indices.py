@@ -0,0 +1,884 @@
+#!/bin/env python
+"""
+Calculate the simple ETCCDI indices directly from the daily data, for the whole grid
+
+Indices which are reductions, counts or running sums of the daily Tx, Tn and P
+(TXx, TNn, SU, FD, Rx5day, PRCPTOT, SDII etc), and the percentile based indices
+(TX90p, TN10p, R95p etc, see percentiles.py), and the spell durations (CDD, CWD,
+WSDI, CSDI, see spells.py) and SPI/SPEI (see drought.py), are calculated here
+with array operations over blocks of the grid, instead of through Climpact for each tile and
+merge_tiles.  Output is in the same final/ERA5_{index}_{STARTYEAR}-{ENDYEAR}.nc
+(and _land.nc) files, with "Ann" and/or "Jan"..."Dec" variables for the periods
+each index has in registry.py.
+
+The base period thresholds (percentiles and SPI/SPEI fits) are stored as they
+are calculated.  To add a year, set utils.ENDYEAR to it and run with --append:
+only that year (and utils.APPEND_LOOKBACK_YEARS before it) is read, the stored
+thresholds are used, and the new values are appended to copies of the existing
+final files, which replace them (named for the new end year) once all are written.  CDD and CWD spells can be longer
+than the years read, so their final files also keep the length of the spells
+going on at the end of the year before the next append reads, to carry them on.
+
+Run as::
+
+  python calculate_indices.py --index TXx TNn ... [--lsm_year YYYY] [--profile NAME] [--validate TILE] [--append]
+
+--index     Indices to calculate, or "all" for all of them
+--lsm_year  Year to take the land-sea mask from, if land_mask.py hasn't stored it
+--profile   Storage profile (chunking, compression) for the output files (utils.STORAGE_PROFILES)
+--validate  Compare the indices for this tile with the Climpact output, rather than calculate them
+--append    Add utils.ENDYEAR to the existing final files
+"""
+
+#*******************************************
+# START
+#*******************************************
+import os
+import shutil
+import calendar
+import datetime as dt
+import numpy as np
+import netCDF4 as ncdf
+
+import utils
+import catalog
+import registry
+import land_mask
+import rechunk_dailies
+import percentiles
+import spells
+import drought
+
+MONTHS = list(calendar.month_abbr)[1:]
+
+# names used for the inputs here, and in the daily files
+VARIABLES = {"tx" : "tx2m", "tn" : "tn2m", "tp" : "tp"}
+
+# most missing days allowed in a month/year for an index value (as climdex)
+MAX_MISSING = {"mon" : 3, "ann" : 15}
+
+# shortest warm/cold spell for WSDI and CSDI
+SPELL_DAYS = 6
+
+# indices whose daily values depend on the days after (windows centred on the day, spells counted
+# in the period they end), so change at the end of the record: calculated again when appending
+ACROSS_YEARS = ["Rx3day", "Rx5day", "CDD", "CWD"]
+
+# variable in the CDD and CWD final files of the lengths of the spells going on at the end of a year
+RUNNING = "spell_length"
+
+#****************************************
+def flag(data, condition):
+    '''
+    Condition as 1/0 for each day, keeping missing days as NaN
+
+    :param array data: daily values
+    :param array condition: boolean array
+
+    :returns: array
+    '''
+
+    return np.where(np.isnan(data), np.nan, condition).astype(np.float32) # flag
+
+#****************************************
+def running_sum(data, ndays):
+    '''
+    Sum over a window of days centred on each day (as climdex Rxnday), along the whole record
+    so that windows can span months and years.  Windows with any missing day are NaN.
+
+    :param array data: daily values (time, latitude, longitude)
+    :param int ndays: length of window
+
+    :returns: array
+    '''
+
+    filled = np.cumsum(np.nan_to_num(data), axis=0, dtype=np.float64)
+    missing = np.cumsum(np.isnan(data), axis=0)
+
+    totals = np.full(data.shape, np.nan, dtype=np.float32)
+    window_sum = filled[ndays-1:].copy()
+    window_sum[1:] -= filled[:-ndays]
+    window_missing = missing[ndays-1:].copy()
+    window_missing[1:] -= missing[:-ndays]
+    window_sum[window_missing > 0] = np.nan
+
+    # place on the central day
+    start = (ndays - 1) // 2
+    totals[start : start + window_sum.shape[0]] = window_sum
+
+    return totals # running_sum
+
+#****************************************
+def wet_days(tp):
+    '''Precipitation on wet days (>= 1mm), zero on dry days, NaN where missing'''
+    return np.where(tp >= 1, tp, np.where(np.isnan(tp), np.nan, 0)).astype(np.float32) # wet_days
+
+#****************************************
+def in_spells(data, condition, starts, index):
+    '''
+    Days in warm/cold spells (WSDI, CSDI), which are broken at the start of each period
+    so would differ between annual and monthly values
+
+    :param array data: daily values, NaN where missing
+    :param array condition: boolean array
+    :param dict starts: "ann", "mon" : index of the first day of each period
+    :param str index: index name, for the periods it has
+
+    :returns: dictionary of "ann" and/or "mon" : array
+    '''
+
+    return {timescale : spells.days_in_spells(data, condition, SPELL_DAYS, starts[timescale]) for timescale in timescales(index)} # in_spells
+
+#****************************************
+def consecutive(d, index, condition):
+    '''
+    Daily values for the longest spell (CDD, CWD).  Spells going on at the start of the
+    days read carry on from their stored lengths (d["running"], when appending), and the
+    lengths of those going on at d["running_day"] are kept there for the next append.
+
+    :param dict d: daily data
+    :param str index: index name
+    :param array condition: boolean array, days in a spell
+
+    :returns: array
+    '''
+
+    running = d.get("running", {})
+    if index not in running:
+        return spells.spell_ends(d["tp"], condition)
+
+    values, running[index] = spells.spell_ends(d["tp"], condition, initial = running[index], running = d["running_day"])
+
+    return values # consecutive
+
+#****************************************
+def base_percentile(d, name, prob):
+    '''Calendar day percentile thresholds of a variable over the base period'''
+
+    return d["thresholds"].get("{}{:02d}".format(name, int(round(prob * 100))), ("day",), \
+                               lambda: percentiles.calendar_thresholds(d[name], d["years"], d["cal"], prob)) # base_percentile
+
+#****************************************
+def wet_day_percentile(d, prob):
+    '''Percentile of precipitation on wet days over the base period'''
+
+    return d["thresholds"].get("r{:02d}".format(int(round(prob * 100))), (), \
+                               lambda: percentiles.wet_day_threshold(d["tp"], d["years"], prob)) # wet_day_percentile
+
+#****************************************
+# name : (inputs, daily values, reduction, units, long name), for the periods in registry.py
+# daily values are either one array, or a dictionary of "ann", "mon" : array
+INDICES = {"TXx" : (["tx"], lambda d: d["tx"], "max", "degrees_C", "Maximum daily maximum temperature"), \
+           "TXn" : (["tx"], lambda d: d["tx"], "min", "degrees_C", "Minimum daily maximum temperature"), \
+           "TNx" : (["tn"], lambda d: d["tn"], "max", "degrees_C", "Maximum daily minimum temperature"), \
+           "TNn" : (["tn"], lambda d: d["tn"], "min", "degrees_C", "Minimum daily minimum temperature"), \
+           "DTR" : (["tx", "tn"], lambda d: d["tx"] - d["tn"], "mean", "degrees_C", "Mean diurnal temperature range"), \
+           "TXm" : (["tx"], lambda d: d["tx"], "mean", "degrees_C", "Mean daily maximum temperature"), \
+           "TNm" : (["tn"], lambda d: d["tn"], "mean", "degrees_C", "Mean daily minimum temperature"), \
+           "TMm" : (["tx", "tn"], lambda d: 0.5 * (d["tx"] + d["tn"]), "mean", "degrees_C", "Mean daily mean temperature"), \
+           "SU" : (["tx"], lambda d: flag(d["tx"], d["tx"] > 25), "sum", "days", "Number of summer days (Tx > 25C)"), \
+           "ID" : (["tx"], lambda d: flag(d["tx"], d["tx"] < 0), "sum", "days", "Number of icing days (Tx < 0C)"), \
+           "FD" : (["tn"], lambda d: flag(d["tn"], d["tn"] < 0), "sum", "days", "Number of frost days (Tn < 0C)"), \
+           "TR" : (["tn"], lambda d: flag(d["tn"], d["tn"] > 20), "sum", "days", "Number of tropical nights (Tn > 20C)"), \
+           "TXge30" : (["tx"], lambda d: flag(d["tx"], d["tx"] >= 30), "sum", "days", "Number of days when Tx >= 30C"), \
+           "TXge35" : (["tx"], lambda d: flag(d["tx"], d["tx"] >= 35), "sum", "days", "Number of days when Tx >= 35C"), \
+           "TMge5" : (["tx", "tn"], lambda d: flag(d["tx"] + d["tn"], 0.5 * (d["tx"] + d["tn"]) >= 5), "sum", "days", "Number of days when Tm >= 5C"), \
+           "TMlt5" : (["tx", "tn"], lambda d: flag(d["tx"] + d["tn"], 0.5 * (d["tx"] + d["tn"]) < 5), "sum", "days", "Number of days when Tm < 5C"), \
+           "TMge10" : (["tx", "tn"], lambda d: flag(d["tx"] + d["tn"], 0.5 * (d["tx"] + d["tn"]) >= 10), "sum", "days", "Number of days when Tm >= 10C"), \
+           "TMlt10" : (["tx", "tn"], lambda d: flag(d["tx"] + d["tn"], 0.5 * (d["tx"] + d["tn"]) < 10), "sum", "days", "Number of days when Tm < 10C"), \
+           "TNlt2" : (["tn"], lambda d: flag(d["tn"], d["tn"] < 2), "sum", "days", "Number of days when Tn < 2C"), \
+           "TNltm2" : (["tn"], lambda d: flag(d["tn"], d["tn"] < -2), "sum", "days", "Number of days when Tn < -2C"), \
+           "TNltm20" : (["tn"], lambda d: flag(d["tn"], d["tn"] < -20), "sum", "days", "Number of days when Tn < -20C"), \
+           "Rx1day" : (["tp"], lambda d: d["tp"], "max", "mm", "Maximum 1-day precipitation"), \
+           "Rx3day" : (["tp"], lambda d: running_sum(d["tp"], 3), "max", "mm", "Maximum 3-day precipitation"), \
+           "Rx5day" : (["tp"], lambda d: running_sum(d["tp"], 5), "max", "mm", "Maximum 5-day precipitation"), \
+           "PRCPTOT" : (["tp"], lambda d: wet_days(d["tp"]), "sum", "mm", "Total wet-day precipitation"), \
+           "R10mm" : (["tp"], lambda d: flag(d["tp"], d["tp"] >= 10), "sum", "days", "Number of heavy precipitation days (P >= 10mm)"), \
+           "R20mm" : (["tp"], lambda d: flag(d["tp"], d["tp"] >= 20), "sum", "days", "Number of very heavy precipitation days (P >= 20mm)"), \
+           "SDII" : (["tp"], lambda d: wet_days(d["tp"]), "intensity", "mm/day", "Simple daily intensity index"), \
+           "TX90p" : (["tx"], lambda d: percentiles.exceedance(d["tx"], d["years"], d["cal"], 0.9, True, \
+                                                        thresholds = base_percentile(d, "tx", 0.9)), "percent", "%", "Percentage of days when Tx > 90th percentile"), \
+           "TX10p" : (["tx"], lambda d: percentiles.exceedance(d["tx"], d["years"], d["cal"], 0.1, False, \
+                                                        thresholds = base_percentile(d, "tx", 0.1)), "percent", "%", "Percentage of days when Tx < 10th percentile"), \
+           "TN90p" : (["tn"], lambda d: percentiles.exceedance(d["tn"], d["years"], d["cal"], 0.9, True, \
+                                                        thresholds = base_percentile(d, "tn", 0.9)), "percent", "%", "Percentage of days when Tn > 90th percentile"), \
+           "TN10p" : (["tn"], lambda d: percentiles.exceedance(d["tn"], d["years"], d["cal"], 0.1, False, \
+                                                        thresholds = base_percentile(d, "tn", 0.1)), "percent", "%", "Percentage of days when Tn < 10th percentile"), \
+           "R95p" : (["tp"], lambda d: percentiles.wet_day_excess(d["tp"], d["years"], 0.95, threshold = wet_day_percentile(d, 0.95)), "sum", "mm", "Total precipitation on very wet days (> 95th percentile)"), \
+           "R99p" : (["tp"], lambda d: percentiles.wet_day_excess(d["tp"], d["years"], 0.99, threshold = wet_day_percentile(d, 0.99)), "sum", "mm", "Total precipitation on extremely wet days (> 99th percentile)"), \
+           "CDD" : (["tp"], lambda d: consecutive(d, "CDD", d["tp"] < 1), "spell", "days", "Maximum number of consecutive dry days (P < 1mm)"), \
+           "CWD" : (["tp"], lambda d: consecutive(d, "CWD", d["tp"] >= 1), "spell", "days", "Maximum number of consecutive wet days (P >= 1mm)"), \
+           "WSDI" : (["tx"], lambda d: in_spells(d["tx"], percentiles.threshold_exceedance(d["tx"], d["years"], d["cal"], 0.9, True, \
+                                                                       thresholds = base_percentile(d, "tx", 0.9)) == 1, d["starts"], "WSDI"), \
+                     "sum", "days", "Warm spell duration index (days in spells of >= 6 days when Tx > 90th percentile)"), \
+           "CSDI" : (["tn"], lambda d: in_spells(d["tn"], percentiles.threshold_exceedance(d["tn"], d["years"], d["cal"], 0.1, False, \
+                                                                       thresholds = base_percentile(d, "tn", 0.1)) == 1, d["starts"], "CSDI"), \
+                     "sum", "days", "Cold spell duration index (days in spells of >= 6 days when Tn < 10th percentile)")}
+
+#****************************************
+# name : (inputs, months accumulated, distribution, long name), monthly values only (as registry.py)
+DROUGHT_INDICES = {}
+for scale in drought.SCALES:
+    DROUGHT_INDICES["{}month_SPI".format(scale)] = (["tp"], scale, "gamma", "{}-month Standardised Precipitation Index".format(scale))
+    DROUGHT_INDICES["{}month_SPEI".format(scale)] = (["tp", "tx", "tn"], scale, "loglogistic", \
+                                                    "{}-month Standardised Precipitation Evapotranspiration Index".format(scale))
+
+#****************************************
+def timescales(index):
+    '''Periods ("ann", "mon") the index has values for, as in the final files from Climpact'''
+
+    return registry.timescales(index) # timescales
+
+#****************************************
+def reduce_periods(values, missing, starts, reduction, max_missing):
+    '''
+    Reduce daily values to one value per period (month or year)
+
+    :param array values: daily values (time, latitude, longitude), NaN where missing
+    :param array missing: daily flag of missing inputs
+    :param array starts: index of the first day of each period
+    :param str reduction: "max", "min", "mean", "sum", "intensity" (mean of non-zero days),
+                          "percent" (sum as a percentage of valid days) or "spell" (longest
+                          spell ending in the period, from spells.spell_ends)
+    :param int max_missing: periods with more missing days than this are NaN
+
+    :returns: array (period, latitude, longitude)
+    '''
+
+    if reduction == "max":
+        result = np.fmax.reduceat(values, starts, axis=0)
+    elif reduction == "min":
+        result = np.fmin.reduceat(values, starts, axis=0)
+    elif reduction == "spell":
+        # zero with no spell, NaN for a period entirely within a spell (as climdex)
+        result = np.fmax.reduceat(values, starts, axis=0)
+        outside = np.add.reduceat(values < 0, starts, axis=0, dtype=int) > 0
+        result = np.where(result > 0, result, np.where(outside, 0, np.nan))
+    else:
+        result = np.add.reduceat(np.nan_to_num(values), starts, axis=0, dtype=np.float64)
+        if reduction == "mean":
+            result /= np.maximum(np.add.reduceat(np.isfinite(values), starts, axis=0, dtype=int), 1)
+        elif reduction == "percent":
+            result *= 100. / np.maximum(np.add.reduceat(np.isfinite(values), starts, axis=0, dtype=int), 1)
+        elif reduction == "intensity":
+            # zero where there are no wet days (as climdex)
+            result /= np.maximum(np.add.reduceat(values > 0, starts, axis=0, dtype=int), 1)
+
+    result = result.astype(np.float32)
+    result[np.add.reduceat(missing, starts, axis=0, dtype=int) > max_missing] = np.nan
+
+    return result # reduce_periods
+
+#****************************************
+class DailyData:
+    '''
+    Daily Tx, Tn and P for the whole record (or from a given year), read a block of
+    the grid at a time.  From the tile-major store if it has been made and the whole
+    record is wanted, otherwise the annual files.  Latitudes run north to south, as
+    for the tiles and the merged indices.
+    '''
+    def __init__(self, first_year = None):
+        # the store holds every year made, so only when that ends with utils.ENDYEAR
+        self.from_store = first_year is None and rechunk_dailies.store_is_current() and \
+            max([row["year"] for row in catalog.lookup("daily", month=None, window="00UTC")]) == utils.ENDYEAR
+        if self.from_store:
+            self.files = [rechunk_dailies.STORE]
+        else:
+            rows = sorted(catalog.lookup("daily", month=None, window="00UTC"), key=lambda row: row["year"])
+            self.files = [row["path"] for row in rows if (first_year is None or row["year"] >= first_year) and row["year"] <= utils.ENDYEAR]
+
+        with ncdf.Dataset(self.files[0], "r") as first:
+            lats = first.variables["latitude"][:]
+            self.lons = first.variables["longitude"][:]
+            self.units = first.variables["time"].units
+            self.calendar = getattr(first.variables["time"], "calendar", "standard")
+
+        self.descending = lats[0] > lats[-1]
+        self.lats = lats if self.descending else lats[::-1]
+
+        times, _ = rechunk_dailies.read_times(self.files, self.units, self.calendar)
+        dates = ncdf.num2date(times, self.units, calendar=self.calendar)
+        self.years = np.array([d.year for d in dates])
+        self.months = np.array([d.month for d in dates])
+        self.cal = percentiles.calendar_days(self.months, np.array([d.day for d in dates]))
+
+    def read(self, rows, columns = slice(None)):
+        '''
+        Read a block of the grid
+
+        :param slice rows: latitudes (north to south)
+        :param slice columns: longitudes
+
+        :returns: dictionary of "tx", "tn", "tp" : array (time, latitude, longitude), NaN where missing,
+                  "years", "months", "cal" : year, month and calendar day of each day, and "lats"
+        '''
+        if self.descending:
+            file_rows = rows
+        else:
+            file_rows = slice(len(self.lats) - rows.stop, len(self.lats) - rows.start)
+
+        blocks = {short : [] for short in VARIABLES}
+        for filename in self.files:
+            with ncdf.Dataset(filename, "r") as ncfile:
+                for short, name in VARIABLES.items():
+                    blocks[short] += [np.ma.filled(ncfile.variables[name][:, file_rows, columns].astype(np.float32), np.nan)]
+
+        daily = {"years" : self.years, "months" : self.months, "cal" : self.cal, "lats" : self.lats[rows]}
+        for short in VARIABLES:
+            daily[short] = np.concatenate(blocks[short])
+            if not self.descending:
+                daily[short] = daily[short][:, ::-1]
+
+        return daily
+
+#****************************************
+def thresholds_file():
+    '''
+    File of base period thresholds for the whole grid, named by the base period and
+    input data version, so that a change to either makes a new one
+    '''
+
+    return os.path.join(utils.DATALOC, "thresholds", "era5_grid_thresholds_{}-{}_{}.nc".format(utils.base_period_start, \
+                                                                                              utils.base_period_end, utils.DATA_VERSION))
+
+#****************************************
+class BaseThresholds:
+    '''
+    Base period thresholds (calendar day percentiles, wet-day percentiles, SPI/SPEI fits)
+    for the current block of the grid.  Calculated and written to the thresholds file
+    (adding to it if it exists), or read back from it when appending, and kept for the
+    other indices in the block which use them.  With no file they are just calculated.
+    '''
+    def __init__(self, filename = None, lats = [], lons = [], block = (1, 1), append = False, profile = utils.STORAGE_PROFILE):
+        self.filename = filename
+        self.append = append
+        self.block = block
+        self.profile = profile
+        self.band = slice(None)
+        self.columns = slice(None)
+        self.cache = {}
+        self.ncfile = None
+        self.written = False
+
+        if filename is None:
+            return
+        if append:
+            if not catalog.is_done("thresholds", path=filename):
+                raise RuntimeError("No stored thresholds ({}), calculate the indices in full first".format(filename))
+            self.ncfile = ncdf.Dataset(filename, "r")
+        elif os.path.exists(filename):
+            self.ncfile = ncdf.Dataset(filename, "a")
+        else:
+            self.ncfile = ncdf.Dataset(filename, "w")
+            self.ncfile.base_period = "{}-{}".format(utils.base_period_start, utils.base_period_end)
+            self.ncfile.data_version = utils.DATA_VERSION
+            for name, size in [("day", 365), ("month", 12), ("parameter", 3), ("latitude", len(lats)), ("longitude", len(lons))]:
+                self.ncfile.createDimension(name, size)
+            for name, values in [("latitude", lats), ("longitude", lons)]:
+                coord = self.ncfile.createVariable(name, "f4", (name,))
+                coord.units = "degrees_north" if name == "latitude" else "degrees_east"
+                coord[:] = values
+
+    def set_block(self, band, columns):
+        '''Move on to the next block of latitudes and longitudes'''
+        self.band = band
+        self.columns = columns
+        self.cache = {}
+
+    def get(self, name, dims, calculate):
+        '''
+        Thresholds for the block
+
+        :param str name: name of the thresholds
+        :param tuple dims: dimensions other than latitude and longitude, e.g. ("day",)
+        :param func calculate: returns the thresholds for the block (dims, latitude, longitude)
+
+        :returns: array
+        '''
+        if name in self.cache:
+            return self.cache[name]
+
+        if self.append:
+            values = np.ma.filled(self.ncfile.variables[name][..., self.band, self.columns].astype(np.float32), np.nan)
+        else:
+            values = calculate()
+            if self.ncfile is not None:
+                if name not in self.ncfile.variables:
+                    dims = tuple(dims) + ("latitude", "longitude")
+                    shape = tuple([len(self.ncfile.dimensions[dim]) for dim in dims])
+                    # chunks of one block, as written
+                    self.ncfile.createVariable(name, "f4", dims, fill_value=utils.MDI, \
+                                               **utils.storage_options(shape, self.profile, chunks = shape[:-2] + tuple(self.block)))
+                self.ncfile.variables[name][..., self.band, self.columns] = np.ma.masked_invalid(values)
+                self.written = True
+
+        self.cache[name] = values
+        return values
+
+    def close(self):
+        '''Close the file, and record it if written'''
+        if self.ncfile is None:
+            return
+        self.ncfile.close()
+        if self.written:
+            catalog.record("thresholds", self.filename, variable=utils.DATA_VERSION, \
+                           time_start=utils.base_period_start, time_end=utils.base_period_end)
+
+#****************************************
+def create_final_file(filename, index, variables, lats, lons, units, calendar, \
+                      index_units, long_name, profile = utils.STORAGE_PROFILE, chunks = None):
+    '''
+    Set up a final index file for the whole grid, to be filled a block at a time.
+    Each variable ("Ann", "Jan"...) has its own (unlimited, so later years can be appended)
+    time axis.
+
+    :param str filename: output file
+    :param str index: index name
+    :param dict variables: name : time values of each variable
+    :param array lats: latitudes
+    :param array lons: longitudes
+    :param str units: time units
+    :param str calendar: time calendar
+    :param str index_units: units of the index
+    :param str long_name: description of the index
+    :param str profile: storage profile
+    :param tuple chunks: (latitude, longitude) chunk shape to use instead of the profile's,
+                         with the whole time axis in each chunk
+
+    :returns: open netCDF4 Dataset
+    '''
+
+    outfile = ncdf.Dataset(filename, "w")
+    outfile.Conventions = "CF-1.7"
+    outfile.index = index
+
+    outfile.createDimension("latitude", len(lats))
+    outfile.createDimension("longitude", len(lons))
+    for name, values in [("latitude", lats), ("longitude", lons)]:
+        coord = outfile.createVariable(name, "f4", (name,))
+        coord.standard_name = name
+        coord.units = "degrees_north" if name == "latitude" else "degrees_east"
+        coord[:] = values
+
+    for name, times in variables.items():
+        time_name = "time" if name == "Ann" else "time_{}".format(name)
+        outfile.createDimension(time_name, None)
+        time = outfile.createVariable(time_name, "f8", (time_name,))
+        time.standard_name = "time"
+        time.units = units
+        time.calendar = calendar
+        time[:] = times
+
+        var = outfile.createVariable(name, "f4", (time_name, "latitude", "longitude"), fill_value=utils.MDI, \
+                                     **utils.storage_options((len(times), len(lats), len(lons)), profile, \
+                                                             chunks = None if chunks is None else (len(times),) + tuple(chunks)))
+        var.long_name = long_name
+        var.units = index_units
+        var.missing_value = np.float32(utils.MDI)
+
+    return outfile # create_final_file
+
+#****************************************
+def previous_final_files(index, land):
+    '''
+    Recorded final files of an index from before utils.ENDYEAR, latest last
+
+    :param str index: index name
+    :param bool land: land-only version
+
+    :returns: list of filenames
+    '''
+
+    new = utils.final_filename(index, land = land)
+
+    return [row["path"] for row in catalog.lookup("final", index_name=index, variable="land" if land else "all") if row["path"] != new] # previous_final_files
+
+#****************************************
+def extend_final_file(index, land, dates, rewrite_last = False):
+    '''
+    Copy the existing final file of an index to a working file to append new periods
+    to, and add the new times.  The existing file is left as it is, so a run which
+    stops part way can just be run again; finish_final_files puts the working files
+    in place, named for the new end year (utils.ENDYEAR), once all are written.
+
+    :param str index: index name
+    :param bool land: land-only version
+    :param dict dates: variable ("Ann", "Jan"...) : datetime of each period calculated
+    :param bool rewrite_last: also write the periods of the existing last year again (for
+                              windows and spells at the end of it, which now run on)
+
+    :returns: open netCDF4 Dataset, dictionary of variable : (position of first new
+              period in the file, boolean array of the calculated periods to add)
+    '''
+
+    previous = previous_final_files(index, land)
+    old = previous[-1] if len(previous) > 0 else utils.final_filename(index, land = land, end = utils.ENDYEAR - 1)
+    new = utils.final_filename(index, land = land)
+
+    shutil.copyfile(old, new + ".tmp")
+    outfile = ncdf.Dataset(new + ".tmp", "a")
+
+    additions = {}
+    for name, period_dates in dates.items():
+        time_name = "time" if name == "Ann" else "time_{}".format(name)
+        if time_name not in outfile.dimensions or not outfile.dimensions[time_name].isunlimited():
+            outfile.close()
+            raise RuntimeError("{} has no unlimited {} axis to append to, calculate in full".format(old, time_name))
+
+        time = outfile.variables[time_name]
+        calendar = getattr(time, "calendar", "standard")
+        last = ncdf.num2date(time[-1], time.units, calendar=calendar).year
+        if last != utils.ENDYEAR - 1:
+            outfile.close()
+            raise RuntimeError("{} ends in {}, append one year at a time".format(old, last))
+
+        keep = np.array([d.year > last or (rewrite_last and d.year == last) for d in period_dates])
+        start = len(time) - (sum([d.year == last for d in period_dates]) if rewrite_last else 0)
+        if keep.any():
+            time[start : start + keep.sum()] = ncdf.date2num([d for d, k in zip(period_dates, keep) if k], time.units, calendar=calendar)
+        additions[name] = (start, keep)
+
+    return outfile, additions # extend_final_file
+
+#****************************************
+def finish_final_files(outfiles, append):
+    '''
+    Close and record the final files once every block has been written.  When appending,
+    the working files replace the existing files, which are only removed once all the
+    new ones are in place.
+
+    :param dict outfiles: (index, suffix) : open netCDF4 Dataset
+    :param bool append: files are working copies from extend_final_file
+    '''
+
+    for (index, suffix), outfile in outfiles.items():
+        filename = outfile.filepath()
+        outfile.close()
+        if append:
+            os.replace(filename, utils.final_filename(index, land = suffix == "_land"))
+            filename = utils.final_filename(index, land = suffix == "_land")
+        catalog.record("final", filename, index_name=index, variable="land" if suffix == "_land" else "all")
+
+    if append:
+        for index, suffix in outfiles:
+            for filename in previous_final_files(index, suffix == "_land"):
+                catalog.remove(filename)
+
+    return # finish_final_files
+
+#****************************************
+def running_spells(outfile, first_year, append, profile = utils.STORAGE_PROFILE):
+    '''
+    Lengths of the spells going on at the end of a year, kept in a CDD/CWD final file
+    so that appending can carry on spells longer than the years it reads.  Added when
+    calculating in full; when appending they have to be for the year before those read.
+
+    :param obj outfile: open netCDF4 Dataset
+    :param int first_year: first year read
+    :param bool append: appending to an existing file
+    :param str profile: storage profile
+
+    :returns: netCDF4 Variable (latitude, longitude), with "year" set once it is all written
+    '''
+
+    if not append:
+        shape = (len(outfile.dimensions["latitude"]), len(outfile.dimensions["longitude"]))
+        var = outfile.createVariable(RUNNING, "i4", ("latitude", "longitude"), fill_value=-1, **utils.storage_options(shape, profile))
+        var.long_name = "Length of the spells going on at the end of the year"
+        var.units = "days"
+        return var
+
+    if RUNNING not in outfile.variables:
+        raise RuntimeError("{} has no lengths of the spells going on to carry on, calculate in full".format(outfile.filepath()))
+    var = outfile.variables[RUNNING]
+    if getattr(var, "year", None) != first_year - 1:
+        raise RuntimeError("{} has the spells going on at the end of {}, not {}, calculate in full".format(outfile.filepath(), \
+                                                                                                       getattr(var, "year", None), first_year - 1))
+
+    return var # running_spells
+
+#****************************************
+def blocks(nlats, nlons, points, tile_lat, tile_lon):
+    '''
+    Blocks of the grid to calculate at once, made of whole chunks of the store (tiles,
+    with the latitudes counted from the south as the store runs south to north), so
+    each chunk is only read once: bands of as many rows of tiles as fit, or if one
+    row doesn't, a row of tiles split into as many tiles along it as fit.  Only if
+    not even one tile fits are the tiles split, and their chunks read more than once.
+
+    :param int nlats: number of latitudes
+    :param int nlons: number of longitudes
+    :param int points: most grid points to read at once
+    :param int tile_lat: latitudes in a tile
+    :param int tile_lon: longitudes in a tile
+
+    :returns: list of (latitude slice, longitude slice), latitudes north to south
+    '''
+
+    if points >= tile_lat * nlons:
+        rows, columns = points // nlons // tile_lat * tile_lat, nlons
+    elif points >= tile_lat * tile_lon:
+        rows, columns = tile_lat, points // (tile_lat * tile_lon) * tile_lon
+    else:
+        print("Memory for less than a tile, the chunks of the store will be read more than once")
+        rows, columns = max([n for n in range(1, tile_lat + 1) if tile_lat % n == 0 and n * tile_lon <= points] + [1]), tile_lon
+
+    edges = list(range(nlats, 0, -rows)) + [0]
+    bands = [slice(start, stop) for stop, start in zip(edges[:-1], edges[1:])][::-1]
+
+    return [(band, slice(first, min(first + columns, nlons))) for band in bands for first in range(0, nlons, columns)] # blocks
+
+#****************************************
+def period_starts(years, months):
+    '''
+    First day of each year, and of each month
+
+    :param array years: year of each day
+    :param array months: month of each day
+
+    :returns: dictionary of "ann", "mon" : array of indices
+    '''
+
+    new_year = np.diff(years, prepend=-1) != 0
+    new_month = np.diff(months, prepend=-1) != 0
+
+    return {"ann" : np.where(new_year)[0], "mon" : np.where(new_year | new_month)[0]} # period_starts
+
+#****************************************
+def calculate(index, daily, starts):
+    '''
+    Values of an index for each year and/or month
+
+    :param str index: index name
+    :param dict daily: daily data, as DailyData.read, plus "starts" (from period_starts) and
+                       "thresholds" (BaseThresholds)
+    :param dict starts: "ann", "mon" : index of the first day of each period
+
+    :returns: dictionary of "ann", "mon" : array (period, latitude, longitude)
+    '''
+
+    if index in DROUGHT_INDICES:
+        inputs, scale, distribution, long_name = DROUGHT_INDICES[index]
+        missing = np.any([np.isnan(daily[name]) for name in inputs], axis=0)
+        years, months = daily["years"][starts["mon"]], daily["months"][starts["mon"]]
+
+        # water balance for SPEI
+        monthly = reduce_periods(daily["tp"], missing, starts["mon"], "sum", MAX_MISSING["mon"])
+        if distribution == "loglogistic":
+            tmax = reduce_periods(daily["tx"], missing, starts["mon"], "mean", MAX_MISSING["mon"])
+            tmin = reduce_periods(daily["tn"], missing, starts["mon"], "mean", MAX_MISSING["mon"])
+            monthly -= drought.hargreaves(tmax, tmin, daily["lats"], years, months)
+
+        params = daily["thresholds"].get("{}_{}month".format(index.split("_")[1].lower(), scale), ("month", "parameter"), \
+                                         lambda: drought.fit(drought.accumulate(monthly, scale), years, months, distribution))
+
+        return {"mon" : drought.standardised(monthly, years, months, scale, distribution, params = params)}
+
+    inputs, func, reduction, units, long_name = INDICES[index]
+
+    values = func(daily)
+    if not isinstance(values, dict):
+        values = {timescale : values for timescale in starts}
+    missing = np.any([np.isnan(daily[name]) for name in inputs], axis=0)
+
+    return {timescale : reduce_periods(values[timescale], missing, starts[timescale], reduction, MAX_MISSING[timescale]) \
+            for timescale in timescales(index)} # calculate
+
+#****************************************
+def validate(tile, indices):
+    '''
+    Compare the indices calculated here with the Climpact output for a tile, for
+    both annual and monthly values
+
+    :param int tile: tile to compare on
+    :param list indices: indices to compare
+    '''
+
+    with ncdf.Dataset(os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile)), "r") as ncfile:
+        time = ncfile.variables["time"]
+        dates = ncdf.num2date(time[:], time.units, calendar=getattr(time, "calendar", "standard"))
+        years = np.array([d.year for d in dates])
+        months = np.array([d.month for d in dates])
+        daily = {"years" : years, "months" : months, "lats" : ncfile.variables["latitude"][:], \
+                 "cal" : percentiles.calendar_days(months, np.array([d.day for d in dates]))}
+        for short, name in VARIABLES.items():
+            daily[short] = np.ma.filled(ncfile.variables[name][:].astype(np.float32), np.nan)
+
+    starts = period_starts(years, months)
+    daily["starts"] = starts
+    daily["thresholds"] = BaseThresholds()
+
+    print("{:10s} {:4s} {:>10s} {:>10s} {:>10s}".format("index", "", "max diff", "mean diff", "matching"))
+    for index in indices:
+        results = calculate(index, daily, starts)
+
+        for timescale, ours in results.items():
+            rows = catalog.lookup("indices", tile=int(tile), index_name=index.lower(), timescale=timescale.upper())
+            if len(rows) == 0:
+                print("{:10s} {:4s} no Climpact output".format(index, timescale))
+                continue
+            with ncdf.Dataset(rows[0]["path"], "r") as ncfile:
+                name = [v for v in ncfile.variables if ncfile.variables[v].ndim == 3][0]
+                theirs = np.ma.filled(ncfile.variables[name][:].astype(np.float32), np.nan)
+
+            diff = np.abs(ours - theirs)
+            print("{:10s} {:4s} {:10.4f} {:10.4f} {:10.4f}".format(index, timescale, np.nanmax(diff), np.nanmean(diff), \
+                                                            np.mean((diff < 0.01) | (np.isnan(ours) & np.isnan(theirs)))))
+
+    return # validate
+
+#****************************************
+def main(indices, lsm_year, profile = utils.STORAGE_PROFILE, memory = utils.INDEX_MEMORY_MB, append = False):
+    '''
+    Calculate the indices for the whole grid, a block at a time, and
+    write the full and land-only final files in the same pass
+
+    :param list indices: indices to calculate
+    :param str lsm_year: year to take the land-sea mask from
+    :param str profile: storage profile for the output files
+    :param int memory: approximate memory (MB) to use per block
+    :param bool append: only calculate utils.ENDYEAR, with the stored thresholds, and
+                        append it to the existing final files
+    '''
+
+    if append:
+        if utils.APPEND_LOOKBACK_YEARS < 2:
+            raise RuntimeError("utils.APPEND_LOOKBACK_YEARS must be at least 2, to calculate {} again for the year before".format(ACROSS_YEARS))
+
+        # appended by an earlier run which stopped before it had done the others
+        finished = [index for index in indices if all([catalog.is_done("final", path=utils.final_filename(index, land = land)) \
+                                                       for land in [False, True]])]
+        for index in finished:
+            print("{} already ends in {}".format(index, utils.ENDYEAR))
+            for land in [False, True]:
+                for filename in previous_final_files(index, land):
+                    catalog.remove(filename)
+        indices = [index for index in indices if index not in finished]
+        if len(indices) == 0:
+            return
+
+    data = DailyData(first_year = utils.ENDYEAR - utils.APPEND_LOOKBACK_YEARS if append else None)
+    nlats, nlons = len(data.lats), len(data.lons)
+
+    land = land_mask.load(lsm_year)
+
+    starts = period_starts(data.years, data.months)
+    period_years = {"ann" : data.years[starts["ann"]], "mon" : data.years[starts["mon"]]}
+    period_months = data.months[starts["mon"]]
+
+    dates = {"Ann" : [dt.datetime(y, 1, 1) for y in period_years["ann"]]}
+    for m, month in enumerate(MONTHS):
+        dates[month] = [dt.datetime(y, m+1, 1) for y in period_years["mon"][period_months == m+1]]
+
+    # inputs plus working copies for the index being calculated, in whole chunks of the store
+    points = max(1, int(memory * 1024**2 // (len(data.years) * 4 * 6)))
+    grid_blocks = blocks(nlats, nlons, points, rechunk_dailies.tile_points(data.lats, utils.DELTALAT), \
+                         rechunk_dailies.tile_points(data.lons, utils.DELTALON))
+    block = (max([band.stop - band.start for band, columns in grid_blocks]), max([columns.stop - columns.start for band, columns in grid_blocks]))
+
+    thresholds = BaseThresholds(thresholds_file(), data.lats, data.lons, block = block, append = append, profile = profile)
+
+    # CDD/CWD spells going on at the end of the year before the next append will start
+    running_year = utils.ENDYEAR - utils.APPEND_LOOKBACK_YEARS
+    running_day = np.where(data.years <= running_year)[0][-1]
+    spell_lengths = {}
+
+    # where each variable's periods go in the files
+    outfiles, additions = {}, {}
+    for index in indices:
+        if index in DROUGHT_INDICES:
+            units, long_name = "1", DROUGHT_INDICES[index][3]
+        else:
+            units, long_name = INDICES[index][3:]
+        names = (["Ann"] if "ann" in timescales(index) else []) + (MONTHS if "mon" in timescales(index) else [])
+        spell = index in INDICES and INDICES[index][2] == "spell"
+        for suffix in ["", "_land"]:
+            if append:
+                outfiles[(index, suffix)], additions[(index, suffix)] = extend_final_file(index, suffix == "_land", {name : dates[name] for name in names}, \
+                                                                                          rewrite_last = index in ACROSS_YEARS)
+            else:
+                variables = {name : ncdf.date2num(dates[name], data.units, calendar=data.calendar) for name in names}
+                outfiles[(index, suffix)] = create_final_file(utils.final_filename(index, land = suffix == "_land"), index, variables, \
+                                                              data.lats, data.lons, data.units, data.calendar, units, long_name, profile = profile)
+                additions[(index, suffix)] = {name : (0, np.ones(len(dates[name]), dtype=bool)) for name in names}
+            if suffix == "" and spell:
+                spell_lengths[index] = running_spells(outfiles[(index, suffix)], data.years[0], append, profile = profile)
+
+    for band, columns in grid_blocks:
+        print("latitudes {}-{}, longitudes {}-{}".format(band.start, band.stop, columns.start, columns.stop))
+
+        daily = data.read(band, columns)
+        daily["starts"] = starts
+        thresholds.set_block(band, columns)
+        daily["thresholds"] = thresholds
+        daily["running_day"] = running_day
+        if append:
+            daily["running"] = {index : np.ma.filled(var[band, columns], 0).astype(np.int32) for index, var in spell_lengths.items()}
+        else:
+            daily["running"] = {index : np.zeros((band.stop - band.start, columns.stop - columns.start), dtype=np.int32) for index in spell_lengths}
+
+        for index in indices:
+            by_period = calculate(index, daily, starts)
+            if index in spell_lengths:
+                spell_lengths[index][band, columns] = daily["running"][index]
+
+            results = {}
+            if "ann" in by_period:
+                results["Ann"] = by_period["ann"]
+            if "mon" in by_period:
+                for m, month in enumerate(MONTHS):
+                    results[month] = by_period["mon"][period_months == m+1]
+
+            for name, result in results.items():
+                for suffix, values in [("", result), ("_land", np.where(land[band, columns], result, np.nan))]:
+                    first, keep = additions[(index, suffix)][name]
+                    if not keep.any():
+                        continue
+                    outfiles[(index, suffix)].variables[name][first : first + keep.sum(), band, columns] = np.ma.masked_invalid(values[keep])
+
+            del by_period
+
+        del daily
+
+    thresholds.close()
+
+    for var in spell_lengths.values():
+        var.year = running_year
+
+    finish_final_files(outfiles, append)
+
+    return # main
+
+#****************************************
+if __name__ == "__main__":
+
+    import argparse
+
+    # set up keyword arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', dest='index', action='store', nargs='+', default=["all"],
+                        help='indices to calculate, or "all" [all]')
+    parser.add_argument('--lsm_year', dest='lsm_year', action='store', default="2020",
+                        help='Year to find file with LSM information (YYYY01_hourly.nc)')
+    parser.add_argument('--profile', dest='profile', action='store', default=utils.STORAGE_PROFILE, choices=list(utils.STORAGE_PROFILES.keys()),
+                        help='Storage profile for output files [{}]'.format(utils.STORAGE_PROFILE))
+    parser.add_argument('--validate', dest='validate', action='store', default=None, type=int,
+                        help='Compare with the Climpact output for this tile, rather than calculate the indices')
+    parser.add_argument('--append', dest='append', action='store_true', default=False,
+                        help='Append utils.ENDYEAR to the existing final files, using the stored thresholds')
+
+    args = parser.parse_args()
+
+    if args.index == ["all"]:
+        indices = list(INDICES.keys()) + list(DROUGHT_INDICES.keys())
+    else:
+        indices = args.index
+
+    if args.validate is not None:
+        validate(args.validate, indices)
+    else:
+        main(indices, args.lsm_year, profile = args.profile, append = args.append)
+
+#*******************************************
+# END
+#*******************************************
@@ -0,0 +1,221 @@
+#!/bin/env python
+"""
+Catalog of all the products made by the processing chain, held in a single
+SQLite database in DATALOC.  Stages record what they make, and look up what
+is available, rather than probing the filesystem for files and success markers.
+
+Stages are "raw", "hourly", "mask", "daily", "store", "tile", "thresholds", "indices" and "final".
+
+Run as::
+
+  python catalog.py [--rebuild]
+
+--rebuild   Scan DATALOC once and record any existing products (e.g. made before
+              the catalog existed, or by Climpact)
+"""
+
+#*******************************************
+# START
+#*******************************************
+import os
+import re
+import glob
+import sqlite3
+import datetime as dt
+
+import utils
+
+COLUMNS = ["stage", "path", "year", "month", "tile", "variable", "index_name", "timescale", "window", \
+           "shape", "time_start", "time_end", "size", "mtime", "checksum", "status", "updated"]
+
+#****************************************
+def connect():
+    '''
+    Open the catalog, making the table if needed.  Long timeout as many array jobs
+    may be writing at once.
+
+    :returns: sqlite3 connection
+    '''
+
+    connection = sqlite3.connect(os.path.join(utils.DATALOC, "catalog.sqlite"), timeout=300)
+    connection.row_factory = sqlite3.Row
+
+    connection.execute("CREATE TABLE IF NOT EXISTS products (stage TEXT NOT NULL, path TEXT PRIMARY KEY, " \
+                       "year INTEGER, month INTEGER, tile INTEGER, variable TEXT, index_name TEXT, timescale TEXT, window TEXT, " \
+                       "shape TEXT, time_start TEXT, time_end TEXT, size INTEGER, mtime REAL, checksum TEXT, status TEXT, updated TEXT)")
+    connection.execute("CREATE INDEX IF NOT EXISTS stage_index ON products (stage, year, month, tile, index_name)")
+
+    return connection # connect
+
+#****************************************
+def record(stage, path, status="done", shape=None, **fields):
+    '''
+    Record (or update) a product
+
+    :param str stage: processing stage
+    :param str path: file
+    :param str status: "done", "failed", "removed" etc
+    :param tuple shape: shape of the main variable(s)
+    :param fields: any other columns (year, month, tile, variable, index_name, timescale, window,
+                   time_start, time_end, checksum)
+    '''
+
+    row = {column : None for column in COLUMNS}
+    row.update(fields)
+    row["stage"] = stage
+    row["path"] = path
+    row["status"] = status
+    row["updated"] = dt.datetime.now().isoformat()
+    if shape is not None:
+        row["shape"] = "x".join([str(s) for s in shape])
+
+    if status == "done" and os.path.exists(path):
+        stat = os.stat(path)
+        row["size"] = stat.st_size
+        row["mtime"] = stat.st_mtime
+
+    for key in ["time_start", "time_end"]:
+        if row[key] is not None:
+            row[key] = str(row[key])
+
+    with connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO products ({}) VALUES ({})".format(", ".join(COLUMNS), ", ".join(["?"]*len(COLUMNS))), \
+                           [row[column] for column in COLUMNS])
+    connection.close()
+
+    return # record
+
+#****************************************
+def lookup(stage, status="done", **filters):
+    '''
+    Find products for a stage matching the filters (a value of None matches NULL)
+
+    :param str stage: processing stage
+    :param str status: status to match
+    :param filters: column=value pairs
+
+    :returns: list of rows (as dictionaries), sorted by path
+    '''
+
+    clauses = ["stage = ?", "status = ?"]
+    values = [stage, status]
+    for column, value in filters.items():
+        if value is None:
+            clauses += ["{} IS NULL".format(column)]
+        else:
+            clauses += ["{} = ?".format(column)]
+            values += [value]
+
+    connection = connect()
+    rows = connection.execute("SELECT * FROM products WHERE {} ORDER BY path".format(" AND ".join(clauses)), values).fetchall()
+    connection.close()
+
+    return [dict(row) for row in rows] # lookup
+
+#****************************************
+def is_done(stage, **filters):
+    '''
+    Has the product been made?
+    '''
+
+    return len(lookup(stage, **filters)) > 0 # is_done
+
+#****************************************
+def remove(path):
+    '''
+    Mark a product as removed (and delete the file if still present)
+    '''
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    with connect() as connection:
+        connection.execute("UPDATE products SET status = 'removed', updated = ? WHERE path = ?", [dt.datetime.now().isoformat(), path])
+    connection.close()
+
+    return # remove
+
+#****************************************
+def record_climpact(tile):
+    '''
+    Record the index files Climpact has written for a tile
+    (file names are index_TIMESCALE_climpact.era5_historical_tile_base.nc)
+    '''
+
+    pattern = os.path.join(utils.DATALOC, "indices", "*_climpact.era5_historical_{}_{}-{}.nc".format(tile, utils.base_period_start, utils.base_period_end))
+
+    for filename in glob.glob(pattern):
+        index, timescale = os.path.basename(filename).split("_climpact")[0].rsplit("_", 1)
+        record("indices", filename, tile=int(tile), index_name=index, timescale=timescale)
+
+    return # record_climpact
+
+#****************************************
+def rebuild():
+    '''
+    Scan DATALOC once and record all existing products
+    '''
+
+    for filename in glob.glob(os.path.join(utils.DATALOC, "raw", "*_hourly_*.nc")):
+        match = re.match(r"(\d{4})(\d{2})_hourly_(.*)\.nc", os.path.basename(filename))
+        record("raw", filename, year=int(match.group(1)), month=int(match.group(2)), variable=match.group(3))
+
+    for filename in glob.glob(os.path.join(utils.DATALOC, "hourlies", "*_hourly.nc")):
+        match = re.match(r"(\d{4})(\d{2})_hourly\.nc", os.path.basename(filename))
+        record("hourly", filename, year=int(match.group(1)), month=int(match.group(2)))
+
+    if os.path.exists(os.path.join(utils.DATALOC, "era5_land_mask.nc")):
+        record("mask", os.path.join(utils.DATALOC, "era5_land_mask.nc"), variable=str(utils.LAND_FRACTION_THRESH))
+
+    for filename in glob.glob(os.path.join(utils.DATALOC, "dailies", "*_daily*.nc")):
+        match = re.match(r"(\d{4})(\d{2})?_daily_?(.*)\.nc", os.path.basename(filename))
+        if match is None:
+            continue
+        month = int(match.group(2)) if match.group(2) is not None else None
+        window = match.group(3) if match.group(3) != "" else "00UTC"
+        record("daily", filename, year=int(match.group(1)), month=month, window=window)
+
+    for filename in glob.glob(os.path.join(utils.DATALOC, "tiles", "era5_tile_*.nc")):
+        match = re.match(r"era5_tile_(\d+)\.nc", os.path.basename(filename))
+        record("tile", filename, tile=int(match.group(1)))
+
+    for filename in glob.glob(os.path.join(utils.DATALOC, "thresholds", "era5_thresholds_*.nc")):
+        match = re.match(r"era5_thresholds_(\d+)_(\d{4})-(\d{4})_(.*)\.nc", os.path.basename(filename))
+        record("thresholds", filename, tile=int(match.group(1)), variable=match.group(4), time_start=match.group(2), time_end=match.group(3))
+
+    for filename in glob.glob(os.path.join(utils.DATALOC, "thresholds", "era5_grid_thresholds_*.nc")):
+        match = re.match(r"era5_grid_thresholds_(\d{4})-(\d{4})_(.*)\.nc", os.path.basename(filename))
+        record("thresholds", filename, variable=match.group(3), time_start=match.group(1), time_end=match.group(2))
+
+    for tile in range(1, (len(utils.box_edge_lats)-1) * (len(utils.box_edge_lons)-1) + 1):
+        record_climpact(tile)
+
+    for filename in glob.glob(os.path.join(utils.DATALOC, "final", "ERA5_*.nc")):
+        index = os.path.basename(filename).split("_")[1]
+        record("final", filename, index_name=index)
+
+    return # rebuild
+
+#****************************************
+if __name__ == "__main__":
+
+    import argparse
+
+    # set up keyword arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild', dest='rebuild', action='store_true', default=False,
+                        help='Record existing products in the catalog, default = False')
+
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild()
+
+    connection = connect()
+    for row in connection.execute("SELECT stage, status, COUNT(*) FROM products GROUP BY stage, status ORDER BY stage"):
+        print("{:10s} {:10s} {}".format(*row))
+    connection.close()
+
+#*******************************************
+# END
+#*******************************************
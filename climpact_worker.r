@@ -0,0 +1,73 @@
+# ------------------------------------------------
+# Long-lived Climpact2 worker for run_climpact.py.
+# Loads the modified climdex.pcic.ncdf package once, then reads one tile job per
+# line on stdin (tab separated: tile, infile, outdir, file.template, base start,
+# base end, cores, thresholds file, "make" or "use") and calls 'create.indices.from.files'
+# for each.  With "make" the base period thresholds are first written to the thresholds
+# file by 'create.thresholds.from.file', and with "use" they are read from it.
+# After each job a line "CLIMPACT_WORKER<tab>tile<tab>done" (or the error message)
+# is written to stdout; everything else on stdout is climdex's own output.
+# Settings as in the original per-tile wrapper.
+# ------------------------------------------------
+
+library(climdex.pcic.ncdf)
+
+# list of variable names according to the tile files
+vars=c(prec="tp",tmax="tx2m", tmin="tn2m")
+
+# author data
+author.data=list(institution="Met Office Hadley Centre", institution_id="MOHC")
+
+# list of indices to calculate, or NULL to calculate all.
+indices=NULL	#c("hw","tnn")
+
+#######################################################
+# Esoterics below, do not modify without a good reason.
+
+# definition used for Excess Heat Factor (EHF). "PA13" for Perkins and Alexander (2013), this is the default. "NF13" for Nairn and Fawcett (2013).
+EHF_DEF = "PA13"
+
+# axis to split data on. For chunking up of grid, leave this.
+axis.name="Y"
+
+# Number of data values to process at once. If you receive "Error: rows.per.slice >= 1 is not TRUE", try increasing this to 20. You might have a large grid.
+maxvals=10
+
+# output compatible with FCLIMDEX. Leave this.
+fclimdex.compatible=FALSE
+
+input <- file("stdin", open="r")
+
+while (length(line <- readLines(input, n=1)) > 0) {
+
+	job <- strsplit(line, "\t")[[1]]
+	tile <- job[1]
+
+	# number of cores to use, or FALSE for single core.
+	cores <- if (job[7] == "1") FALSE else as.integer(job[7])
+
+	# base period thresholds, made once per tile then reused
+	thresholds.files <- job[8]
+
+	status <- tryCatch({
+		if (job[9] == "make") {
+			create.thresholds.from.file(job[2],thresholds.files,author.data,variable.name.map=vars,base.range=c(as.integer(job[5]),as.integer(job[6])),parallel=cores,
+				axis.to.split.on=axis.name,fclimdex.compatible=fclimdex.compatible,max.vals.millions=maxvals,cluster.type="SOCK")
+		}
+		create.indices.from.files(job[2],job[3],job[4],author.data,variable.name.map=vars,base.range=c(as.integer(job[5]),as.integer(job[6])),parallel=cores,axis.to.split.on=axis.name,climdex.vars.subset=indices,thresholds.files=thresholds.files,fclimdex.compatible=fclimdex.compatible,
+			cluster.type="SOCK",ehfdef=EHF_DEF,max.vals.millions=maxvals,rxnday_n=3,rnnmm_n=30,ntxntn_n=2,ntxbntnb_n=2,wsdin_n=3,csdin_n=3,hddheatn_n=18,cddcoldn_n=18,gddgrown_n=10,
+			thresholds.name.map=c(tx05thresh="tx05thresh",tx10thresh="tx10thresh", tx50thresh="tx50thresh", tx90thresh="tx90thresh",tx95thresh="tx95thresh",
+					tn05thresh="tn05thresh",tn10thresh="tn10thresh",tn50thresh="tn50thresh",tn90thresh="tn90thresh",tn95thresh="tn95thresh",
+					tx90thresh_15days="tx90thresh_15days",tn90thresh_15days="tn90thresh_15days",tavg90thresh_15days="tavg90thresh_15days",
+					tavg05thresh="tavg05thresh",tavg95thresh="tavg95thresh",
+					txraw="txraw",tnraw="tnraw",precraw="precraw",
+					r95thresh="r95thresh", r99thresh="r99thresh",
+			                rxnday_n=3,rnnmm_n=30,ntxntn_n=7,ntxbntnb_n=7,wsdin_n=3,
+			                csdin_n=3,hddheatn_n=18,cddcoldn_n=18,gddgrown_n=10))
+		"done"
+	}, error=function(err) gsub("[\t\n]", " ", conditionMessage(err)))
+
+	cat("CLIMPACT_WORKER", tile, status, sep="\t")
+	cat("\n")
+	flush(stdout())
+}
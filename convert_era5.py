@@ -4,16 +4,19 @@ Convert the monthly files of hourly T and P into annual files of daily values
 
 Run as
 
-  python convert_era5.py --start YEAR --end YEAR [--remove]
+  python convert_era5.py --start YEAR --end YEAR [--remove] [--chunk_days N] [--windows 00UTC 06UTC solar] [--profile NAME]
 
---remove    Remove the input monthly files at the end, leaving just daily files for each year
+--remove       Remove the input monthly files at the end, leaving just daily files for each year
+--chunk_days   Number of days of hourly data to hold in memory at once
+--windows      Day definitions to make (start hour in UTC, or local solar day).  Non-00UTC
+                 files have the window as a suffix, e.g. YYYY_daily_06UTC.nc
+--profile      Storage profile (chunking, compression) for the output files (utils.STORAGE_PROFILES)
 """
 
 #*******************************************
 # START
 #*******************************************
 import os
-import fnmatch
 import datetime
 import numpy as np
 import datetime as dt
@@ -21,99 +24,469 @@ import datetime as dt
 import iris
 import iris.coord_categorisation
 import cf_units
+import netCDF4 as ncdf
 
 import utils
+import catalog
+import land_mask
 
 #****************************************
-def make_dailies(year, month, remove = False):
+def read_hours(variable, start, end, padding = 0):
     '''
-    Convert hourly T and P fields into daily Tx, Tn and P-accumulations
+    Read a block of hours from a netCDF variable, returning float32 data with missing values as NaN
 
+    If the variable has an "expver" axis (mixture of ERA5 and ERA5T), the two are merged
+    on the fly, using ERA5T for the times at which ERA5 is missing.
 
-    SPICE notes - 40GB, 10mins per year
+    :param obj variable: netCDF4 variable, (time, [expver,] latitude, longitude)
+    :param int start: first hour to read
+    :param int end: read up to (but not including) this hour
+    :param int padding: number of hours missing from the start of the file (returned as NaN)
+
+    :returns: array
     '''
 
-    try:
-        cubelist = iris.load(os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(year, month)))
+    data = np.full((end - start, variable.shape[-2], variable.shape[-1]), np.nan, dtype=np.float32)
+
+    first = max(start, padding)
+    if end > first:
+        block = variable[first - padding : end - padding]
+        block = np.ma.filled(np.ma.asarray(block).astype(np.float32), np.nan)
+
+        if "expver" in variable.dimensions:
+            era5, era5t = block[:, 0], block[:, 1]
+
+            # use locations of missing data to overwrite
+            missing = np.isnan(era5[:, 0, 0])
+            era5[missing] = era5t[missing]
+            block = era5
+
+        data[first - start:] = block
+
+    return data # read_hours
+
+#****************************************
+def open_month(year, month):
+    '''
+    Open the hourly T and P for a month.  Uses the combined hourly file if it has been
+    written (get_era5.py --hourlies), otherwise reads directly from the raw downloads.
+
+    :param int year: year
+    :param int month: month
+
+    :returns: dictionary of variable : (netCDF4 variable, padding hours), list of open datasets
+    '''
+
+    hourly_file = os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(year, month))
+
+    if catalog.is_done("hourly", year=int(year), month=int(month)):
+        ncfile = ncdf.Dataset(hourly_file, "r")
+        return {"t2m" : (ncfile.variables["t2m"], 0), "tp" : (ncfile.variables["tp"], 0)}, [ncfile]
+
+    t_file = ncdf.Dataset(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_2m_temperature.nc".format(year, month)), "r")
+    p_file = ncdf.Dataset(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_total_precipitation.nc".format(year, month)), "r")
+
+    # precipitation at the start of 1979 is missing some time stamps, pad these at the start
+    padding = len(t_file.dimensions["time"]) - len(p_file.dimensions["time"])
+
+    return {"t2m" : (t_file.variables["t2m"], 0), "tp" : (p_file.variables["tp"], padding)}, [t_file, p_file]
+
+#****************************************
+def day_offsets(window, lons):
+    '''
+    Hour (UTC, relative to midnight) at which each day starts for a given day definition
+
+    :param str window: "HHUTC" for a fixed start hour, or "solar" for the local solar day
+    :param array lons: longitudes (degrees east)
+
+    :returns: array of integer offsets, one per longitude
+    '''
+
+    if window == "solar":
+        # local midnight is earlier in UTC to the east, later to the west
+        east = ((np.asarray(lons) + 180.) % 360.) - 180.
+        return -np.round(east / 15.).astype(int)
+
+    elif window.endswith("UTC"):
+        return np.full(len(lons), int(window[:-3]), dtype=int)
+
+    else:
+        raise ValueError("unknown day window {}".format(window))
+
+    return # day_offsets
+
+#****************************************
+def window_suffix(window):
+    '''
+    Filename suffix for the given day definition (none for 00-00 UTC, the default)
+    '''
+
+    if window == "00UTC":
+        return ""
+    else:
+        return "_{}".format(window)
+
+    return # window_suffix
+
+#****************************************
+def neighbouring_months(year, month):
+    '''
+    Previous and following months
+
+    :returns: (year, month), (year, month)
+    '''
+
+    previous = dt.date(year, month, 1) - dt.timedelta(days=1)
+    following = dt.date(year, month, 28) + dt.timedelta(days=4)
+
+    return (previous.year, previous.month), (following.year, following.month) # neighbouring_months
 
-        names = [str(c.var_name) for c in cubelist]
+#****************************************
+class HourlySource:
+    '''
+    Hourly T and P for a single month, read in blocks of hours.
 
-#        lsm = cubelist[names.index("lsm")]
+    Hour 0 is the first hour of the month.  Hours either side of the month (needed
+    when days do not start at 00 UTC) are read from the neighbouring months, and
+    flagged as unavailable if those have not been downloaded.
+    '''
+    def __init__(self, year, month):
+        self.year, self.month = year, month
+        self.datasets = []
+
+        self.months = {0 : self._open(year, month)}
+
+        self.ncfile = self.months[0]["t2m"][0].group()
+        self.nhours = len(self.ncfile.dimensions["time"])
+        self.lats = self.ncfile.variables["latitude"][:]
+        self.lons = self.ncfile.variables["longitude"][:]
+
+        times = self.ncfile.variables["time"][:]
+        self.first_time = times[0]
+        self.time_step = times[1] - times[0]
+
+    def _open(self, year, month):
+        variables, datasets = open_month(year, month)
+        self.datasets += datasets
+        return variables
+
+    def open_neighbours(self):
+        '''Open the previous and following months, where they exist'''
+        for key, (year, month) in zip([-1, 1], neighbouring_months(self.year, self.month)):
+            try:
+                self.months[key] = self._open(year, month)
+            except FileNotFoundError:
+                pass
+
+    def time(self, hour):
+        '''Time coordinate value of an hour (can lie outside the month)'''
+        return self.first_time + np.asarray(hour) * self.time_step
+
+    def read(self, var, start, end):
+        '''
+        Read hours [start, end) of a variable
+
+        :returns: data (NaN where missing), boolean array of which hours were available
+        '''
+        blocks, available = [], []
+        for key, first, last in [(-1, start, min(end, 0)), (0, max(start, 0), min(end, self.nhours)), (1, max(start, self.nhours), end)]:
+            if last <= first:
+                continue
+            if key in self.months:
+                variable, padding = self.months[key][var]
+                offset = {-1 : variable.shape[0] + padding, 0 : 0, 1 : -self.nhours}[key]
+                blocks += [read_hours(variable, first + offset, last + offset, padding = padding)]
+                available += [np.ones(last - first, dtype=bool)]
+            else:
+                blocks += [np.full((last - first, len(self.lats), len(self.lons)), np.nan, dtype=np.float32)]
+                available += [np.zeros(last - first, dtype=bool)]
+
+        return np.concatenate(blocks), np.concatenate(available)
+
+    def close(self):
+        for ncfile in self.datasets:
+            ncfile.close()
 
-        new_list = []
-        for cube in cubelist:
-#            if cube.var_name == "lsm":
-#                continue
-            print(cube.var_name)
+#****************************************
+# name, long_name, units, cell_method
+DAILY_VARIABLES = {"tx2m" : ("2 metre maximum temperature", "degreesC", "maximum"), \
+                   "tn2m" : ("2 metre minimum temperature", "degreesC", "minimum"), \
+                   "tm2m" : ("2 metre mean temperature", "degreesC", "mean"), \
+                   "tp" : ("Total precipitation", "kg m-2 d-1", "sum"), \
+                   "tpmax" : ("Maximum hourly precipitation", "kg m-2 h-1", "maximum")}
 
-            # mask all regions which are 100% ocean
-#            cube.data[lsm.data == 0] = utils.MDI
-#            cube.data = np.ma.masked_where(lsm.data == 0, cube.data)
-#            cube.data.fill_value = utils.MDI
+#****************************************
+def reduce_days(t2m, tp, available, offsets, first, ndays):
+    '''
+    Fused reduction of blocks of hourly T and P to all daily quantities in one go.
+    Missing (NaN) hours are ignored, but days which need hours which are unavailable
+    (neighbouring month not present) are set to NaN.
+
+    :param array t2m: hourly temperature (time, latitude, longitude) in C
+    :param array tp: hourly precipitation (time, latitude, longitude) in mm
+    :param array available: flag for each hour of the block
+    :param array offsets: hour at which the day starts, per longitude
+    :param int first: position in the block of 00 UTC on the first day
+    :param int ndays: number of days to make
+
+    :returns: dictionary of daily arrays
+    '''
 
-            # add a "day" indicator to allow aggregation
-            iris.coord_categorisation.add_day_of_month(cube, "time", name="day_of_month")
+    shape = (ndays, t2m.shape[1], t2m.shape[2])
+    daily = {name : np.full(shape, np.nan, dtype=np.float32) for name in DAILY_VARIABLES}
 
-            if cube.var_name == "tp":
-                # precip
-                p_cube = cube.aggregated_by(["day_of_month"], iris.analysis.SUM)
-                p_cube.remove_coord("day_of_month")
-                p_cube.data *= 1000. # convert to mm
-                p_cube.units = "mm"
+    for offset in np.unique(offsets):
+        if len(np.unique(offsets)) == 1:
+            lons = slice(None)
+        else:
+            lons, = np.where(offsets == offset)
 
-                # fix units for Climpact
-                p_cube.units = cf_units.Unit("kg m-2 d-1")
+        start = first + offset
+        hours = slice(start, start + 24*ndays)
 
-                new_list += [p_cube]
+        temp = t2m[hours][..., lons].reshape(ndays, 24, shape[1], -1)
+        precip = tp[hours][..., lons].reshape(ndays, 24, shape[1], -1)
+        complete = available[hours].reshape(ndays, 24).all(axis=1)
 
-            if cube.var_name == "t2m":
-                # temperature
-                cube.data -= 273.15 # convert to C
-                cube.units = "degreesC"
+        valid_t = np.isfinite(temp).sum(axis=1)
+        valid_p = np.isfinite(precip).sum(axis=1)
+        sum_t = np.nansum(temp, axis=1)
 
-                tx_cube = cube.aggregated_by(["day_of_month"], iris.analysis.MAX)
-                tx_cube.remove_coord("day_of_month")
-                tx_cube.var_name = "tx2m"
-                tx_cube.long_name = "2 metre maximum temperature"
+        for name, values, valid in [("tx2m", np.fmax.reduce(temp, axis=1), valid_t), \
+                                    ("tn2m", np.fmin.reduce(temp, axis=1), valid_t), \
+                                    ("tm2m", sum_t / np.maximum(valid_t, 1), valid_t), \
+                                    ("tp", np.nansum(precip, axis=1), valid_p), \
+                                    ("tpmax", np.fmax.reduce(precip, axis=1), valid_p)]:
+            values[valid == 0] = np.nan
+            values[~complete] = np.nan
+            daily[name][..., lons] = values
 
-                tn_cube = cube.aggregated_by(["day_of_month"], iris.analysis.MIN)
-                tn_cube.remove_coord("day_of_month")
-                tn_cube.var_name = "tn2m"
-                tn_cube.long_name = "2 metre minimum temperature"
+    return daily # reduce_days
 
-                new_list += [tx_cube]
-                new_list += [tn_cube]
-        # end for cube in cubelist
+#****************************************
+def create_daily_file(filename, hourly, window, profile = utils.STORAGE_PROFILE):
+    '''
+    Set up the file of daily values, with an unlimited time axis so that days can be appended in chunks
 
-        iris.save(new_list, os.path.join(utils.DATALOC, "dailies", "{}{:02d}_daily.nc".format(year, month)), zlib=True)
+    :param str filename: output file
+    :param obj hourly: open netCDF4 Dataset of hourly values to take coordinates from
+    :param str window: day definition
+    :param str profile: storage profile
 
-    except OSError:
-        print("file missing")
+    :returns: open netCDF4 Dataset
+    '''
+
+    outfile = ncdf.Dataset(filename, "w")
+
+    for attr in hourly.ncattrs():
+        outfile.setncattr(attr, hourly.getncattr(attr))
+    outfile.Conventions = "CF-1.7"
+    outfile.day_definition = window
+
+    outfile.createDimension("time", None)
+    outfile.createDimension("latitude", len(hourly.dimensions["latitude"]))
+    outfile.createDimension("longitude", len(hourly.dimensions["longitude"]))
+    outfile.createDimension("bnds", 2)
+
+    time = outfile.createVariable("time", "f8", ("time",))
+    time.axis = "T"
+    time.bounds = "time_bnds"
+    time.units = hourly.variables["time"].units
+    time.standard_name = "time"
+    time.long_name = "time"
+    time.calendar = getattr(hourly.variables["time"], "calendar", "standard")
+    outfile.createVariable("time_bnds", "f8", ("time", "bnds"))
+
+    for name, axis, units in [("latitude", "Y", "degrees_north"), ("longitude", "X", "degrees_east")]:
+        coord = outfile.createVariable(name, "f4", (name,))
+        coord.axis = axis
+        coord.units = units
+        coord.standard_name = name
+        coord.long_name = name
+        coord[:] = hourly.variables[name][:]
+
+    shape = (len(hourly.dimensions["time"]) // 24, len(hourly.dimensions["latitude"]), len(hourly.dimensions["longitude"]))
+    for name, (long_name, units, method) in DAILY_VARIABLES.items():
+        var = outfile.createVariable(name, "f4", ("time", "latitude", "longitude"), fill_value=utils.MDI, **utils.storage_options(shape, profile))
+        var.long_name = long_name
+        var.units = units
+        var.cell_methods = "day_of_month: {}".format(method)
+
+    return outfile # create_daily_file
+
+#****************************************
+def hourly_files(year, month):
+    '''
+    The hourly input files (combined and raw) for a month
+    '''
+
+    return [os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(year, month)), \
+            os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_2m_temperature.nc".format(year, month)), \
+            os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_total_precipitation.nc".format(year, month))] # hourly_files
+
+#****************************************
+def remove_hourlies(year, month):
+    '''
+    Remove the hourly input files (combined and raw) for a month
+    '''
 
-    with open(os.path.join(utils.DATALOC, "{}{:02d}_daily_success.txt".format(year, month)), "w") as outfile:
-        outfile.write("Success {}".format(dt.datetime.now()))
+    for filename in hourly_files(year, month):
+        catalog.remove(filename)
 
-    print("{}-{} done".format(year, month))
+    return # remove_hourlies
+
+#****************************************
+def month_done(year, month, windows):
+    '''
+    Have the daily files of a month been completed for all the day definitions?
+    '''
+
+    return all([catalog.is_done("daily", year=int(year), month=int(month), window=w) for w in windows]) # month_done
+
+#****************************************
+def remove_finished(year, month, windows, earliest, latest):
+    '''
+    Remove the hourly inputs of a month once nothing still needs them: its own daily
+    files, the first days of the following month (days which start before 00 UTC)
+    and the last day of the previous month (days which end after 24 UTC)
+
+    :param int year: year
+    :param int month: month
+    :param list windows: day definitions being made
+    :param int earliest: earliest hour (relative to 00 UTC) any day starts
+    :param int latest: latest hour (relative to 00 UTC) any day starts
+    '''
+
+    previous, following = neighbouring_months(year, month)
+
+    if not month_done(year, month, windows):
+        return
+    if earliest < 0 and not month_done(*following, windows):
+        return
+    if latest > 0 and not month_done(*previous, windows) and any([os.path.exists(f) for f in hourly_files(*previous)]):
+        return
+
+    remove_hourlies(year, month)
+
+    return # remove_finished
+
+#****************************************
+def make_dailies(year, month, remove = False, chunk_days = utils.DAILY_CHUNK_DAYS, windows = utils.DAY_WINDOWS, profile = utils.STORAGE_PROFILE):
+    '''
+    Convert hourly T and P fields into daily Tx, Tn, Tmean, P-accumulations and maximum hourly P
+
+    Streams through the hourly data a few days at a time, so peak memory is set
+    by chunk_days rather than the length of the month.  Reads the combined hourly file
+    if present, otherwise straight from the raw downloads, merging ERA5/ERA5T and
+    padding missing precipitation time stamps on the fly.  Each block of hours is read
+    once and reduced for all the requested day definitions.
+
+    SPICE notes - 40GB, 10mins per year (whole month in memory)
+
+    :param int year: year to process
+    :param int month: month to process
+    :param bool remove: remove the hourly (and raw) files of this month and its neighbours once
+                        nothing needs them (storing the land-sea mask first)
+    :param int chunk_days: number of days to read and reduce at once
+    :param list windows: day definitions to make ("00UTC", "06UTC", "solar" etc)
+    :param str profile: storage profile for the daily files
+    '''
+
+    try:
+        hourly = HourlySource(year, month)
+    except FileNotFoundError:
+        # not downloaded (yet); any other error (corrupt file, full disk) is raised,
+        #    before the inputs could be removed
+        print("{}-{} files missing".format(year, month))
+        return
+
+    # keep the land-sea mask before the hourly files go
+    if remove and not land_mask.is_current() and "lsm" in hourly.ncfile.variables:
+        land_mask.write(hourly.ncfile, os.path.basename(hourly.ncfile.filepath()))
+
+    # hours either side of the UTC day that the windows need
+    offsets = {window : day_offsets(window, hourly.lons) for window in windows}
+    earliest = min([np.min(o) for o in offsets.values()])
+    latest = max([np.max(o) for o in offsets.values()])
+    if earliest < 0 or latest > 0:
+        hourly.open_neighbours()
+
+    ndays = hourly.nhours // 24
+
+    # the last day runs into the following month - if that hasn't been downloaded
+    #    yet, leave it out and record the files as partial, to be made again once it has
+    waiting = latest > 0 and 1 not in hourly.months
+    complete = (hourly.nhours - latest) // 24 if waiting else ndays
+
+    outfiles = {window : create_daily_file(os.path.join(utils.DATALOC, "dailies", "{}{:02d}_daily{}.nc".format(year, month, window_suffix(window))), hourly.ncfile, window, profile = profile) for window in windows}
+
+    for first_day in range(0, complete, chunk_days):
+        last_day = min(first_day + chunk_days, complete)
+        print("days {}-{}".format(first_day+1, last_day))
+
+        # single read of the block of hours covering all windows
+        start, end = 24*first_day + earliest, 24*last_day + latest
+        t2m, available = hourly.read("t2m", start, end)
+        t2m -= 273.15 # convert to C
+        tp, _ = hourly.read("tp", start, end)
+        tp *= 1000. # convert to mm
+
+        for window in windows:
+            daily = reduce_days(t2m, tp, available, offsets[window], 24*first_day - start, last_day - first_day)
+
+            # time points in the middle of the hours which make up the (nominal) day, as for aggregated_by
+            day_start = 24*np.arange(first_day, last_day)
+            if np.all(offsets[window] == offsets[window][0]):
+                day_start += offsets[window][0]
+            bounds = np.array([hourly.time(day_start), hourly.time(day_start + 23)]).T
+
+            outfile = outfiles[window]
+            outfile.variables["time"][first_day:last_day] = np.mean(bounds, axis=1)
+            outfile.variables["time_bnds"][first_day:last_day] = bounds
+            for name in DAILY_VARIABLES:
+                outfile.variables[name][first_day:last_day] = np.ma.masked_invalid(daily[name])
+
+        del t2m, tp
+
+    for window, outfile in outfiles.items():
+        filename = outfile.filepath()
+        outfile.close()
+        catalog.record("daily", filename, status="partial" if waiting else "done", year=int(year), month=int(month), window=window, \
+                       shape=(complete, len(hourly.lats), len(hourly.lons)), \
+                       time_start=dt.date(year, month, 1), time_end=dt.date(year, month, complete))
+    hourly.close()
+
+    if waiting:
+        print("{}-{} done apart from the last day, waiting for the following month".format(year, month))
+    else:
+        print("{}-{} done".format(year, month))
+
+    # finish the previous month, if it was waiting for this one
+    previous, following = neighbouring_months(year, month)
+    unfinished = [w for w in windows if len(catalog.lookup("daily", status="partial", year=previous[0], month=previous[1], window=w)) > 0]
+    if len(unfinished) > 0:
+        make_dailies(previous[0], previous[1], chunk_days = chunk_days, windows = unfinished, profile = profile)
 
     if remove:
-        os.remove(os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(year, month)))
-        
+        for other in [previous, (year, month), following]:
+            remove_finished(other[0], other[1], windows, earliest, latest)
+
     return # make_dailies
 
 
 #****************************************
-def make_years(year, remove = False):
+def make_years(year, remove = False, window = "00UTC", profile = utils.STORAGE_PROFILE):
     '''
     Take all monthly files of daily values, and make a single year file
     Enables save at this point.
     '''
 
-    files = []
-    for filename in os.listdir(os.path.join(utils.DATALOC, "dailies")):
-        if fnmatch.fnmatch(filename, '{}??_daily.nc'.format(year)):
-            files += [os.path.join(utils.DATALOC, "dailies", filename)]
+    files = [row["path"] for row in catalog.lookup("daily", year=int(year), window=window) if row["month"] is not None]
 
-    assert len(files) == 12
+    if len(files) != 12:
+        # e.g. December waiting for the following January
+        print("{} - only {} months complete, annual file not made".format(year, len(files)))
+        return
 
     cubelist = iris.load(files)
 
@@ -131,14 +504,16 @@ def make_years(year, remove = False):
     for cube in new_list:
         assert cube.shape[0] == time_axis
 
-    iris.save(new_list, os.path.join(utils.DATALOC, "dailies", "{}_daily.nc".format(year)), zlib=True)
+    iris.save(new_list, os.path.join(utils.DATALOC, "dailies", "{}_daily{}.nc".format(year, window_suffix(window))), \
+              **utils.storage_options(new_list[0].shape, profile, for_iris = True))
 
-    with open(os.path.join(utils.DATALOC, "{}_success.txt".format(year)), "w") as outfile:
-        outfile.write("Success {}".format(dt.datetime.now()))
+    catalog.record("daily", os.path.join(utils.DATALOC, "dailies", "{}_daily{}.nc".format(year, window_suffix(window))), \
+                   year=int(year), month=None, window=window, shape=new_list[0].shape, \
+                   time_start=dt.date(year, 1, 1), time_end=dt.date(year, 12, 31))
 
     if remove:
         for fn in files:
-            os.remove(fn)
+            catalog.remove(fn)
 
     return # make_years
 
@@ -155,20 +530,30 @@ if __name__ == "__main__":
                         help='End year [2019]')
     parser.add_argument('--remove', dest='remove', action='store_true', default=False,
                         help='Remove hourly and monthly files, default = False')
+    parser.add_argument('--chunk_days', dest='chunk_days', action='store', default=utils.DAILY_CHUNK_DAYS, type=int,
+                        help='Days of hourly data to process at once [{}]'.format(utils.DAILY_CHUNK_DAYS))
+    parser.add_argument('--windows', dest='windows', action='store', nargs='+', default=utils.DAY_WINDOWS,
+                        help='Day definitions to make, e.g. 00UTC 06UTC solar [{}]'.format(" ".join(utils.DAY_WINDOWS)))
+    parser.add_argument('--profile', dest='profile', action='store', default=utils.STORAGE_PROFILE, choices=list(utils.STORAGE_PROFILES.keys()),
+                        help='Storage profile for output files [{}]'.format(utils.STORAGE_PROFILE))
 
     args = parser.parse_args()         
 
     for year in np.arange(args.start, args.end+1):
 
-        if os.path.exists(os.path.join(utils.DATALOC, "dailies", "{}_daily.nc".format(year))):
+        if all([catalog.is_done("daily", year=int(year), month=None, window=w) for w in args.windows]):
             print("{} - already downloaded and processed".format(year))
         else:
             for month in np.arange(1, 13):
 
-                if not os.path.exists(os.path.join(utils.DATALOC, "dailies", "{}{:02d}_daily.nc".format(year, month))):
-                    make_dailies(year, month, remove = args.remove)
+                if not all([catalog.is_done("daily", year=int(year), month=int(month), window=w) for w in args.windows]):
+                    make_dailies(year, month, remove = args.remove, chunk_days = args.chunk_days, windows = args.windows, profile = args.profile)
 
-            make_years(year, remove = args.remove)
+            # including the previous year, if its December was waiting for this January
+            for done_year in [year - 1, year]:
+                for window in args.windows:
+                    if month_done(done_year, 12, [window]) and not catalog.is_done("daily", year=int(done_year), month=None, window=window):
+                        make_years(done_year, remove = args.remove, window = window, profile = args.profile)
 
 #*******************************************
 # END
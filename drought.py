@@ -0,0 +1,283 @@
+#!/bin/env python
+"""
+Array kernels for the standardised drought indices (SPI and SPEI, over 3, 6 and 12 months)
+
+As the SPEI R package used by Climpact: monthly precipitation (SPI), or
+precipitation less Hargreaves potential evapotranspiration (SPEI), is summed over
+the preceding months.  For each calendar month, a gamma (SPI, with the chance of
+zero precipitation fitted separately) or log-logistic (SPEI) distribution is
+fitted to the base period values by unbiased probability weighted moments
+(L-moments), and the probability of each value converted to a standard normal
+deviate.
+
+Fits are done for all grid points at once, with closed form L-moment estimators
+rather than an iterative fit for each point, and can be passed in (e.g. stored
+from an earlier run) so later years can be done without the base period data.
+"""
+
+#*******************************************
+# START
+#*******************************************
+import calendar
+import numpy as np
+from scipy import special
+
+import utils
+
+# months accumulated over
+SCALES = [3, 6, 12]
+
+# probabilities are kept within this distance of 0 and 1, so the indices stay finite
+PROB_LIMIT = 1.e-6
+
+# middle day of year of each month, for the extraterrestrial radiation
+MID_MONTH = np.array([15, 46, 74, 105, 135, 166, 196, 227, 258, 288, 319, 349])
+MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+#****************************************
+def accumulate(monthly, scale):
+    '''
+    Sum over the preceding months (including the current one), NaN if any is missing
+
+    :param array monthly: monthly values (month, latitude, longitude), consecutive months
+    :param int scale: number of months
+
+    :returns: array
+    '''
+
+    filled = np.cumsum(np.nan_to_num(monthly), axis=0, dtype=np.float64)
+    missing = np.cumsum(np.isnan(monthly), axis=0)
+
+    window_sum = filled[scale-1:].copy()
+    window_sum[1:] -= filled[:-scale]
+    window_missing = missing[scale-1:].copy()
+    window_missing[1:] -= missing[:-scale]
+    window_sum[window_missing > 0] = np.nan
+
+    totals = np.full(monthly.shape, np.nan, dtype=np.float32)
+    totals[scale-1:] = window_sum
+
+    return totals # accumulate
+
+#****************************************
+def extraterrestrial_radiation(lats, months):
+    '''
+    Daily extraterrestrial radiation in the middle of each month (FAO-56, equation 21)
+
+    :param array lats: latitudes (degrees)
+    :param array months: month (1-12) of each value
+
+    :returns: array (month, latitude) in mm/day of evaporation equivalent
+    '''
+
+    day = 2 * np.pi * MID_MONTH[np.asarray(months) - 1][:, None] / 365.
+    phi = np.radians(np.asarray(lats, dtype=np.float64))[None, :]
+
+    distance = 1 + 0.033 * np.cos(day)
+    declination = 0.409 * np.sin(day - 1.39)
+    sunset = np.arccos(np.clip(-np.tan(phi) * np.tan(declination), -1, 1))
+
+    radiation = 24 * 60 / np.pi * 0.0820 * distance * \
+        (sunset * np.sin(phi) * np.sin(declination) + np.cos(phi) * np.cos(declination) * np.sin(sunset))
+
+    return 0.408 * radiation # extraterrestrial_radiation
+
+#****************************************
+def hargreaves(tmax, tmin, lats, years, months):
+    '''
+    Monthly potential evapotranspiration by Hargreaves and Samani (1985)
+
+    :param array tmax: monthly mean daily maximum temperature (month, latitude, longitude)
+    :param array tmin: monthly mean daily minimum temperature
+    :param array lats: latitudes
+    :param array years: year of each month
+    :param array months: month of each month
+
+    :returns: array (month, latitude, longitude) in mm/month
+    '''
+
+    radiation = extraterrestrial_radiation(lats, months)[:, :, None]
+
+    days = MONTH_DAYS[np.asarray(months) - 1] + ((np.asarray(months) == 2) & \
+        np.array([calendar.isleap(y) for y in years]))
+
+    with np.errstate(invalid="ignore"):
+        pet = 0.0023 * radiation * (0.5 * (tmax + tmin) + 17.8) * np.sqrt(np.maximum(tmax - tmin, 0))
+
+    return (np.maximum(pet, 0) * days[:, None, None]).astype(np.float32) # hargreaves
+
+#****************************************
+def lmoments(sample):
+    '''
+    First three sample L-moments from unbiased probability weighted moments
+
+    :param array sample: values (sample, point), NaN where missing
+
+    :returns: l1, l2, l3, number of values (each array (point))
+    '''
+
+    x = np.sort(sample, axis=0) # NaNs last
+    n = np.isfinite(x).sum(axis=0)
+    j = np.arange(x.shape[0])[:, None]
+    x = np.where(j < n, np.nan_to_num(x), 0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        b0 = x.sum(axis=0) / n
+        b1 = (j / (n - 1.) * x).sum(axis=0) / n
+        b2 = (j * (j - 1.) / ((n - 1.) * (n - 2.)) * x).sum(axis=0) / n
+
+    return b0, 2*b1 - b0, 6*b2 - 6*b1 + b0, n # lmoments
+
+#****************************************
+def gamma_fit(sample):
+    '''
+    Gamma distribution fitted to the non-zero values, with the chance of zero fitted
+    separately (as SPEI::spi)
+
+    :param array sample: values to fit (sample, point), NaN where missing
+
+    :returns: array (3, point) of probability of zero, shape and scale (NaN where no fit)
+    '''
+
+    valid = np.isfinite(sample).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        zero = (sample == 0).sum(axis=0) / valid
+        l1, l2, _, n = lmoments(np.where(sample > 0, sample, np.nan))
+
+        # shape from the L-CV (Hosking, pelgam)
+        t = l2 / l1
+        z = np.where(t < 0.5, np.pi * t**2, 1 - t)
+        shape = np.where(t < 0.5, (1 + 0.2906 * z) / (z + 0.1882 * z**2 + 0.0442 * z**3), \
+                         (0.36067 * z - 0.59567 * z**2 + 0.25361 * z**3) / (1 - 2.78861 * z + 2.56096 * z**2 - 0.77045 * z**3))
+        scale = l1 / shape
+
+    params = np.array([zero, shape, scale], dtype=np.float32)
+    params[:, (n < 3) | ~(l2 > 0)] = np.nan
+
+    return params # gamma_fit
+
+#****************************************
+def gamma_cdf(params, values):
+    '''
+    Probabilities of the values from gamma_fit parameters
+
+    :param array params: (3, point)
+    :param array values: values to convert (time, point)
+
+    :returns: array (time, point)
+    '''
+
+    zero, shape, scale = params
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return zero + (1 - zero) * special.gammainc(shape, np.maximum(values, 0) / scale) # gamma_cdf
+
+#****************************************
+def loglogistic_fit(sample):
+    '''
+    (Generalised) log-logistic distribution fitted to the sample (as SPEI::spei,
+    Hosking's generalised logistic)
+
+    :param array sample: values to fit (sample, point), NaN where missing
+
+    :returns: array (3, point) of location, scale and shape (NaN where no fit)
+    '''
+
+    l1, l2, l3, n = lmoments(sample)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        k = -l3 / l2
+        kpi = np.where(k == 0, 1, k * np.pi)
+        alpha = np.where(k == 0, l2, l2 * np.sin(kpi) / kpi)
+        xi = np.where(k == 0, l1, l1 - alpha * (1. / np.where(k == 0, 1, k) - np.pi / np.sin(kpi)))
+
+    params = np.array([xi, alpha, k], dtype=np.float32)
+    params[:, (n < 3) | ~(l2 > 0)] = np.nan
+
+    return params # loglogistic_fit
+
+#****************************************
+def loglogistic_cdf(params, values):
+    '''
+    Probabilities of the values from loglogistic_fit parameters
+
+    :param array params: (3, point)
+    :param array values: values to convert (time, point)
+
+    :returns: array (time, point)
+    '''
+
+    xi, alpha, k = params
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        y = (values - xi) / alpha
+        inside = 1 - k * y
+        y = np.where(k == 0, y, -np.log(np.where(inside > 0, inside, 1)) / np.where(k == 0, 1, k))
+        prob = 1. / (1 + np.exp(-y))
+
+        # beyond the bounds of the distribution
+        prob = np.where(inside > 0, prob, np.where(k > 0, 1, 0))
+
+    return np.where(np.isnan(values) | np.isnan(k), np.nan, prob) # loglogistic_cdf
+
+#****************************************
+def fit(totals, years, months, distribution, start = utils.base_period_start, end = utils.base_period_end):
+    '''
+    Distribution for each calendar month, fitted to the base period
+
+    :param array totals: accumulated values (month, latitude, longitude), from accumulate
+    :param array years: year of each month
+    :param array months: month of each month
+    :param str distribution: "gamma" (SPI) or "loglogistic" (SPEI)
+    :param int start: first year of base period
+    :param int end: last year of base period
+
+    :returns: array (calendar month, parameter, latitude, longitude)
+    '''
+
+    flat = totals.reshape(totals.shape[0], -1)
+    in_base = (years >= start) & (years <= end)
+    fitter = gamma_fit if distribution == "gamma" else loglogistic_fit
+
+    params = np.array([fitter(flat[(months == month) & in_base]) for month in range(1, 13)])
+
+    return params.reshape((12, 3) + totals.shape[1:]) # fit
+
+#****************************************
+def standardised(monthly, years, months, scale, distribution, params = None, start = utils.base_period_start, end = utils.base_period_end):
+    '''
+    SPI or SPEI for each month
+
+    :param array monthly: monthly precipitation or water balance (month, latitude, longitude),
+                          consecutive months, NaN where missing
+    :param array years: year of each month
+    :param array months: month of each month
+    :param int scale: number of months accumulated over
+    :param str distribution: "gamma" (SPI) or "loglogistic" (SPEI)
+    :param array params: from fit, calculated here if not given
+    :param int start: first year of base period
+    :param int end: last year of base period
+
+    :returns: array (month, latitude, longitude)
+    '''
+
+    totals = accumulate(monthly, scale)
+    if params is None:
+        params = fit(totals, years, months, distribution, start = start, end = end)
+
+    totals = totals.reshape(totals.shape[0], -1)
+    params = params.reshape(12, 3, -1)
+    result = np.full(totals.shape, np.nan, dtype=np.float32)
+
+    cdf = gamma_cdf if distribution == "gamma" else loglogistic_cdf
+
+    for month in range(1, 13):
+        this_month = months == month
+        prob = cdf(params[month - 1], totals[this_month])
+        result[this_month] = special.ndtri(np.clip(prob, PROB_LIMIT, 1 - PROB_LIMIT))
+
+    return result.reshape(monthly.shape) # standardised
+
+#*******************************************
+# END
+#*******************************************
@@ -3,140 +3,182 @@
 """
 Post calculate extra ETCCDI indices which aren't done automatically by Climpact (ETR, R95pTOT, R99pTOT)
 
+The derived indices are declared in registry.DERIVED as expressions over other
+final indices, and made in order of their dependencies, with those which don't
+depend on each other made together.  The final files of the inputs are read a
+block (of times and a band of latitudes) at a time, so memory stays the same
+however long the record, each input is read once however many indices use it,
+and each block is written to both the full and land-only outputs, with the land
+version masked by the shared land-sea mask rather than read from the _land files.
+
 Run as::
 
-  python extra_indices.py --index ETR
+  python extra_indices.py --index ETR ... [--lsm_year YYYY] [--profile NAME] [--workers N]
 
---index     ETCCDI indices to calculate (ETR, R95pTOT, R99pTOT)
+--index     Derived indices to calculate, or "all" for all in the registry
+--lsm_year  Year to take the land-sea mask from, if land_mask.py hasn't stored it
+--profile   Storage profile (chunking, compression) for the output files (utils.STORAGE_PROFILES)
+--workers   Indices to calculate at once [as many as CPUs allow]
 """
 
 #*******************************************
 # START
 #*******************************************
-import os
-import glob
-import calendar
 import numpy as np
+import concurrent.futures
 
-import iris
-import iris.coord_categorisation
 import netCDF4 as ncdf
 
 import utils
+import catalog
+import land_mask
+import registry
+import rechunk_dailies
+import calculate_indices
 
 #****************************************
-def get_cubelists(name1, name2, land=False):
-    """
-    Read in the two cube lists required for calculations
-
-    :param str name1: first name
-    :param str name2: second name
-    :param bool land: load on landmasked files
-
-    :returns: cubelist1, cubelist2
-    """
+def blocks(shape, lats, narrays, memory = utils.DERIVED_MEMORY_MB):
+    '''
+    Blocks of (time, latitude) to read at once: bands of a tile's latitudes (as
+    the merged files are chunked), and as many times as fit in the memory
 
-    if land:
-        path = os.path.join(utils.DATALOC, "final", "ERA5_{}_{}-{}_land.nc".format(name1, utils.STARTYEAR, utils.ENDYEAR))
-    else:
-        path = os.path.join(utils.DATALOC, "final", "ERA5_{}_{}-{}.nc".format(name1, utils.STARTYEAR, utils.ENDYEAR))
-    print(path)
-    cubelist1 = iris.load(path)
+    :param tuple shape: (time, latitude, longitude) of the variables
+    :param array lats: latitudes
+    :param int narrays: number of arrays of the block's size held at once
+    :param int memory: memory (MB) to use
 
-    if land:
-        path = os.path.join(utils.DATALOC, "final", "ERA5_{}_{}-{}_land.nc".format(name2, utils.STARTYEAR, utils.ENDYEAR))
-    else:
-        path = os.path.join(utils.DATALOC, "final", "ERA5_{}_{}-{}.nc".format(name2, utils.STARTYEAR, utils.ENDYEAR))
-        
-    print(path)
-    cubelist2 = iris.load(path)
+    :returns: list of (time slice, latitude slice)
+    '''
 
-    return cubelist1, cubelist2 # get_cubelists
+    ntimes, nlats, nlons = shape
+    rows = min(nlats, rechunk_dailies.tile_points(lats, utils.DELTALAT))
+    steps = max(1, int(memory * 1024**2 // (4 * narrays * rows * nlons)))
 
+    return [(slice(t, min(t + steps, ntimes)), slice(l, min(l + rows, nlats))) \
+            for l in range(0, nlats, rows) for t in range(0, ntimes, steps)] # blocks
 
 #****************************************
-def RXXpTOT(index="R95pTOT", land=False):
-    """
-    Calculates the R95pTOT/R99pTOT from R95p/R99p and PRCPTOT
-
-    :param str index: which of R95pTOT or R99pTOT to calulate
-    :param bool land: load on landmasked files
-    """
-
-    descriptor = {"R95pTOT" : "very", "R99pTOT" : "extremely"}
-
-    if index == "R95pTOT":
-        rXXp, prcptot = get_cubelists("R95p", "PRCPTOT", land=land)
-
-    elif index == "R99pTOT":
-        rXXp, prcptot = get_cubelists("R99p", "PRCPTOT", land=land)
-
-    rXXp_names = [c.var_name for c in rXXp]
-    prcptot_names = [c.var_name for c in prcptot]
-
-    rxxptot_list = []
-    for name in rXXp_names:
-
-        rxxptot_cube = 100 * rXXp[rXXp_names.index(name)] / prcptot[prcptot_names.index(name)]
-        rxxptot_cube.name = "Contribution from {} wet days".format(descriptor[index])
-        rxxptot_cube.var_name = name
-
-        rxxptot_list += [rxxptot_cube]
-
-    if land:
-        iris.save(rxxptot_list, os.path.join(utils.DATALOC, "final", "ERA5_{}_{}-{}_land.nc".format(index, utils.STARTYEAR, utils.ENDYEAR)), fill_value=utils.MDI, zlib=True)
-    else:
-        iris.save(rxxptot_list, os.path.join(utils.DATALOC, "final", "ERA5_{}_{}-{}.nc".format(index, utils.STARTYEAR, utils.ENDYEAR)), fill_value=utils.MDI, zlib=True)
+def read_block(variable, time_slice, lat_slice):
+    '''
+    Read a block of a final file variable, with missing values as NaN
 
-    return # RXXpTOT
+    :returns: array
+    '''
 
+    return np.ma.filled(np.ma.asarray(variable[time_slice, lat_slice]).astype(np.float32), np.nan) # read_block
 
 #****************************************
-def etr(land=False):
-    """
-    Calculates the ETR
-
-    :param bool land: load on landmasked files
-    """
-
-    txx, tnn = get_cubelists("TXx", "TNn", land=land)
-
-    txx_names = [c.var_name for c in txx]
-    tnn_names = [c.var_name for c in tnn]
-
-    etr_list = []
-    for name in txx_names:
-
-        etr_cube = txx[txx_names.index(name)]-tnn[tnn_names.index(name)]
-        etr_cube.name = "Extreme Temperature Range"
-        etr_cube.var_name = name
-
-        etr_list += [etr_cube]
-    
-    if land:
-        iris.save(etr_list, os.path.join(utils.DATALOC, "final", "ERA5_ETR_{}-{}_land.nc".format(utils.STARTYEAR, utils.ENDYEAR)), fill_value=utils.MDI, zlib=True)
-    else:
-        iris.save(etr_list, os.path.join(utils.DATALOC, "final", "ERA5_ETR_{}-{}.nc".format(utils.STARTYEAR, utils.ENDYEAR)), fill_value=utils.MDI, zlib=True)
-    
-
-    return # etr
+def evaluate(indices, lsm_year = "2020", profile = utils.STORAGE_PROFILE, workers = None):
+    '''
+    Make a generation of independent derived indices (registry.DERIVED).  Each input
+    is read once, a block at a time, for all the indices which use it, and the indices
+    are calculated from each block in parallel threads.  The full and land-only files
+    are written from the one read.
+
+    :param list indices: derived indices, whose inputs have all been made
+    :param str lsm_year: year to take the land-sea mask from, if it hasn't been stored
+    :param str profile: storage profile for the output files
+    :param int workers: indices to calculate at once (default, as many as CPUs allow)
+    '''
 
+    land = land_mask.load(lsm_year)
+
+    names = sorted(set([name for index in indices for name in registry.DERIVED[index][0]]))
+    inputs = {name : ncdf.Dataset(utils.final_filename(name), "r") for name in names}
+    for ncfile in inputs.values():
+        print(ncfile.filepath())
+
+    first = inputs[names[0]]
+    lats = first.variables["latitude"][:]
+    lons = first.variables["longitude"][:]
+
+    # variables ("Ann", "Jan"...) of each index, for the periods all its inputs have
+    variables = {}
+    for index in indices:
+        files = [inputs[name] for name in registry.DERIVED[index][0]]
+        variables[index] = [name for name in ["Ann"] + calculate_indices.MONTHS if all([name in ncfile.variables for ncfile in files])]
+        if len(variables[index]) == 0:
+            raise Exception("{}: inputs {} have no variables in common".format(index, registry.DERIVED[index][0]))
+        for name in variables[index]:
+            if len(set([ncfile.variables[name].shape for ncfile in files])) > 1:
+                raise Exception("{}: inputs {} have different shapes for {}".format(index, registry.DERIVED[index][0], name))
+
+    outfiles = {}
+    for index in indices:
+        source = inputs[registry.DERIVED[index][0][0]]
+        template = source.variables[variables[index][0]]
+        time = source.variables[template.dimensions[0]]
+        units = registry.DERIVED[index][2] if registry.DERIVED[index][2] is not None else template.units
+
+        # same layout as the inputs
+        chunking = template.chunking()
+        chunks = None if chunking == "contiguous" else chunking[1:]
+
+        times = {name : source.variables[source.variables[name].dimensions[0]][:] for name in variables[index]}
+        for variable in ["all", "land"]:
+            outfiles[(index, variable)] = calculate_indices.create_final_file(utils.final_filename(index, land = variable == "land"), index, \
+                                                                              times, lats, lons, time.units, getattr(time, "calendar", "standard"), \
+                                                                              units, registry.DERIVED[index][3], profile = profile, chunks = chunks)
+
+    if workers is None:
+        workers = utils.n_workers(len(indices))
+
+    def calculate(index, block):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.ma.masked_invalid(registry.DERIVED[index][1](block))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for name in ["Ann"] + calculate_indices.MONTHS:
+            # indices with this variable, grouped by its shape (the length of record of their inputs)
+            groups = {}
+            for index in [index for index in indices if name in variables[index]]:
+                groups.setdefault(inputs[registry.DERIVED[index][0][0]].variables[name].shape, []).append(index)
+
+            for shape, group in groups.items():
+                needed = sorted(set([n for index in group for n in registry.DERIVED[index][0]]))
+                print("{}: {} from {}".format(name, group, needed))
+
+                for time_slice, lat_slice in blocks(shape, lats, len(needed) + 2 * len(group)):
+                    # netCDF reads and writes in this thread, the calculations in the pool
+                    block = {n : read_block(inputs[n].variables[name], time_slice, lat_slice) for n in needed}
+                    results = pool.map(calculate, group, [block] * len(group))
+
+                    for index, result in zip(group, results):
+                        outfiles[(index, "all")].variables[name][time_slice, lat_slice] = result
+                        outfiles[(index, "land")].variables[name][time_slice, lat_slice] = \
+                            np.ma.array(result, mask=np.ma.getmaskarray(result) | ~land[lat_slice])
+
+    for ncfile in inputs.values():
+        ncfile.close()
+    for (index, variable), outfile in outfiles.items():
+        filename = outfile.filepath()
+        outfile.close()
+        catalog.record("final", filename, index_name=index, variable=variable)
+
+    return # evaluate
 
 #****************************************
-def main(index):
+def main(indices, lsm_year = "2020", profile = utils.STORAGE_PROFILE, workers = None):
     '''
-    Calls correct routine for specified index
+    Make the derived indices, and any derived indices they depend on, a generation
+    of independent indices at a time
 
-    :param str index: which index to run (ETR/R95pTOT/R99pTOT)
+    :param list indices: derived indices, or ["all"] for all in registry.DERIVED
+    :param str lsm_year: year to take the land-sea mask from, if it hasn't been stored
+    :param str profile: storage profile for the output files
+    :param int workers: indices to calculate at once (default, as many as CPUs allow)
     '''
 
-    if index == "ETR":
-        etr()
-        etr(land=True)
+    if indices == ["all"]:
+        indices = list(registry.DERIVED.keys())
+
+    for index in [index for index in indices if index not in registry.DERIVED]:
+        print("no calculation necessary for {}".format(index))
+    indices = [index for index in indices if index in registry.DERIVED]
 
-    elif index in ["R95pTOT", "R99pTOT"]:
-        RXXpTOT(index)
-        RXXpTOT(index, land=True)
+    for generation in registry.resolve(indices):
+        print("calculating {}".format(generation))
+        evaluate(generation, lsm_year = lsm_year, profile = profile, workers = workers)
 
     return # main
 
@@ -148,18 +190,19 @@ if __name__ == "__main__":
 
     # set up keyword arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('--index', dest='index', action='store', default="TX90p", 
-                        help='etccdi index')
+    parser.add_argument('--index', dest='index', action='store', nargs='+', default=["ETR"],
+                        help='derived indices, or "all" [ETR]')
+    parser.add_argument('--lsm_year', dest='lsm_year', action='store', default="2020",
+                        help='Year to find file with LSM information (YYYY01_hourly.nc)')
+    parser.add_argument('--profile', dest='profile', action='store', default=utils.STORAGE_PROFILE, choices=list(utils.STORAGE_PROFILES.keys()),
+                        help='Storage profile for output files [{}]'.format(utils.STORAGE_PROFILE))
+    parser.add_argument('--workers', dest='workers', action='store', default=None, type=int,
+                        help='indices to calculate at once [as many as CPUs allow]')
 
     args = parser.parse_args()
 
-    if args.index in ["R95pTOT", "R99pTOT", "ETR"]:
-
-        main(args.index)
+    main(args.index, lsm_year=args.lsm_year, profile=args.profile, workers=args.workers)
 
-    else:
-        print("no calculation necessary")
-         
 #*******************************************
 # END
 #*******************************************
@@ -2,13 +2,18 @@
 """
 Get the ERA 5 data, using the CDSAPI from ECMWF to download automatically.
 
-Spins through each month of each year to get hourly data for T and P
+Spins through each month of each year to get hourly data for T and P, and
+converts these straight to daily values (see convert_era5.make_dailies)
 
 Run as::
 
-  python get_era5.py --start YEAR --end YEAR [--remove]
+  python get_era5.py --start YEAR --end YEAR [--remove] [--hourlies] [--workers N] [--profile NAME]
 
---remove    Remove the hourly T and P files once made a combined file for the month
+--remove    Remove the hourly T and P files once made the daily file for the month
+--hourlies  Also write the combined T and P hourly file for the month (slow, ~6GB)
+--workers   Number of CDS requests in flight at once.  Failed downloads are retried
+              with backoff, and the queue is saved to DATALOC/download_queue.json
+--profile   Storage profile (chunking, compression) for the output files (utils.STORAGE_PROFILES)
 
 Butchered from:
 http://fcm1.metoffice.com/projects/utils/browser/CM_ML/trunk/NAO_Precip_Regr/get_era5_uwind.py
@@ -24,37 +29,98 @@ import iris
 import numpy as np
 import sys
 import time
+import json
+import queue
+import threading
+import zlib
+import netCDF4 as ncdf
 
 import utils
+import catalog
+import convert_era5
 
 sys.path.append('/data/users/rdunn/reanalyses/code/era5/cdsapi-0.1.4')
-import cdsapi
+try:
+    import cdsapi
+except ImportError:
+    # only needed for downloads, not for combining files already downloaded
+    cdsapi = None
+
+RAW_NAMES = {"2m_temperature" : "t2m", "total_precipitation" : "tp"}
+
+#****************************************
+def file_checksum(filename, blocksize=2**24):
+    '''
+    Adler-32 checksum of a file, read in blocks
+    '''
+
+    checksum = 1
+    with open(filename, "rb") as infile:
+        for block in iter(lambda: infile.read(blocksize), b""):
+            checksum = zlib.adler32(block, checksum)
+
+    return "{:08x}".format(checksum) # file_checksum
 
 #****************************************
 def check_success(year, month, variable):
     '''
-    Check that this cube has been downloaded successfully
+    Check that this file has been downloaded successfully
+
+    Files already verified in the catalog are checked with a single stat.  Otherwise
+    only the time axis and the final hour are read, to check the length is right for
+    the month and that the last field is not a single value, and the file is then
+    recorded in the catalog with its size and checksum.
     '''
 
-    if not os.path.exists(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable))):
+    filename = os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable))
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
         return False
 
-    cubelist = iris.load(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable)))
+    for entry in catalog.lookup("raw", path=filename):
+        if entry["checksum"] is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+
+    try:
+        with ncdf.Dataset(filename, "r") as ncfile:
+            variable_data = ncfile.variables[RAW_NAMES[variable]]
+            nhours = len(ncfile.dimensions["time"])
+
+            expected = calendar.monthrange(year, month)[1] * 24
+            if nhours != expected and not (year == 1979 and variable == "total_precipitation" and nhours < expected):
+                # precipitation on start year has quirks (missing time stamps), otherwise should be all hours
+                print("{} has {} hours, expected {}".format(filename, nhours, expected))
+                return False
 
-    cube = cubelist[0]
+            shape = variable_data.shape
+            last_hour = convert_era5.read_hours(variable_data, nhours-1, nhours)
 
-    if len(np.unique(cube.data[-1,:,:])) == 1:
+    except (OSError, KeyError, IndexError) as err:
+        print("{} unreadable: {}".format(filename, err))
+        return False
+
+    if len(np.unique(last_hour[np.isfinite(last_hour)])) <= 1:
         # single value for all the final hour of the data, download likely to be unsuccessful
         return False
-    else:
-        return True # check_success
+
+    catalog.record("raw", filename, year=int(year), month=int(month), variable=variable, shape=shape, checksum=file_checksum(filename))
+
+    return True # check_success
 
 #****************************************
-def retrieve(year, month, variable, ndays):
+def retrieve(year, month, variable, ndays, client=None):
     '''
     Use ECMWF API to get the data
 
     4.5GB per month --> 55GB per year, 50mins per month of processing
+
+    :param int year: year
+    :param int month: month
+    :param str variable: 2m_temperature or total_precipitation
+    :param int ndays: number of days in the month
+    :param obj client: CDS API client to reuse (new one made if None)
     '''
 
     if variable == "2m_temperature":
@@ -67,15 +133,15 @@ def retrieve(year, month, variable, ndays):
     
     days = ["{:2d}".format(d+1) for d in range(ndays)]
 
-    c = cdsapi.Client()
-
+    if client is None:
+        client = cdsapi.Client()
 
     if year <= 1978:
         retrieval_name = 'reanalysis-era5-single-levels-preliminary-back-extension'
     else:
         retrieval_name = 'reanalysis-era5-single-levels'
 
-    c.retrieve(
+    client.retrieve(
         'reanalysis-era5-single-levels',
         {
             'product_type':'reanalysis',
@@ -100,15 +166,10 @@ def retrieve(year, month, variable, ndays):
 
     time.sleep(5) # to allow any writing process to finish up.
 
-    # make a "success" file
-    with open(os.path.join(utils.DATALOC, "{}{:02d}_hourly_{}_success.txt".format(year, month, variable)), "w") as outfile:
-        
-        outfile.write("Success {}".format(dt.datetime.now()))
-
     return # retreive
 
 #****************************************
-def combine(year, month, remove=False):
+def combine(year, month, remove=False, profile=utils.STORAGE_PROFILE):
     """
     Now need to merge files for T and P
       Overlap of delayed and 5-day ERA5 - hence can given as tp_0001 and tp_0005 fields
@@ -118,6 +179,9 @@ def combine(year, month, remove=False):
       https://confluence.ecmwf.int/display/CUSF/ERA5+CDS+requests+which+return+a+mixture+of+ERA5+and+ERA5T+data
     
     Though won't be for most fields
+
+    Only needed if the combined hourly file is wanted, as convert_era5.make_dailies
+    does the same merging on the fly when reading the raw files.
     """
 
     # aim to add the precipitation cube to the temperature one.  Read both in
@@ -196,19 +260,171 @@ def combine(year, month, remove=False):
     cubelist += [tp_cube]
 
     # and write out (6GB so takes a while!)
-    iris.save(cubelist, os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(year, month)), zlib=True)
+    iris.save(cubelist, os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(year, month)), \
+              **utils.storage_options(tp_cube.shape, profile, for_iris = True))
 
-    # make success file 
-    with open(os.path.join(utils.DATALOC, "{}{:02d}_success.txt".format(year, month)), "w") as outfile:
-                outfile.write("Success {}".format(dt.datetime.now()))
+    catalog.record("hourly", os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(year, month)), year=int(year), month=int(month), shape=tp_cube.shape)
 
     # remove input files
     if remove:
         for variable in ["2m_temperature", "total_precipitation"]:
-            os.remove(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable)))
+            catalog.remove(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable)))
 
     return # combine
     
+#****************************************
+class DownloadScheduler:
+    '''
+    Queue of monthly downloads run by a pool of worker threads, so that several
+    requests are in flight with the CDS at once.
+
+    Each worker keeps a single CDS client for all its requests.  Failed downloads
+    are put back on the queue with an exponential backoff, up to a maximum number
+    of attempts.  The state of the queue is saved after every change, so an
+    interrupted run picks up where it stopped.
+
+    :param str state_file: JSON file to hold the queue state
+    :param int nworkers: number of requests in flight at once
+    :param int max_attempts: give up on a download after this many attempts
+    :param float backoff: wait (s) before the first retry, doubling each time
+    :param float max_backoff: longest wait (s) between retries
+    :param obj client_factory: callable returning a CDS API client (or a fake, as benchmark_pipeline.FakeClient)
+    '''
+    def __init__(self, state_file, nworkers=utils.DOWNLOAD_WORKERS, max_attempts=utils.DOWNLOAD_MAX_ATTEMPTS, \
+                 backoff=utils.DOWNLOAD_BACKOFF, max_backoff=utils.DOWNLOAD_MAX_BACKOFF, client_factory=None):
+        self.state_file = state_file
+        self.nworkers = nworkers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.client_factory = client_factory if client_factory is not None else cdsapi.Client
+
+        self.lock = threading.Lock()
+        self.jobs = queue.PriorityQueue()
+        self.finished = queue.Queue()
+        self.threads = []
+        self.outstanding = 0
+
+        self.state = {}
+        if os.path.exists(state_file):
+            with open(state_file, "r") as infile:
+                self.state = json.load(infile)
+
+    @staticmethod
+    def key(year, month, variable):
+        return "{}{:02d}_{}".format(year, month, variable)
+
+    def _save(self):
+        # write then rename, so an interruption never leaves a partial file
+        with open(self.state_file + ".tmp", "w") as outfile:
+            json.dump(self.state, outfile, indent=1, sort_keys=True)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def add(self, year, month, variable):
+        '''Queue a download, resuming any attempts recorded from a previous run'''
+        key = self.key(year, month, variable)
+        with self.lock:
+            job = self.state.get(key, {"year" : int(year), "month" : int(month), "variable" : variable, "attempts" : 0})
+            if job.get("status") == "failed":
+                # a fresh run gets a fresh set of attempts
+                job["attempts"] = 0
+            job["status"] = "pending"
+            self.state[key] = job
+            self._save()
+            self.outstanding += 1
+        self.jobs.put((time.time(), key))
+
+    def start(self):
+        '''Start the worker threads'''
+        for w in range(self.nworkers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self.threads += [thread]
+
+    def _worker(self):
+        client = None
+        while True:
+            not_before, key = self.jobs.get()
+            if key is None:
+                return
+
+            wait = not_before - time.time()
+            if wait > 0:
+                # still backing off, put back and look again shortly
+                self.jobs.put((not_before, key))
+                time.sleep(min(wait, 1.))
+                continue
+
+            job = self.state[key]
+            ndays = calendar.monthrange(job["year"], job["month"])[1]
+            print("{} - {} - {} downloading (attempt {})".format(job["year"], job["month"], job["variable"], job["attempts"] + 1))
+
+            try:
+                if client is None:
+                    client = self.client_factory()
+                retrieve(job["year"], job["month"], job["variable"], ndays, client=client)
+                success = check_success(job["year"], job["month"], job["variable"])
+            except Exception as err:
+                print("{} failed: {}".format(key, err))
+                # start again with a new client in case the old one is the problem
+                client = None
+                success = False
+
+            with self.lock:
+                job["attempts"] += 1
+                if success:
+                    job["status"] = "done"
+                elif job["attempts"] >= self.max_attempts:
+                    job["status"] = "failed"
+                else:
+                    delay = min(self.backoff * 2**(job["attempts"] - 1), self.max_backoff)
+                    print("{} retry in {}s".format(key, delay))
+                    self.jobs.put((time.time() + delay, key))
+                self._save()
+
+            if job["status"] != "pending":
+                self.finished.put((job["year"], job["month"], job["variable"], job["status"]))
+
+    def results(self):
+        '''
+        Yield (year, month, variable, status) as each download finishes (done or failed),
+        stopping the workers once the queue is empty
+        '''
+        while self.outstanding > 0:
+            yield self.finished.get()
+            self.outstanding -= 1
+
+        for thread in self.threads:
+            self.jobs.put((float("inf"), None))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+#****************************************
+def convert(year, month, remove=False, hourlies=False, profile=utils.STORAGE_PROFILE):
+    '''
+    Make the daily file for a month once both variables are downloaded
+
+    :param int year: year
+    :param int month: month
+    :param bool remove: remove the raw files once done
+    :param bool hourlies: also write the combined hourly file
+    :param str profile: storage profile for the output files
+    '''
+
+    try:
+        if hourlies:
+            combine(year, month, remove = remove, profile = profile)
+            convert_era5.make_dailies(year, month, profile = profile)
+        else:
+            # straight from raw to daily, without the combined hourly file
+            convert_era5.make_dailies(year, month, remove = remove, profile = profile)
+    except OSError as err:
+        # inputs are kept, so the month is converted again on the next run
+        print("{} - {} conversion failed: {}".format(year, month, err))
+
+    return # convert
+
 #****************************************
 if __name__ == "__main__":
 
@@ -222,55 +438,72 @@ if __name__ == "__main__":
                         help='End year [2019]')
     parser.add_argument('--remove', dest='remove', action='store_true', default=False,
                         help='Remove hourly and monthly files, default = False')
+    parser.add_argument('--hourlies', dest='hourlies', action='store_true', default=False,
+                        help='Write combined hourly files, default = False')
+    parser.add_argument('--workers', dest='workers', action='store', default=utils.DOWNLOAD_WORKERS, type=int,
+                        help='Number of downloads in flight at once [{}]'.format(utils.DOWNLOAD_WORKERS))
+    parser.add_argument('--profile', dest='profile', action='store', default=utils.STORAGE_PROFILE, choices=list(utils.STORAGE_PROFILES.keys()),
+                        help='Storage profile for output files [{}]'.format(utils.STORAGE_PROFILE))
  
     args = parser.parse_args()         
 
+    scheduler = DownloadScheduler(os.path.join(utils.DATALOC, "download_queue.json"), nworkers = args.workers)
+
+    # variables still to download for each month to convert
+    to_convert = {}
+
     for year in np.arange(args.start, args.end+1):
 
-        if os.path.exists(os.path.join(utils.DATALOC, "dailies", "{}_daily.nc".format(year))):
+        if catalog.is_done("daily", year=int(year), month=None, window="00UTC"):
             print("{} - already downloaded and processed".format(year))
         else:
             for month in np.arange(1, 13):
 
                 print("{} - {}".format(year, month))
-                # get number of days
-                ndays = calendar.monthrange(year, month)[1]
                 
                 if dt.datetime.now() > dt.datetime(year, month, 1):
 
-                    if not os.path.exists(os.path.join(utils.DATALOC, "{}{:02d}_success.txt".format(year, month))):
+                    if not catalog.is_done("daily", year=int(year), month=int(month), window="00UTC"):
 
+                        to_convert[(year, month)] = set()
                         for variable in ["2m_temperature", "total_precipitation"]:
 
                             # if file doesn't exist then retrieve
-                            if not os.path.exists(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable))):
-                                while not check_success(year, month, variable):
-                                    retrieve(year, month, variable, ndays)
-
-                            else:
-                                # check if success file exists.
-                                if not os.path.exists(os.path.join(utils.DATALOC, "{}{:02d}_hourly_{}_success.txt".format(year, month, variable))):
-
-                                    if os.path.exists(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable))):
-                                        if args.remove:
-                                            os.remove(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable)))
-                                            while not check_success(year, month, variable):
-                                                retrieve(year, month, variable, ndays)
-                                        else:
-                                            print("{} - {} - {} already downloaded".format(year, month, variable))                                              
-                                    else:
-                                        print("{} - {} - {} already downloaded".format(year, month, variable))    
-                                else:
-                                    print("{} - {} - {} already downloaded".format(year, month, variable))    
+                            if not catalog.is_done("raw", year=int(year), month=int(month), variable=variable):
+                                scheduler.add(year, month, variable)
+                                to_convert[(year, month)].add(variable)
 
+                            # check existing file is complete (one stat if already verified)
+                            elif not check_success(year, month, variable):
+                                catalog.remove(os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_{}.nc".format(year, month, variable)))
+                                scheduler.add(year, month, variable)
+                                to_convert[(year, month)].add(variable)
 
-                        combine(year, month, remove = args.remove)
+                            else:
+                                print("{} - {} - {} already downloaded".format(year, month, variable))    
 
                     else:
                         print("{} - {} already downloaded".format(year, month))    
                         
                 else:
                     print("{} - {} in future - not getting data".format(year, month))
+
+    scheduler.start()
+
+    # months with everything already downloaded
+    for (year, month), variables in sorted(to_convert.items()):
+        if len(variables) == 0:
+            convert(year, month, remove = args.remove, hourlies = args.hourlies, profile = args.profile)
+
+    # and the rest as their downloads complete
+    for year, month, variable, status in scheduler.results():
+        if status == "done":
+            to_convert[(year, month)].discard(variable)
+            if len(to_convert[(year, month)]) == 0:
+                convert(year, month, remove = args.remove, hourlies = args.hourlies, profile = args.profile)
+        else:
+            print("{} - {} - {} failed after {} attempts".format(year, month, variable, scheduler.max_attempts))
+
 #*******************************************
 # END
 #*******************************************
@@ -0,0 +1,161 @@
+#!/bin/env python
+"""
+Land-sea mask shared by all the stages
+
+The ERA5 land-sea fraction is read once, thresholded at utils.LAND_FRACTION_THRESH,
+and kept as a small 2-D byte array (latitude north to south, as the tiles and
+final files) in DATALOC.  The stages load this rather than going back to the
+hourly files, so these can be removed - convert_era5.py --remove stores the mask
+before deleting the first month.  As the ERA5 land-sea mask does not change with
+time, it is made from whichever year is available first, and only made again if
+the threshold changes.
+
+Run as::
+
+  python land_mask.py [--lsm_year YYYY]
+
+--lsm_year  Year to take the land-sea fraction from
+"""
+
+#*******************************************
+# START
+#*******************************************
+import os
+import functools
+import numpy as np
+import netCDF4 as ncdf
+
+import utils
+import catalog
+
+MASK_FILE = os.path.join(utils.DATALOC, "era5_land_mask.nc")
+
+#****************************************
+def read_fraction(ncfile):
+    '''
+    Land fraction at the first time in an open hourly file
+
+    :param obj ncfile: netCDF4 Dataset with an "lsm" variable (time, [expver,] latitude, longitude)
+
+    :returns: array (latitude, longitude), north to south, NaN where missing
+    '''
+
+    variable = ncfile.variables["lsm"]
+    field = np.ma.asarray(variable[0]).astype(np.float32)
+
+    if "expver" in variable.dimensions:
+        # ERA5 and ERA5T, only one of which is present
+        field = field.max(axis=0)
+
+    fraction = np.ma.filled(field, np.nan)
+    if ncfile.variables["latitude"][0] < ncfile.variables["latitude"][-1]:
+        fraction = fraction[::-1]
+
+    return fraction # read_fraction
+
+#****************************************
+def write(ncfile, source):
+    '''
+    Threshold the land fraction in an open hourly file and store the mask
+
+    :param obj ncfile: netCDF4 Dataset with an "lsm" variable
+    :param str source: name of the file, for the attributes
+    '''
+
+    fraction = read_fraction(ncfile)
+    lats = ncfile.variables["latitude"][:]
+    if lats[0] < lats[-1]:
+        lats = lats[::-1]
+    lons = ncfile.variables["longitude"][:]
+
+    with np.errstate(invalid="ignore"):
+        land = fraction >= utils.LAND_FRACTION_THRESH
+
+    with ncdf.Dataset(MASK_FILE, "w") as outfile:
+        outfile.createDimension("latitude", len(lats))
+        outfile.createDimension("longitude", len(lons))
+
+        for name, values, units in [("latitude", lats, "degrees_north"), ("longitude", lons, "degrees_east")]:
+            var = outfile.createVariable(name, "f4", (name,))
+            var[:] = values
+            var.units = units
+            var.standard_name = name
+
+        var = outfile.createVariable("land", "i1", ("latitude", "longitude"), zlib=True)
+        var[:] = land.astype(np.int8)
+        var.long_name = "Land (land fraction >= {})".format(utils.LAND_FRACTION_THRESH)
+        var.flag_values = np.array([0, 1], dtype=np.int8)
+        var.flag_meanings = "sea land"
+
+        outfile.threshold = utils.LAND_FRACTION_THRESH
+        outfile.source = source
+
+    catalog.record("mask", MASK_FILE, shape=land.shape, variable=str(utils.LAND_FRACTION_THRESH))
+
+    return # write
+
+#****************************************
+def make(lsm_year):
+    '''
+    Make the mask from the first hour of January of the given year
+    (from the raw download if the combined hourly file wasn't kept)
+
+    :param str lsm_year: year
+    '''
+
+    if catalog.is_done("hourly", year=int(lsm_year), month=1):
+        lsm_file = os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(lsm_year, 1))
+    else:
+        lsm_file = os.path.join(utils.DATALOC, "raw", "{}{:02d}_hourly_2m_temperature.nc".format(lsm_year, 1))
+
+    with ncdf.Dataset(lsm_file, "r") as ncfile:
+        write(ncfile, os.path.basename(lsm_file))
+
+    return # make
+
+#****************************************
+def is_current():
+    '''
+    Has the mask been made, with the current threshold?
+
+    :returns: bool
+    '''
+
+    return catalog.is_done("mask", path=MASK_FILE, variable=str(utils.LAND_FRACTION_THRESH)) # is_current
+
+#****************************************
+@functools.lru_cache()
+def load(lsm_year = "2020"):
+    '''
+    Boolean land mask, made first if needed.  Read once per process.
+
+    :param str lsm_year: year to make the mask from, if it hasn't been made
+
+    :returns: array (latitude, longitude), north to south
+    '''
+
+    if not is_current():
+        make(lsm_year)
+
+    with ncdf.Dataset(MASK_FILE, "r") as ncfile:
+        land = np.ma.filled(ncfile.variables["land"][:], 0).astype(bool)
+
+    return land # load
+
+#****************************************
+if __name__ == "__main__":
+
+    import argparse
+
+    # set up keyword arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lsm_year', dest='lsm_year', action='store', default="2020",
+                        help='Year to find file with LSM information (YYYY01_hourly.nc)')
+
+    args = parser.parse_args()
+
+    make(args.lsm_year)
+
+#*******************************************
+# END
+#*******************************************
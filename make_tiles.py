@@ -2,28 +2,37 @@
 """
 Split up the annual files of daily data into tiles of daily values over the whole record
 
+All the tiles in a batch are written in one pass, reading each annual file once.
+If the tile-major store has been made (rechunk_dailies.py) tiles are read from
+that instead of from every annual file.
+
+With --append, the annual file for utils.ENDYEAR is added to the end of the
+existing tile files instead.
+
 Run as::
 
-  python make_files.py --batch N --total M
+  python make_files.py --batch N --total M [--profile NAME] [--append]
 
 --batch    ID of the tile 
 --total    Total number of tiles
+--profile  Storage profile (compression) for the tile files (utils.STORAGE_PROFILES)
+--append   Add utils.ENDYEAR to the existing tiles
 """
 
 #*******************************************
 # START
 #*******************************************
 import os
-import fnmatch
-import datetime
 import numpy as np
 
-import iris
-import iris.coord_categorisation
-import cf_units
 import netCDF4 as ncdf
 
 import utils
+import catalog
+import rechunk_dailies
+
+# the variables Climpact uses (daily files also hold Tmean and max hourly P)
+VARIABLES = ["tx2m", "tn2m", "tp"]
 
 #****************************************
 def find_files():
@@ -31,112 +40,225 @@ def find_files():
     Find all the files which should be part of the cube
     '''
 
-    files = []
-    for filename in os.listdir(os.path.join(utils.DATALOC, "dailies")):
-        if fnmatch.fnmatch(filename, '????_daily.nc'):
-            files += [os.path.join(utils.DATALOC, "dailies", filename)]
+    files = [row["path"] for row in catalog.lookup("daily", month=None, window="00UTC")]
 
     return files # find_files
 
 #****************************************
-def latConstraint(lats):
-    return iris.Constraint(latitude = lambda cell: lats[0] <= cell < lats[1])
+def create_tile_file(filename, source, lat_slice, lon_slice, times, bounds, reverse = False, profile = utils.STORAGE_PROFILE):
+    '''
+    Set up the file for a tile over the whole record, with the missing data
+    attributes set at creation so no second pass is needed, and an unlimited
+    time axis so that later years can be appended
+
+    :param str filename: tile file
+    :param obj source: open netCDF4 Dataset of daily values to take coordinates and attributes from
+    :param slice lat_slice: latitudes of the tile in the source
+    :param slice lon_slice: longitudes of the tile in the source
+    :param array times: time points of the whole record
+    :param array bounds: time bounds of the whole record
+    :param bool reverse: flip latitudes (store runs south to north, tiles north to south)
+    :param str profile: storage profile (chunks are always about a year)
+
+    :returns: open netCDF4 Dataset
+    '''
 
-#****************************************
-def lonConstraint(lons):
-    return iris.Constraint(longitude = lambda cell: lons[0] <= cell < lons[1])
+    lats = source.variables["latitude"][lat_slice]
+    if reverse:
+        lats = lats[::-1]
+    lons = source.variables["longitude"][lon_slice]
+
+    outfile = ncdf.Dataset(filename, "w")
+    outfile.Conventions = "CF-1.5"
+
+    outfile.createDimension("time", None)
+    outfile.createDimension("latitude", len(lats))
+    outfile.createDimension("longitude", len(lons))
+    outfile.createDimension("bnds", 2)
+
+    time = outfile.createVariable("time", "f8", ("time",))
+    for attr in source.variables["time"].ncattrs():
+        time.setncattr(attr, source.variables["time"].getncattr(attr))
+    time[:] = times
+    outfile.createVariable("time_bnds", "f8", ("time", "bnds"))[:] = bounds
+
+    for name, values in [("latitude", lats), ("longitude", lons)]:
+        coord = outfile.createVariable(name, "f4", (name,))
+        for attr in source.variables[name].ncattrs():
+            if attr != "_FillValue":
+                coord.setncattr(attr, source.variables[name].getncattr(attr))
+        coord[:] = values
+
+    # about a year per chunk, to match the year-by-year writes
+    shape = (len(times), len(lats), len(lons))
+    for name in VARIABLES:
+        var = outfile.createVariable(name, "f4", ("time", "latitude", "longitude"), fill_value=utils.MDI, \
+                                     **utils.storage_options(shape, profile, chunks = (366, len(lats), len(lons))))
+        for attr in source.variables[name].ncattrs():
+            if attr not in ["_FillValue", "missing_value"]:
+                var.setncattr(attr, source.variables[name].getncattr(attr))
+        var.missing_value = np.float32(utils.MDI)
+
+    # fix units for Climpact
+    outfile.variables["tp"].units = "kg m-2 d-1"
+
+    return outfile # create_tile_file
 
 #****************************************
-def main(tile_ids):
+def main(tile_ids, profile = utils.STORAGE_PROFILE):
     '''
-    Spin through Latitudes and Longitudes to extract tiles for Climpact
+    Write all the tiles in the batch in a single pass through the daily data.
+
+    Every tile file is opened once, then each annual file (or the tile-major store)
+    is read once, as the hyperslab covering the batch, and scattered into the tile
+    files.
+
+    :param list tile_ids: tiles in this batch
+    :param str profile: storage profile for the tile files
     '''
         
     if not os.path.exists(os.path.join(utils.DATALOC, "tiles")):
         os.mkdir(os.path.join(utils.DATALOC, "tiles"))
 
+    # in case they have already been processed
+    tiles = []
+    for tile in range(tile_ids[0], tile_ids[-1]+1):
+        if catalog.is_done("tile", tile=int(tile)):
+            print("tile {} already processed".format(tile))
+        else:
+            tiles += [tile]
+    if len(tiles) == 0:
+        return
+
+    # use the tile-major store if it has been made (rechunk_dailies.py), as each
+    #   tile is then a single contiguous read, else the annual files
+    from_store = rechunk_dailies.store_is_current()
+    if from_store:
+        files = [rechunk_dailies.STORE]
+    else:
+        files = find_files()
+
+    first = ncdf.Dataset(files[0], "r")
+    calendar = getattr(first.variables["time"], "calendar", "standard")
+    times, bounds = rechunk_dailies.read_times(files, first.variables["time"].units, calendar)
+
+    # slices for every tile, from the coordinates (the same for all files)
+    tile_table = utils.tile_index(first.variables["latitude"][:], first.variables["longitude"][:])
+
+    outfiles = {tile : create_tile_file(os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile)), first, \
+                                        tile_table[tile][0], tile_table[tile][1], times, bounds, reverse = from_store, profile = profile) for tile in tiles}
+    first.close()
+
+    if from_store:
+        # chunks are whole tiles, so read each in turn
+        regions = [[tile] for tile in tiles]
+    else:
+        # one read of the box covering the batch
+        regions = [tiles]
+
+    offset = 0
+    for filename in files:
+        print(filename)
+        infile = ncdf.Dataset(filename, "r")
+        ntimes = len(infile.dimensions["time"])
+
+        for region in regions:
+            lat_rows = slice(min([tile_table[tile][0].start for tile in region]), max([tile_table[tile][0].stop for tile in region]))
+            lon_cols = slice(min([tile_table[tile][1].start for tile in region]), max([tile_table[tile][1].stop for tile in region]))
+
+            for name in VARIABLES:
+                block = infile.variables[name][:, lat_rows, lon_cols]
+
+                for tile in region:
+                    lat_slice, lon_slice = tile_table[tile]
+                    data = block[:, lat_slice.start - lat_rows.start : lat_slice.stop - lat_rows.start, \
+                                 lon_slice.start - lon_cols.start : lon_slice.stop - lon_cols.start]
+                    if from_store:
+                        # store runs south to north, tiles north to south as before
+                        data = data[:, ::-1]
+
+                    # masked values are written as the fill value (MDI)
+                    outfiles[tile].variables[name][offset : offset + ntimes] = data
+
+                del block
+
+        infile.close()
+        offset += ntimes
+
+    for tile, outfile in outfiles.items():
+        shape = outfile.variables["tx2m"].shape
+        outfile.close()
+
+        catalog.record("tile", os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile)), tile=int(tile), shape=shape)
+        print("tile {} done".format(tile))
 
-    files = find_files()
-
-    cubelist = iris.load(files)
-    
-    # ensure these are standardised
-    for cube in cubelist:
-        cube.attributes["Conventions"] = "CF-1.5"
-
-    new_list = cubelist.concatenate()
-
-    # have to use a counter method to assign lats/lons to tile numbers
-    tile = 1
-    for t, lat in enumerate(utils.box_edge_lats):
-        if t == 0: continue
-        for n, lon in enumerate(utils.box_edge_lons):
-            if n == 0: continue
-
-            # if tile not selected in this batch
-            if tile < tile_ids[0] or tile > tile_ids[-1]:
-                pass
-            else:
-                print("lat {}, lon {}".format(t, n))
-
-                # in case it has already been processed
-                if os.path.exists(os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile))):
-                    print("    already processed")
-
-                else:
-                    # coordinate constraints
-                    lat_constraint = latConstraint([utils.box_edge_lats[t-1], lat])
-                    lon_constraint = lonConstraint([utils.box_edge_lons[n-1], lon])
-
-                    tile_list = []
-                    # apply to all variables
-                    for cube in new_list:
-                        print(cube.var_name)
-
-                        tile_cube = cube.extract(lat_constraint)
-                        tile_cube = tile_cube.extract(lon_constraint)
-
-                        # fix units for Climpact
-                        if tile_cube.var_name == "tp":
-                            tile_cube.units = cf_units.Unit("kg m-2 d-1")
-                        # fix missing data in lots of ways
-
-                        try:
-                            if tile_cube.data.mask == False:
-                                tile_cube.data.mask = np.zeros(tile_cube.shape)
-                            elif tile_cube.data.mask == False:
-                                tile_cube.data.mask = np.ones(tile_cube.shape)
-                        except ValueError:
-                            # have a proper array
-                            pass
-
-                        tile_cube.data[tile_cube.data.mask == True] = utils.MDI
-
-                        tile_cube.data.fill_value = utils.MDI
-                        tile_cube._FillValue = utils.MDI
-                        tile_cube.missing_value = utils.MDI
-
-                        tile_list += [tile_cube]
-
-                    # save file
-#                    print("era_tile_{}.nc".format(tile))
-#                    input("stop")
-                    iris.save(tile_list, os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile)), fill_value=utils.MDI, zlib=True)
-
-                    # use ncdf library to force setting of keywords
-                    ncfile = ncdf.Dataset(os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile)), 'r+')
-
-                    for var in ["tx2m", "tn2m", "tp"]:
-
-                        ncfile.variables[var].missing_value = utils.MDI
-                        ncfile.variables[var].fill_value = utils.MDI
+    return # main
 
-                    ncfile.close()
+#****************************************
+def append_year(tile_ids, year = utils.ENDYEAR):
+    '''
+    Add a year of daily data to the end of the existing tile files, reading the
+    annual file once as the hyperslab covering the batch
 
-                    print("       done")
-            tile += 1
+    :param list tile_ids: tiles in this batch
+    :param int year: year to add
+    '''
 
-    return # main
+    rows = catalog.lookup("daily", year=int(year), month=None, window="00UTC")
+    if len(rows) == 0:
+        print("no daily file for {}".format(year))
+        return
+
+    infile = ncdf.Dataset(rows[0]["path"], "r")
+    tile_table = utils.tile_index(infile.variables["latitude"][:], infile.variables["longitude"][:])
+
+    tiles = []
+    for tile in range(tile_ids[0], tile_ids[-1]+1):
+        if catalog.is_done("tile", tile=int(tile)):
+            tiles += [tile]
+        else:
+            print("tile {} not made yet".format(tile))
+    if len(tiles) == 0:
+        infile.close()
+        return
+
+    lat_rows = slice(min([tile_table[tile][0].start for tile in tiles]), max([tile_table[tile][0].stop for tile in tiles]))
+    lon_cols = slice(min([tile_table[tile][1].start for tile in tiles]), max([tile_table[tile][1].stop for tile in tiles]))
+    blocks = {name : infile.variables[name][:, lat_rows, lon_cols] for name in VARIABLES}
+
+    for tile in tiles:
+        filename = os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile))
+        outfile = ncdf.Dataset(filename, "a")
+        time = outfile.variables["time"]
+        calendar = getattr(time, "calendar", "standard")
+
+        if not outfile.dimensions["time"].isunlimited():
+            outfile.close()
+            raise RuntimeError("{} has a fixed time axis, remake the tiles".format(filename))
+        if ncdf.num2date(time[-1], time.units, calendar=calendar).year >= year:
+            print("tile {} already has {}".format(tile, year))
+            outfile.close()
+            continue
+
+        times, bounds = rechunk_dailies.read_times([rows[0]["path"]], time.units, calendar)
+        start = len(time)
+        time[start : start + len(times)] = times
+        outfile.variables["time_bnds"][start : start + len(times)] = bounds
+
+        lat_slice, lon_slice = tile_table[tile]
+        for name in VARIABLES:
+            outfile.variables[name][start : start + len(times)] = blocks[name][:, lat_slice.start - lat_rows.start : lat_slice.stop - lat_rows.start, \
+                                                                             lon_slice.start - lon_cols.start : lon_slice.stop - lon_cols.start]
+
+        shape = outfile.variables["tx2m"].shape
+        outfile.close()
+
+        catalog.record("tile", filename, tile=int(tile), shape=shape)
+        print("tile {} extended to {}".format(tile, year))
+
+    infile.close()
+
+    return # append_year
 
 #****************************************
 if __name__ == "__main__":
@@ -149,6 +271,10 @@ if __name__ == "__main__":
                         help='batch number')
     parser.add_argument('--total', dest='total', action='store', default=100, type=int,
                         help='total number of batches')
+    parser.add_argument('--profile', dest='profile', action='store', default=utils.STORAGE_PROFILE, choices=list(utils.STORAGE_PROFILES.keys()),
+                        help='Storage profile for output files [{}]'.format(utils.STORAGE_PROFILE))
+    parser.add_argument('--append', dest='append', action='store_true', default=False,
+                        help='Add utils.ENDYEAR to the existing tiles')
 
     args = parser.parse_args()
 
@@ -162,7 +288,10 @@ if __name__ == "__main__":
 
     print("Batch {} of {}".format(args.batch, args.total))
     try:
-        main(tiles_to_run[args.batch])
+        if args.append:
+            append_year(tiles_to_run[args.batch])
+        else:
+            main(tiles_to_run[args.batch], profile = args.profile)
     except IndexError:
         # account for rounding and imperfect division
         pass
@@ -1,144 +1,287 @@
 #!/bin/env python
 """
-Merge the individual tiles together for a given ETCCDI index
+Merge the individual tiles together for the ETCCDI indices
+
+Several indices can be merged in one run, sharing the search for the tile
+files, the coordinates and the land-sea mask, with as many indices merged at
+once as the CPUs and memory allow.
+
+The final files are made for the whole grid first, then each tile's values are
+written into its place, so only one tile is held in memory at a time.  Merges
+can be run while Climpact is still running, and filled in by later runs as the
+remaining tiles finish.
 
 Run as::
 
-  python merge_tiles.py --index TX90p
+  python merge_tiles.py --index TX90p TXx ... [--lsm_year YYYY] [--profile NAME] [--workers N]
 
---index     ETCCDI index to process
+--index     ETCCDI indices to process, or "all" for all those with tile output
+--lsm_year  Year of the file to take the land-sea mask from, if land_mask.py hasn't stored it
+--profile   Storage profile (chunking, compression) for the output files (utils.STORAGE_PROFILES)
+--workers   Indices to merge at once [as many as CPUs and memory allow]
 """
 
 #*******************************************
 # START
 #*******************************************
 import os
-import glob
-import calendar
 import numpy as np
+import concurrent.futures
 
-import iris
-from iris.util import equalise_attributes
-import iris.coord_categorisation
 import netCDF4 as ncdf
 
 import utils
+import catalog
+import land_mask
+import registry
+import rechunk_dailies
+import calculate_indices
 
 #****************************************
-def merge_cubes(index, timescale):
+def find_files():
     '''
-    Find all the files which should be part of the cube and merge into a single list
+    Find the tile files of every index, with a single look in the catalog
+
+    :returns: dictionary of (lower case index, timescale) : list of (tile, file)
     '''
 
-    files = []
-    print("finding files")
-    path = os.path.join(utils.DATALOC, "indices", "{}_{}_climpact.era5_historical_*_{}-{}.nc".format(index.lower(), timescale.upper(), utils.base_period_start, utils.base_period_end))
-    print(path)
-    files = glob.glob(path)
-    
-    print("loading {} files".format(len(files)))
-
-    if len(files) > 0:
-        cubelist = iris.load(files)
-        equalise_attributes(cubelist)
-        
-        # and merge the cubes
-        merged_cubes = cubelist.concatenate()
-        
-        assert len(merged_cubes) == 1
-
-        return merged_cubes[0]
-    else:
-        return np.array([]) # merge_cubes
+    files = {}
+    for row in catalog.lookup("indices"):
+        files.setdefault((row["index_name"], row["timescale"].lower()), []).append((row["tile"], row["path"]))
+
+    return files # find_files
 
 #****************************************
-def remove_coords(cube, monthly = True):
+def read_grid():
     '''
-    Remove time bounds and added Auxillary coordinate of months
+    Coordinates of the whole grid, from the first annual file of daily values
+
+    :returns: latitudes (north to south, as the tiles), longitudes
     '''
 
-    cube.coord("time").bounds = None
+    rows = catalog.lookup("daily", month=None, window="00UTC")
+    with ncdf.Dataset(rows[0]["path"], "r") as ncfile:
+        lats = ncfile.variables["latitude"][:]
+        lons = ncfile.variables["longitude"][:]
 
-    if monthly:
-        cube.remove_coord("month") 
+    if lats[0] < lats[-1]:
+        lats = lats[::-1]
 
-    return cube # remove_coords
+    return lats, lons # read_grid
 
 #****************************************
-def main(index, lsm_year):
+def read_tile(filename):
     '''
-    Combine cubes for annual and monthly into single output file.
+    Index values from a Climpact output file for a tile
+
+    :param str filename: file
+
+    :returns: values (time, latitude, longitude) with latitudes north to south, dates,
+              dictionary of "units", "long_name", "calendar"
     '''
 
-    if not os.path.exists(os.path.join(utils.DATALOC, "final")):
-        os.mkdir(os.path.join(utils.DATALOC, "final"))
+    with ncdf.Dataset(filename, "r") as ncfile:
+        var = [ncfile.variables[v] for v in ncfile.variables if ncfile.variables[v].ndim == 3][0]
+        time = ncfile.variables[var.dimensions[0]]
+        lats = ncfile.variables[var.dimensions[1]][:]
+
+        values = var[:]
+        if lats[0] < lats[-1]:
+            values = values[:, ::-1]
 
+        calendar = getattr(time, "calendar", "standard")
+        dates = ncdf.num2date(time[:], time.units, calendar=calendar)
+        attributes = {"units" : getattr(var, "units", ""), "long_name" : getattr(var, "long_name", var.name), "calendar" : calendar}
 
-    # get annual cube
-    annual_cube = merge_cubes(index, "ann")
-    # if no files
+    return values, dates, attributes # read_tile
 
-    if annual_cube.shape[0] == 0:
+#****************************************
+def month_slices(dates):
+    '''
+    Where each calendar month lies along a monthly time axis.  On a regular axis
+    (consecutive months, none missing) these are strides of 12, so the values for
+    each month are views of the tile rather than copies.
 
-        if "spei" in index.lower() or "spi" in index.lower():
-            # these don't have annual versions
-            pass
-        else:            
-            print("No files found")
-            return
+    :param list dates: dates of the monthly values
 
-    if "spei" in index.lower() or "spi" in index.lower():
-        final_cubelist = []
-    else:
-        annual_cube.var_name = "Ann"
-        annual_cube = remove_coords(annual_cube, monthly = False)
-        annual_cube.data.fill_value = utils.MDI
-        annual_cube.missing_value = utils.MDI
-        annual_cube._FillValue = utils.MDI
-   
-        final_cubelist = [annual_cube]
-
-    if index in ["TN10p", "TN90p", "TX10p", "TX90p", "TNn", "TNx", "TXn", "TXx", "DTR", "Rx1day", "Rx5day", \
-                 "TMm", "TXm", "TNm", "TXge35", "TXge30", "TMlt10", "TMge10", "TMlt5", "TMge5", "TXgt50p", \
-                 "TNlt2", "TNltm2", "TNltm20", "Rx3day", "3month_SPEI", "6month_SPEI", "12month_SPEI", \
-                 "3month_SPI", "6month_SPI", "12month_SPI"]:
-        # get monthly cube
-        monthly_cube = merge_cubes(index, "mon")
-
-        # now process cube into months
-        iris.coord_categorisation.add_month(monthly_cube, 'time', name='month')
-
-        # extract each month
-        for m in calendar.month_abbr:
-            if m == "":
+    :returns: list of 12 indexers (slices, or boolean arrays if the axis is irregular), January first
+    '''
+
+    count = np.array([12 * d.year + d.month - 1 for d in dates])
+
+    if np.all(np.diff(count) == 1):
+        return [slice((m - count[0]) % 12, None, 12) for m in range(12)]
+
+    print("irregular monthly time axis, selecting each month")
+    months = count % 12
+    return [months == m for m in range(12)] # month_slices
+
+#****************************************
+def open_outputs(index, files, lats, lons, profile = utils.STORAGE_PROFILE):
+    '''
+    Set up the full and land-only final files for the whole grid, with the time axes
+    and attributes of the first tile, or reopen them to carry on with a partial merge
+
+    :param str index: ETCCDI index
+    :param dict files: timescale : list of (tile, file)
+    :param array lats: latitudes of the whole grid
+    :param array lons: longitudes of the whole grid
+    :param str profile: storage profile for the output files
+
+    :returns: dictionary of "all", "land" : open netCDF4 Dataset, set of tiles already merged
+    '''
+
+    if len(catalog.lookup("final", status="partial", index_name=index, variable="all")) > 0:
+        outfiles = {"all" : ncdf.Dataset(utils.final_filename(index), "a"), \
+                    "land" : ncdf.Dataset(utils.final_filename(index, land = True), "a")}
+        merged = set([int(tile) for tile in outfiles["all"].merged_tiles.split()])
+        return outfiles, merged
+
+    units = None
+    variables = {}
+    for timescale, tiles in files.items():
+        values, dates, attributes = read_tile(tiles[0][1])
+        if units is None:
+            units = "days since {}-01-01 00:00:00".format(dates[0].year)
+        times = ncdf.date2num(dates, units, calendar=attributes["calendar"])
+
+        if timescale == "ann":
+            variables["Ann"] = times
+        else:
+            for month, where in zip(calculate_indices.MONTHS, month_slices(dates)):
+                variables[month] = times[where]
+
+    # one chunk per tile, as written
+    chunks = (rechunk_dailies.tile_points(lats, utils.DELTALAT), rechunk_dailies.tile_points(lons, utils.DELTALON))
+
+    outfiles = {}
+    for variable in ["all", "land"]:
+        outfiles[variable] = calculate_indices.create_final_file(utils.final_filename(index, land = variable == "land"), index, \
+                                                                 variables, lats, lons, units, attributes["calendar"], attributes["units"], \
+                                                                 attributes["long_name"], profile = profile, chunks = chunks)
+        outfiles[variable].merged_tiles = ""
+
+    return outfiles, set() # open_outputs
+
+#****************************************
+def merge_index(index, files, lats, lons, land, profile = utils.STORAGE_PROFILE):
+    '''
+    Write each tile's annual and monthly values into its place in the full and
+    land-only final files, a tile at a time.  Tiles not yet run are left missing,
+    and filled on a later run; a tile only counts as merged once all the periods
+    of the index (registry.timescales) have been written for it.
+
+    :param str index: ETCCDI index
+    :param dict files: (lower case index, timescale) : list of (tile, file), from find_files
+    :param array lats: latitudes of the whole grid
+    :param array lons: longitudes of the whole grid
+    :param array land: boolean land mask (latitude, longitude), from land_mask.load
+    :param str profile: storage profile for the output files
+    '''
+
+    timescales = {timescale : files.get((index.lower(), timescale), []) for timescale in registry.timescales(index)}
+
+    # the final files have variables for every period, so need a tile of each to set them up
+    missing = [timescale for timescale, tiles in timescales.items() if len(tiles) == 0]
+    if len(missing) > 0:
+        print("{}: no {} files found".format(index, " or ".join(missing)))
+        return
+
+    outfiles, merged = open_outputs(index, timescales, lats, lons, profile = profile)
+    tile_table = utils.tile_index(lats, lons)
+
+    written = {timescale : set() for timescale in timescales}
+    for timescale, tiles in timescales.items():
+        print("{} {}: {} tiles".format(index, timescale, len(tiles)))
+        for tile, filename in tiles:
+            if tile in merged:
                 continue
+            lat_slice, lon_slice = tile_table[tile]
+
+            values, dates, attributes = read_tile(filename)
+
+            # sea masked by broadcasting the 2-D mask over time, once for the whole tile
+            by_output = {"all" : values, \
+                         "land" : np.ma.array(values, mask=np.ma.getmaskarray(values) | ~land[lat_slice, lon_slice])}
+
+            if timescale == "ann":
+                by_variable = [("Ann", slice(None))]
             else:
-                print(m)
-                monthConstraint = iris.Constraint(month=m)
+                by_variable = list(zip(calculate_indices.MONTHS, month_slices(dates)))
+
+            # all the variables written from views of the one tile read
+            for name, where in by_variable:
+                for variable, data in by_output.items():
+                    outfiles[variable].variables[name][:, lat_slice, lon_slice] = data[where]
+
+            written[timescale].add(tile)
 
-                month_cube = monthly_cube.extract(monthConstraint)
-                month_cube.var_name = m
-                month_cube = remove_coords(month_cube)               
-                
-                month_cube.data.fill_value = utils.MDI
-                month_cube.missing_value = utils.MDI
-                month_cube._FillValue = utils.MDI
+    merged |= set.intersection(*written.values())
+    complete = set(tile_table.keys()) <= merged
+    for variable, outfile in outfiles.items():
+        outfile.merged_tiles = " ".join([str(tile) for tile in sorted(merged)])
+        filename = outfile.filepath()
+        outfile.close()
+        catalog.record("final", filename, status="done" if complete else "partial", index_name=index, variable=variable)
 
-                final_cubelist += [month_cube]
+    print("{} {}".format(index, "done" if complete else "{} of {} tiles".format(len(merged), len(tile_table))))
 
-    # and save the list
-    iris.save(final_cubelist, os.path.join(utils.DATALOC, "final", "ERA5_{}_{}-{}.nc".format(index, utils.STARTYEAR, utils.ENDYEAR)), fill_value=utils.MDI, zlib=True)
+    return # merge_index
 
-    # apply land_sea mask
-    lsm_cube = iris.load_cube(os.path.join(utils.DATALOC, "hourlies", "{}{:02d}_hourly.nc".format(lsm_year, 1)), "land_binary_mask")
+#****************************************
+def main(indices, lsm_year, profile = utils.STORAGE_PROFILE, workers = None, memory = utils.MERGE_MEMORY_MB):
+    '''
+    Merge the tiles of several indices.  The tile files are found, and the coordinates
+    and land-sea mask read, once, then the indices are merged in parallel processes.
+
+    :param list indices: ETCCDI indices, or ["all"] for all with tile output
+    :param str lsm_year: year of the file to take the land-sea mask from
+    :param str profile: storage profile for the output files
+    :param int workers: indices to merge at once (default, as many as CPUs and memory allow)
+    :param int memory: memory (MB) needed to merge each index
+    '''
 
-    for cube in final_cubelist:
-        lsm_data = lsm_cube.data[:cube.shape[0]]
-        cube.data[lsm_data < utils.LAND_FRACTION_THRESH] = utils.MDI
-        cube.data = np.ma.masked_where(lsm_data < utils.LAND_FRACTION_THRESH, cube.data)
-        cube.data.fill_value = utils.MDI
+    if not os.path.exists(os.path.join(utils.DATALOC, "final")):
+        os.mkdir(os.path.join(utils.DATALOC, "final"))
 
-    iris.save(final_cubelist, os.path.join(utils.DATALOC, "final", "ERA5_{}_{}-{}_land.nc".format(index, utils.STARTYEAR, utils.ENDYEAR)), fill_value=utils.MDI, zlib=True)
+    print("finding files")
+    files = find_files()
+
+    if indices == ["all"]:
+        names = {name.lower() : name for name in registry.MERGED}
+        indices = sorted(set([names.get(index, index) for index, timescale in files]))
+
+    for index in [index for index in indices if index in registry.DERIVED]:
+        print("merging not required for {}".format(index))
+    indices = [index for index in indices if index not in registry.DERIVED]
+
+    lats, lons = read_grid()
+    land = land_mask.load(lsm_year)
+
+    if workers is None:
+        workers = utils.n_workers(len(indices), memory = memory)
+    print("merging {} indices, {} at once".format(len(indices), workers))
+
+    failures = []
+    if workers == 1:
+        for index in indices:
+            try:
+                merge_index(index, files, lats, lons, land, profile = profile)
+            except Exception as err:
+                print("{}: {}".format(index, err))
+                failures += [index]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = {pool.submit(merge_index, index, files, lats, lons, land, profile = profile) : index for index in indices}
+            for job in concurrent.futures.as_completed(jobs):
+                try:
+                    job.result()
+                except Exception as err:
+                    print("{}: {}".format(jobs[job], err))
+                    failures += [jobs[job]]
+
+    if len(failures) > 0:
+        raise Exception("Merging failed for {}".format(sorted(failures)))
 
     return # main
 
@@ -150,18 +293,19 @@ if __name__ == "__main__":
 
     # set up keyword arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('--index', dest='index', action='store', default="TX90p", 
-                        help='etccdi index')
-    parser.add_argument('--lsm_year', dest='lsm_year', action='store', default="2020", 
+    parser.add_argument('--index', dest='index', action='store', nargs='+', default=["TX90p"],
+                        help='etccdi indices, or "all" [TX90p]')
+    parser.add_argument('--lsm_year', dest='lsm_year', action='store', default="2020",
                         help='Year to find file with LSM information (YYYY01_hourly.nc)')
+    parser.add_argument('--profile', dest='profile', action='store', default=utils.STORAGE_PROFILE, choices=list(utils.STORAGE_PROFILES.keys()),
+                        help='Storage profile for output files [{}]'.format(utils.STORAGE_PROFILE))
+    parser.add_argument('--workers', dest='workers', action='store', default=None, type=int,
+                        help='indices to merge at once [as many as CPUs and memory allow]')
 
     args = parser.parse_args()
 
-    if args.index in ["ETR", "R99pTOT", "R95pTOT"]:
-        print("merging not required for {}".format(args.index))
-    else:
-        main(args.index, args.lsm_year)
-         
+    main(args.index, args.lsm_year, profile = args.profile, workers = args.workers)
+
 #*******************************************
 # END
 #*******************************************
@@ -0,0 +1,348 @@
+#!/bin/env python
+"""
+Array kernels for the percentile based indices (TX90p, TN10p, R95p etc)
+
+Thresholds are calendar day percentiles over the base period, from a 5-day
+window centred on each day, using the same quantile estimator as climdex
+(type 8).  Within the base period exceedances are found with the bootstrap of
+Zhang et al. (2005): for each base year, the thresholds are recalculated with
+that year replaced by each of the other base years in turn, and the results
+averaged.
+
+Everything is done for a block of grid points at once.  For each year left out,
+the remaining years' window values are sorted once, and each replacement year is
+then merged in by order statistics rather than re-sorting the sample.
+
+Leap days are not part of the 365-day calendar of thresholds, and are compared
+against the threshold for 28th February.
+
+Thresholds can be passed in (e.g. stored from an earlier run), so that years
+outside the base period can be done without the base period data.
+"""
+
+#*******************************************
+# START
+#*******************************************
+import numpy as np
+
+import utils
+
+WINDOW = 5
+
+# first day of each month in a 365-day calendar
+MONTH_STARTS = np.cumsum([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+
+#****************************************
+def calendar_days(months, days):
+    '''
+    Day of a 365-day calendar (0-364) for each date, -1 for 29th February
+
+    :param array months: month of each date
+    :param array days: day of month of each date
+
+    :returns: array
+    '''
+
+    months, days = np.asarray(months), np.asarray(days)
+
+    cal = MONTH_STARTS[months - 1] + days - 1
+    cal[(months == 2) & (days == 29)] = -1
+
+    return cal # calendar_days
+
+#****************************************
+def quantile(sorted_values, n, prob):
+    '''
+    Type 8 quantile (as climdex) of samples sorted along axis 1, with missing values
+    (as +inf) at the end
+
+    :param array sorted_values: (day, sample, point)
+    :param array n: number of valid values (day, point)
+    :param float prob: probability
+
+    :returns: array (day, point)
+    '''
+
+    lower, upper, frac = quantile_ranks(n, prob)
+
+    xlower = np.take_along_axis(sorted_values, (lower - 1)[:, None, :], axis=1)[:, 0]
+    xupper = np.take_along_axis(sorted_values, (upper - 1)[:, None, :], axis=1)[:, 0]
+
+    return interpolate(xlower, xupper, frac, n) # quantile
+
+#****************************************
+def quantile_ranks(n, prob):
+    '''
+    Ranks (1-based) either side of the type 8 quantile, and the fraction between them
+
+    :param array n: number of valid values
+    :param float prob: probability
+
+    :returns: lower rank, upper rank, fraction
+    '''
+
+    h = (n + 1./3.) * prob + 1./3.
+    rank = np.floor(h).astype(int)
+    frac = h - rank
+
+    # beyond the ends of the sample take the end value
+    frac[(rank < 1) | (rank >= n)] = 0
+    lower = np.clip(rank, 1, np.maximum(n, 1))
+    upper = np.clip(rank + 1, 1, np.maximum(n, 1))
+
+    return lower, upper, frac # quantile_ranks
+
+#****************************************
+def interpolate(xlower, xupper, frac, n):
+    '''Value between two order statistics, NaN with no valid values'''
+
+    with np.errstate(invalid="ignore"):
+        values = xlower + frac * (xupper - xlower)
+    values[n == 0] = np.nan
+
+    return values.astype(np.float32) # interpolate
+
+#****************************************
+def union_order_statistic(apad, b, rank):
+    '''
+    The rank-th smallest value of the union of two sorted samples, without sorting
+    the union: min over t of max(A_(rank-t), B_(t)), for the few values in B
+
+    :param array apad: sorted sample A (day, sample, point), padded with one -inf at the
+                       start and len(B)+1 +inf at the end
+    :param array b: sorted sample B (day, small sample, point)
+    :param array rank: 1-based rank for each day and point
+
+    :returns: array (day, point)
+    '''
+
+    best = np.full(rank.shape, np.inf, dtype=apad.dtype)
+    for t in range(b.shape[1] + 1):
+        a = np.take_along_axis(apad, np.clip(rank - t, 0, apad.shape[1] - 1)[:, None, :], axis=1)[:, 0]
+        if t > 0:
+            a = np.maximum(a, b[:, t-1])
+        best = np.minimum(best, a)
+
+    return best # union_order_statistic
+
+#****************************************
+def base_windows(data, years, cal, start = utils.base_period_start, end = utils.base_period_end):
+    '''
+    Values in the window around each calendar day of each base year (+inf where missing,
+    including outside the base period)
+
+    :param array data: daily values (time, point)
+    :param array years: year of each day
+    :param array cal: calendar day of each day (-1 for leap days)
+    :param int start: first year of base period
+    :param int end: last year of base period
+
+    :returns: array (year, calendar day, window, point)
+    '''
+
+    nyears = end - start + 1
+    half = WINDOW // 2
+
+    series = np.full((nyears * 365 + 2 * half, data.shape[1]), np.inf, dtype=np.float32)
+    use = (years >= start) & (years <= end) & (cal >= 0)
+    series[half + (years[use] - start) * 365 + cal[use]] = np.where(np.isnan(data[use]), np.inf, data[use])
+
+    centres = half + (np.arange(nyears) * 365)[:, None] + np.arange(365)[None, :]
+
+    return series[centres[:, :, None] + np.arange(-half, half + 1)[None, None, :]] # base_windows
+
+#****************************************
+def compare(values, thresholds, above):
+    '''Exceedance (1/0) of the thresholds, NaN where either is missing'''
+
+    with np.errstate(invalid="ignore"):
+        if above:
+            exceeds = values > thresholds
+        else:
+            exceeds = values < thresholds
+
+    return np.where(np.isnan(values) | np.isnan(thresholds), np.nan, exceeds).astype(np.float32) # compare
+
+#****************************************
+def base_thresholds(windows, prob):
+    '''
+    Calendar day thresholds from all the base period windows
+
+    :param array windows: (year, calendar day, window, point), from base_windows
+    :param float prob: percentile as a probability
+
+    :returns: array (calendar day, point)
+    '''
+
+    sample = np.sort(windows.transpose(1, 0, 2, 3).reshape(365, -1, windows.shape[3]), axis=1)
+
+    return quantile(sample, np.isfinite(sample).sum(axis=1), prob) # base_thresholds
+
+#****************************************
+def calendar_thresholds(data, years, cal, prob, start = utils.base_period_start, end = utils.base_period_end, \
+                        chunk = utils.PERCENTILE_CHUNK):
+    '''
+    Calendar day percentile thresholds from the whole base period
+
+    :param array data: daily values (time, latitude, longitude), NaN where missing
+    :param array years: year of each day
+    :param array cal: calendar day of each day (-1 for leap days)
+    :param float prob: percentile as a probability (e.g. 0.9)
+    :param int start: first year of base period
+    :param int end: last year of base period
+    :param int chunk: number of grid points to do at once
+
+    :returns: array (calendar day, latitude, longitude)
+    '''
+
+    flat = data.reshape(data.shape[0], -1)
+    thresholds = np.full((365, flat.shape[1]), np.nan, dtype=np.float32)
+
+    for first in range(0, flat.shape[1], chunk):
+        points = slice(first, min(first + chunk, flat.shape[1]))
+        thresholds[:, points] = base_thresholds(base_windows(flat[:, points], years, cal, start = start, end = end), prob)
+
+    return thresholds.reshape((365,) + data.shape[1:]) # calendar_thresholds
+
+#****************************************
+def threshold_exceedance(data, years, cal, prob, above, thresholds = None, start = utils.base_period_start, end = utils.base_period_end):
+    '''
+    Daily exceedance (1/0) of the calendar day percentile thresholds from the whole base
+    period, for all years (no bootstrap, as climdex for WSDI and CSDI)
+
+    :param array data: daily values (time, latitude, longitude), NaN where missing
+    :param array years: year of each day
+    :param array cal: calendar day of each day (-1 for leap days)
+    :param float prob: percentile as a probability (e.g. 0.9)
+    :param bool above: count days above (True) or below (False) the threshold
+    :param array thresholds: from calendar_thresholds, calculated here if not given
+    :param int start: first year of base period
+    :param int end: last year of base period
+
+    :returns: array (time, latitude, longitude)
+    '''
+
+    if thresholds is None:
+        thresholds = calendar_thresholds(data, years, cal, prob, start = start, end = end)
+
+    # leap days use the threshold for 28th February
+    day = np.where(cal < 0, MONTH_STARTS[2] - 1, cal)
+
+    return compare(data, thresholds[day], above) # threshold_exceedance
+
+#****************************************
+def exceedance(data, years, cal, prob, above, thresholds = None, start = utils.base_period_start, end = utils.base_period_end, \
+               chunk = utils.PERCENTILE_CHUNK):
+    '''
+    Daily exceedance of the calendar day percentile thresholds.  1/0 outside the base
+    period, and the bootstrap mean (fraction of the resampled thresholds exceeded) inside.
+    Summing over a period and dividing by the valid days gives TX90p etc.
+
+    :param array data: daily values (time, latitude, longitude), NaN where missing
+    :param array years: year of each day
+    :param array cal: calendar day of each day (-1 for leap days)
+    :param float prob: percentile as a probability (e.g. 0.9)
+    :param bool above: count days above (True) or below (False) the threshold
+    :param array thresholds: from calendar_thresholds, for the years outside the base period,
+                             calculated here if not given
+    :param int start: first year of base period
+    :param int end: last year of base period
+    :param int chunk: number of grid points to do at once
+
+    :returns: array (time, latitude, longitude)
+    '''
+
+    flat = data.reshape(data.shape[0], -1)
+
+    # leap days use the threshold for 28th February
+    day = np.where(cal < 0, MONTH_STARTS[2] - 1, cal)
+    in_base = (years >= start) & (years <= end)
+    base_years = np.arange(start, end + 1)
+    nyears = len(base_years)
+
+    # thresholds from the whole base period, for the years outside it
+    result = threshold_exceedance(data, years, cal, prob, above, thresholds = thresholds, start = start, end = end).reshape(flat.shape)
+    if not in_base.any():
+        return result.reshape(data.shape)
+
+    for first in range(0, flat.shape[1], chunk):
+        points = slice(first, min(first + chunk, flat.shape[1]))
+        values = flat[:, points]
+        npoints = values.shape[1]
+
+        windows = base_windows(values, years, cal, start = start, end = end)
+
+        # bootstrap for the years inside
+        by_year = np.sort(windows, axis=2)
+        for y, year in enumerate(base_years):
+            today = years == year
+            if not today.any():
+                continue
+
+            # the other years, sorted once for all the replacements
+            others = np.sort(np.delete(windows, y, axis=0).transpose(1, 0, 2, 3).reshape(365, (nyears - 1) * WINDOW, npoints), axis=1)
+            n_others = np.isfinite(others).sum(axis=1)
+            others = np.concatenate([np.full((365, 1, npoints), -np.inf, dtype=np.float32), others, \
+                                     np.full((365, WINDOW + 1, npoints), np.inf, dtype=np.float32)], axis=1)
+
+            total = np.zeros((today.sum(), npoints), dtype=np.float32)
+            for r in range(nyears):
+                if r == y:
+                    continue
+                # year y replaced by year r (so year r appears twice)
+                n = n_others + np.isfinite(by_year[r]).sum(axis=1)
+                lower, upper, frac = quantile_ranks(n, prob)
+                resampled = interpolate(union_order_statistic(others, by_year[r], lower), \
+                                        union_order_statistic(others, by_year[r], upper), frac, n)
+                total += compare(values[today], resampled[day[today]], above)
+
+            result[today, points] = total / (nyears - 1)
+
+    return result.reshape(data.shape) # exceedance
+
+#****************************************
+def wet_day_threshold(data, years, prob, start = utils.base_period_start, end = utils.base_period_end):
+    '''
+    Percentile of precipitation on wet days (>= 1mm) in the base period, for R95p/R99p
+
+    :param array data: daily precipitation (time, latitude, longitude), NaN where missing
+    :param array years: year of each day
+    :param float prob: percentile as a probability (e.g. 0.95)
+    :param int start: first year of base period
+    :param int end: last year of base period
+
+    :returns: array (latitude, longitude)
+    '''
+
+    base = data[(years >= start) & (years <= end)].reshape(-1, data.shape[1] * data.shape[2])
+
+    with np.errstate(invalid="ignore"):
+        sample = np.sort(np.where(base >= 1, base, np.inf), axis=0)[None]
+
+    return quantile(sample, np.isfinite(sample).sum(axis=1), prob).reshape(data.shape[1:]) # wet_day_threshold
+
+#****************************************
+def wet_day_excess(data, years, prob, threshold = None, start = utils.base_period_start, end = utils.base_period_end):
+    '''
+    Precipitation on days above the base period wet-day percentile, zero on other days,
+    NaN where missing.  Summed over a year this gives R95p/R99p.
+
+    :param array data: daily precipitation (time, latitude, longitude), NaN where missing
+    :param array years: year of each day
+    :param float prob: percentile as a probability (e.g. 0.95)
+    :param array threshold: from wet_day_threshold, calculated here if not given
+
+    :returns: array (time, latitude, longitude)
+    '''
+
+    if threshold is None:
+        threshold = wet_day_threshold(data, years, prob, start = start, end = end)
+
+    with np.errstate(invalid="ignore"):
+        excess = np.where(data > threshold, data, 0)
+
+    return np.where(np.isnan(data) | np.isnan(threshold), np.nan, excess).astype(np.float32) # wet_day_excess
+
+#*******************************************
+# END
+#*******************************************
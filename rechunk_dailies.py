@@ -0,0 +1,213 @@
+#!/bin/env python
+"""
+Rechunk the annual files of daily values into a single tile-major store
+
+The store holds the whole record, chunked as (full time axis, one tile of
+latitude, one tile of longitude), so that each tile is a single contiguous read
+for make_tiles rather than a read of every annual file.  Latitudes are stored
+south to north so that the chunks line up with the tile edges.  Only needs
+making once (and again when years are added).
+
+Run as::
+
+  python rechunk_dailies.py [--memory MB] [--profile NAME]
+
+--memory    Approximate memory to use (MB) when assembling blocks of tiles
+--profile   Storage profile (compression) for the store (chunks are always one tile)
+"""
+
+#*******************************************
+# START
+#*******************************************
+import os
+import numpy as np
+import netCDF4 as ncdf
+
+import utils
+import catalog
+
+STORE = os.path.join(utils.DATALOC, "dailies", "era5_daily_tiled.nc")
+
+#****************************************
+def store_is_current():
+    '''
+    Has the store been made, and does it still cover all the annual files (no years
+    appended since)?
+
+    :returns: bool
+    '''
+
+    stores = catalog.lookup("store", window="00UTC")
+    rows = catalog.lookup("daily", month=None, window="00UTC")
+    if len(stores) == 0 or len(rows) == 0:
+        return False
+
+    return stores[0]["time_end"] == max(rows, key=lambda row: row["year"])["time_end"] # store_is_current
+
+#****************************************
+def tile_points(coord, delta):
+    '''
+    Number of grid points in one tile along a coordinate
+
+    :param array coord: coordinate values (regular)
+    :param float delta: tile size in degrees
+
+    :returns: int
+    '''
+
+    return int(round(delta / np.abs(coord[1] - coord[0]))) # tile_points
+
+#****************************************
+def read_times(files, units, calendar):
+    '''
+    Time points and bounds from all the annual files, on a common set of units
+
+    :param list files: annual files of daily values, in time order
+    :param str units: time units to convert to
+    :param str calendar: calendar of the time axis
+
+    :returns: array of times, array of bounds
+    '''
+
+    times, bounds = [], []
+    for filename in files:
+        with ncdf.Dataset(filename, "r") as ncfile:
+            for values, store in [(ncfile.variables["time"][:], times), (ncfile.variables["time_bnds"][:], bounds)]:
+                dates = ncdf.num2date(values, ncfile.variables["time"].units, calendar=calendar)
+                store += [ncdf.date2num(dates, units, calendar=calendar)]
+
+    return np.concatenate(times), np.concatenate(bounds) # read_times
+
+#****************************************
+def create_store(filename, files, profile = utils.STORAGE_PROFILE):
+    '''
+    Set up the store with time from all the annual files and coordinates from the first
+
+    :param str filename: store file
+    :param list files: annual files of daily values, in time order
+    :param str profile: storage profile
+
+    :returns: open netCDF4 Dataset
+    '''
+
+    first = ncdf.Dataset(files[0], "r")
+    lats = first.variables["latitude"][:]
+    lons = first.variables["longitude"][:]
+    units = first.variables["time"].units
+    calendar = getattr(first.variables["time"], "calendar", "standard")
+
+    times, bounds = read_times(files, units, calendar)
+
+    store = ncdf.Dataset(filename, "w")
+    store.Conventions = "CF-1.7"
+
+    store.createDimension("time", len(times))
+    store.createDimension("latitude", len(lats))
+    store.createDimension("longitude", len(lons))
+    store.createDimension("bnds", 2)
+
+    time = store.createVariable("time", "f8", ("time",))
+    for attr in first.variables["time"].ncattrs():
+        time.setncattr(attr, first.variables["time"].getncattr(attr))
+    time[:] = times
+    store.createVariable("time_bnds", "f8", ("time", "bnds"))[:] = bounds
+
+    for name, values in [("latitude", np.sort(lats)), ("longitude", lons)]:
+        coord = store.createVariable(name, "f4", (name,))
+        for attr in first.variables[name].ncattrs():
+            if attr != "_FillValue":
+                coord.setncattr(attr, first.variables[name].getncattr(attr))
+        coord[:] = values
+
+    chunks = (len(times), tile_points(lats, utils.DELTALAT), tile_points(lons, utils.DELTALON))
+    for name in ["tx2m", "tn2m", "tp"]:
+        var = store.createVariable(name, "f4", ("time", "latitude", "longitude"), fill_value=utils.MDI, \
+                                   **utils.storage_options((len(times), len(lats), len(lons)), profile, chunks = chunks))
+        for attr in first.variables[name].ncattrs():
+            if attr not in ["_FillValue", "missing_value"]:
+                var.setncattr(attr, first.variables[name].getncattr(attr))
+        var.missing_value = np.float32(utils.MDI)
+
+    first.close()
+
+    return store # create_store
+
+#****************************************
+def main(memory = utils.RECHUNK_MEMORY_MB, profile = utils.STORAGE_PROFILE):
+    '''
+    Build the tile-major store from the annual daily files.
+
+    Works through a band of tiles at a time (as many tiles in longitude as fit in
+    memory), reading that hyperslab from every annual file and writing whole chunks
+    once, so no chunk is ever compressed more than once.
+
+    :param int memory: approximate memory (MB) to use per block
+    :param str profile: storage profile for the store
+    '''
+
+    rows = sorted(catalog.lookup("daily", month=None, window="00UTC"), key=lambda row: row["year"])
+    files = [row["path"] for row in rows]
+
+    store = create_store(STORE, files, profile = profile)
+    ntimes = len(store.dimensions["time"])
+    nlats = len(store.dimensions["latitude"])
+    nlons = len(store.dimensions["longitude"])
+    lat_chunk, lon_chunk = store.variables["tx2m"].chunking()[1:]
+
+    # whole tiles in longitude which fit in the memory allowance
+    tile_mb = ntimes * lat_chunk * lon_chunk * 4 / 1024**2
+    lon_block = max(1, int(memory // tile_mb)) * lon_chunk
+
+    infiles = [ncdf.Dataset(filename, "r") for filename in files]
+    # annual files are north to south, store is south to north
+    descending = infiles[0].variables["latitude"][0] > infiles[0].variables["latitude"][-1]
+
+    # bands of tiles in latitude, on the store's (ascending) latitudes
+    lat_bands = sorted(set([(lat_slice.start, lat_slice.stop) for lat_slice, _ in \
+                            utils.tile_index(store.variables["latitude"][:], store.variables["longitude"][:]).values() \
+                            if lat_slice.stop > lat_slice.start]))
+
+    for lat_start, lat_end in lat_bands:
+        if descending:
+            lat_rows = slice(nlats - lat_end, nlats - lat_start)
+        else:
+            lat_rows = slice(lat_start, lat_end)
+
+        for lon_start in range(0, nlons, lon_block):
+            lon_end = min(lon_start + lon_block, nlons)
+            print("latitudes {}-{}, longitudes {}-{}".format(lat_start, lat_end, lon_start, lon_end))
+
+            for name in ["tx2m", "tn2m", "tp"]:
+                block = np.ma.concatenate([infile.variables[name][:, lat_rows, lon_start:lon_end] for infile in infiles])
+                if descending:
+                    block = block[:, ::-1]
+                store.variables[name][:, lat_start:lat_end, lon_start:lon_end] = block
+
+    for infile in infiles:
+        infile.close()
+    store.close()
+
+    catalog.record("store", STORE, window="00UTC", shape=(ntimes, nlats, nlons), \
+                   time_start=rows[0]["time_start"], time_end=rows[-1]["time_end"])
+
+    return # main
+
+#****************************************
+if __name__ == "__main__":
+
+    import argparse
+
+    # set up keyword arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--memory', dest='memory', action='store', default=utils.RECHUNK_MEMORY_MB, type=int,
+                        help='Memory to use when assembling tiles (MB) [{}]'.format(utils.RECHUNK_MEMORY_MB))
+    parser.add_argument('--profile', dest='profile', action='store', default=utils.STORAGE_PROFILE, choices=list(utils.STORAGE_PROFILES.keys()),
+                        help='Storage profile for output files [{}]'.format(utils.STORAGE_PROFILE))
+
+    args = parser.parse_args()
+
+    main(memory = args.memory, profile = args.profile)
+
+#*******************************************
+# END
+#*******************************************
@@ -0,0 +1,86 @@
+#!/bin/env python
+"""
+Registry of the indices in the final files
+
+Which periods each index has values for, and the derived indices, which are
+declared as expressions over other final indices.  extra_indices.py works out
+from the declarations the order the derived indices have to be made in, so a
+new one only needs an entry in DERIVED.
+"""
+
+#*******************************************
+# START
+#*******************************************
+
+# indices from Climpact (merged from the tiles by merge_tiles.py, or calculated
+# directly by calculate_indices.py) : periods with values
+MERGED = {}
+for name in ["TN10p", "TN90p", "TX10p", "TX90p", "TNn", "TNx", "TXn", "TXx", "DTR", "Rx1day", "Rx5day", \
+             "TMm", "TXm", "TNm", "TXge35", "TXge30", "TMlt10", "TMge10", "TMlt5", "TMge5", "TXgt50p", \
+             "TNlt2", "TNltm2", "TNltm20", "Rx3day"]:
+    MERGED[name] = ["ann", "mon"]
+for name in ["3month_SPEI", "6month_SPEI", "12month_SPEI", "3month_SPI", "6month_SPI", "12month_SPI"]:
+    MERGED[name] = ["mon"]
+for name in ["FD", "SU", "ID", "TR", "GSL", "WSDI", "CSDI", "CDD", "CWD", "R10mm", "R20mm", "R30mm", \
+             "PRCPTOT", "SDII", "R95p", "R99p"]:
+    MERGED[name] = ["ann"]
+
+#****************************************
+# name : (inputs, values from dictionary of input : array, units, long name)
+# units of None are those of the first input; values are calculated for the periods all the inputs have
+DERIVED = {"ETR" : (["TXx", "TNn"], lambda d: d["TXx"] - d["TNn"], None, "Extreme Temperature Range"), \
+           "R95pTOT" : (["R95p", "PRCPTOT"], lambda d: 100 * d["R95p"] / d["PRCPTOT"], "%", "Contribution from very wet days"), \
+           "R99pTOT" : (["R99p", "PRCPTOT"], lambda d: 100 * d["R99p"] / d["PRCPTOT"], "%", "Contribution from extremely wet days")}
+
+#****************************************
+def timescales(index):
+    '''
+    Periods ("ann", "mon") the index has values for
+
+    :param str index: index name
+
+    :returns: list
+    '''
+
+    if index in DERIVED:
+        periods = [timescales(name) for name in DERIVED[index][0]]
+        return [period for period in ["ann", "mon"] if all([period in p for p in periods])]
+
+    return MERGED.get(index, ["ann"]) # timescales
+
+#****************************************
+def resolve(indices):
+    '''
+    Order to make derived indices in, including any derived inputs they need
+
+    :param list indices: derived indices wanted
+
+    :returns: list of generations, each a list of indices whose inputs are all
+              made by earlier generations (so those in a generation are independent)
+    '''
+
+    needed = set()
+    pending = list(indices)
+    while len(pending) > 0:
+        index = pending.pop()
+        if index not in DERIVED:
+            raise Exception("{} is not a derived index".format(index))
+        if index not in needed:
+            needed.add(index)
+            pending += [name for name in DERIVED[index][0] if name in DERIVED]
+
+    generations = []
+    done = set()
+    while len(needed) > 0:
+        ready = sorted([index for index in needed if all([name in done or name not in DERIVED for name in DERIVED[index][0]])])
+        if len(ready) == 0:
+            raise Exception("Circular dependencies between {}".format(sorted(needed)))
+        generations += [ready]
+        done |= set(ready)
+        needed -= set(ready)
+
+    return generations # resolve
+
+#*******************************************
+# END
+#*******************************************
@@ -4,10 +4,14 @@ Wrapper for the Climpact2 code
 
 Run as::
 
-  python run_climpact.py --batch N --total M
+  python run_climpact.py --batch N --total M [--workers N] [--cores N] [--new_thresholds]
 
 --batch    ID of the tile 
 --total    Total number of tiles
+--workers  Number of tiles to run at once (default, as many as CPUs and memory allow)
+--cores    Number of cores climdex uses for each tile
+--new_thresholds  Recalculate the base period thresholds, rather than using those stored
+                    from an earlier run (by tile, base period and utils.DATA_VERSION)
 """
 
 #*******************************************
@@ -17,135 +21,175 @@ import os
 import datetime
 import numpy as np
 import subprocess
+import queue
+import threading
 
 import utils
+import catalog
+
+# set relative to current as checked out as part of the repository
+CLIMPACT_LOCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "climpact2-master")
+
+# R worker which runs the tiles, and the start of the lines it reports back on
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "climpact_worker.r")
+MARKER = "CLIMPACT_WORKER\t"
 
 #******************************************************************************************
-#******************************************************************************************
-class cd:
+class ClimpactWorker:
+    """
+    A long-lived Rscript (climpact_worker.r) which loads climdex.pcic.ncdf once and then
+    runs each tile sent to it down a pipe, so there is no interpreter and package startup,
+    or wrapper file, per tile.  Runs in the Climpact2 directory.
     """
-    Context manager for changing the current working directory
+    def __init__(self):
+        try:
+            self.process = subprocess.Popen(["Rscript", WORKER], cwd=CLIMPACT_LOCS, stdin=subprocess.PIPE, \
+                                            stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+        except OSError:
+            # executable not found
+            print("Cannot find Rscript")
+            raise OSError
+
+    def run(self, tile, thresholds, make_thresholds, cores = 1):
+        """
+        Run Climpact2 on a tile, waiting for it to finish
+
+        :param int tile: tile to process
+        :param str thresholds: file of base period thresholds
+        :param bool make_thresholds: calculate and write the thresholds, rather than read them
+        :param int cores: cores for climdex to use on this tile
+        """
+        job = [tile, os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile)), os.path.join(utils.DATALOC, "indices"), \
+               "var_daily_climpact.era5_historical_{}_{}-{}.nc".format(tile, utils.base_period_start, utils.base_period_end), \
+               utils.base_period_start, utils.base_period_end, cores, thresholds, "make" if make_thresholds else "use"]
+        self.process.stdin.write("\t".join([str(j) for j in job]) + "\n")
+        self.process.stdin.flush()
+
+        for line in self.process.stdout:
+            if line.startswith(MARKER):
+                status = line.rstrip("\n").split("\t", 2)[2]
+                if status != "done":
+                    raise Exception("Climpact failed on tile {}: {}".format(tile, status))
+                return
+            else:
+                # climdex's own output
+                print(line, end="")
+
+        raise Exception("Climpact worker stopped during tile {}".format(tile))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # already stopped
+            pass
+        self.process.wait()
 
-    https://stackoverflow.com/questions/431684/how-do-i-cd-in-python/13197763#13197763
+#******************************************************************************************
+def thresholds_file(tile):
     """
-    def __init__(self, newPath):
-        self.newPath = os.path.expanduser(newPath)
+    File of base period thresholds for a tile, named by the tile, base period and
+    input data version, so that a change to any of these makes a new one
 
-    def __enter__(self):
-        self.savedPath = os.getcwd()
-        os.chdir(self.newPath)
+    :param int tile: tile
 
-    def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
+    :returns: str
+    """
 
+    return os.path.join(utils.DATALOC, "thresholds", "era5_thresholds_{}_{}-{}_{}.nc".format(tile, utils.base_period_start, \
+                                                                                            utils.base_period_end, utils.DATA_VERSION))
 
 #******************************************************************************************
-def main(tile_ids):
+def run_tile(worker, tile, cores = 1, new_thresholds = False):
     """
-    Run the Climpact2 code on the tile
+    Run the Climpact2 code on a tile and record the outputs
 
-    change directory to the Climpact 2 code, make the new wrapper and run it
+    The percentile thresholds for the base period are calculated on the first run
+    for the tile and stored, then read back on later runs.
 
+    :param obj worker: ClimpactWorker to run on
     :param int tile: tile to process
+    :param int cores: cores for climdex to use on this tile
+    :param bool new_thresholds: recalculate the thresholds even if stored
+    """
 
-    """ 
+    thresholds = thresholds_file(tile)
+    make_thresholds = new_thresholds or not catalog.is_done("thresholds", path=thresholds)
+
+    print("tile {} running ({} thresholds)".format(tile, "making" if make_thresholds else "using stored"))
+    worker.run(tile, thresholds, make_thresholds, cores = cores)
 
-    # set relative to current as checked out as part of the repository
-    CLIMPACT_LOCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "climpact2-master")
+    if make_thresholds:
+        catalog.record("thresholds", thresholds, tile=int(tile), variable=utils.DATA_VERSION, \
+                       time_start=utils.base_period_start, time_end=utils.base_period_end)
+    catalog.record_climpact(tile)
+
+    print("tile {} ...... done".format(tile))
+
+    return # run_tile
+
+#******************************************************************************************
+def main(tile_ids, workers = None, cores = utils.CLIMPACT_CORES, memory = utils.CLIMPACT_MEMORY_MB, new_thresholds = False):
+    """
+    Run the Climpact2 code on the tiles of the batch.
+
+    Several tiles run at once, each pulled from a shared queue by a worker as it
+    becomes free, so a slow tile does not leave the others waiting.  Each worker
+    keeps one R session (ClimpactWorker) for all the tiles it runs.
+
+    :param list tile_ids: tiles to process
+    :param int workers: tiles to run at once (default, as many as CPUs and memory allow)
+    :param int cores: cores for climdex to use on each tile
+    :param int memory: memory (MB) needed by each tile
+    :param bool new_thresholds: recalculate the base period thresholds even if stored
+    """ 
 
     # make sure output directory exists.
     if not os.path.exists(os.path.join(utils.DATALOC, "indices")):
         os.mkdir(os.path.join(utils.DATALOC, "indices"))
 
+    tiles = queue.Queue()
     for tile in tile_ids:
         # make sure it can run
-        if not os.path.exists(os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile))):
-            return
-
-        try:
-            # change directory to where code is
-            with cd(CLIMPACT_LOCS):
-                # make the new wrapper file
-                wrapper = os.path.join(CLIMPACT_LOCS,  "climpact2.ncdf.wrapper.{}.r".format(tile))
-
-                with open(wrapper, "w") as wrapperfile:
-
-                    wrapperfile.write("# ------------------------------------------------\n")
-                    wrapperfile.write("# This wrapper script calls the 'create.indices.from.files' function from the modified climdex.pcic.ncdf package\n")
-                    wrapperfile.write("# to calculate ETCCDI, ET-SCI and other indices, using data and parameters provided by the user.\n")
-                    wrapperfile.write("# Note even when using a threshold file, the base.range parameter must still be specified accurately.\n")
-                    wrapperfile.write("# ------------------------------------------------\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("library(climdex.pcic.ncdf)\n")
-                    wrapperfile.write("# list of one to three input files. e.g. c(\"a.nc\",\"b.nc\",\"c.nc\")\n")
-                    wrapperfile.write("infiles=\"{}\"\n".format(os.path.join(utils.DATALOC, "tiles", "era5_tile_{}.nc".format(tile))))
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# list of variable names according to above file(s)\n")
-                    wrapperfile.write("vars=c(prec=\"tp\",tmax=\"tx2m\", tmin=\"tn2m\")\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# output directory. Will be created if it does not exist.\n")
-                    wrapperfile.write("outdir=\"{}\"\n".format(os.path.join(utils.DATALOC, "indices")))
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# Output filename format. Must use CMIP5 filename convention. i.e. \"var_timeresolution_model_scenario_run_starttime-endtime.nc\"\n")
-                    wrapperfile.write("file.template=\"var_daily_climpact.era5_historical_{}_{}-{}.nc\"\n".format(tile, utils.base_period_start, utils.base_period_end))
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# author data\n")
-                    wrapperfile.write("author.data=list(institution=\"Met Office Hadley Centre\", institution_id=\"MOHC\")\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# reference period\n")
-                    wrapperfile.write("base.range=c({},{})\n".format(utils.base_period_start, utils.base_period_end))
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# number of cores to use, or FALSE for single core.\n")
-                    wrapperfile.write("cores=FALSE\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# list of indices to calculate, or NULL to calculate all.\n")
-                    wrapperfile.write("indices=NULL	#c(\"hw\",\"tnn\")\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# input threshold file to use, or NULL for none.\n")
-                    wrapperfile.write("thresholds.files=NULL#\"thresholds.test.1991-1997.nc\"\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("#######################################################\n")
-                    wrapperfile.write("# Esoterics below, do not modify without a good reason.\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# definition used for Excess Heat Factor (EHF). \"PA13\" for Perkins and Alexander (2013), this is the default. \"NF13\" for Nairn and Fawcett (2013).\n")
-                    wrapperfile.write("EHF_DEF = \"PA13\"\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# axis to split data on. For chunking up of grid, leave this.\n")
-                    wrapperfile.write("axis.name=\"Y\"\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# Number of data values to process at once. If you receive \"Error: rows.per.slice >= 1 is not TRUE\", try increasing this to 20. You might have a large grid.\n")
-                    wrapperfile.write("maxvals=10\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# output compatible with FCLIMDEX. Leave this.\n")
-                    wrapperfile.write("fclimdex.compatible=FALSE\n")
-                    wrapperfile.write("\n")
-                    wrapperfile.write("# Call the package.\n")
-                    wrapperfile.write("create.indices.from.files(infiles,outdir,file.template,author.data,variable.name.map=vars,base.range=base.range,parallel=cores,axis.to.split.on=axis.name,climdex.vars.subset=indices,thresholds.files=thresholds.files,fclimdex.compatible=fclimdex.compatible,\n")
-                    wrapperfile.write("	cluster.type=\"SOCK\",ehfdef=EHF_DEF,max.vals.millions=maxvals,rxnday_n=3,rnnmm_n=30,ntxntn_n=2,ntxbntnb_n=2,wsdin_n=3,csdin_n=3,hddheatn_n=18,cddcoldn_n=18,gddgrown_n=10,\n")
-                    wrapperfile.write("	thresholds.name.map=c(tx05thresh=\"tx05thresh\",tx10thresh=\"tx10thresh\", tx50thresh=\"tx50thresh\", tx90thresh=\"tx90thresh\",tx95thresh=\"tx95thresh\", \n")
-                    wrapperfile.write("			tn05thresh=\"tn05thresh\",tn10thresh=\"tn10thresh\",tn50thresh=\"tn50thresh\",tn90thresh=\"tn90thresh\",tn95thresh=\"tn95thresh\",\n")
-                    wrapperfile.write("			tx90thresh_15days=\"tx90thresh_15days\",tn90thresh_15days=\"tn90thresh_15days\",tavg90thresh_15days=\"tavg90thresh_15days\",\n")
-                    wrapperfile.write("			tavg05thresh=\"tavg05thresh\",tavg95thresh=\"tavg95thresh\",\n")
-                    wrapperfile.write("			txraw=\"txraw\",tnraw=\"tnraw\",precraw=\"precraw\", \n")
-                    wrapperfile.write("			r95thresh=\"r95thresh\", r99thresh=\"r99thresh\", \n")
-                    wrapperfile.write("	                rxnday_n=3,rnnmm_n=30,ntxntn_n=7,ntxbntnb_n=7,wsdin_n=3, \n")
-                    wrapperfile.write("	                csdin_n=3,hddheatn_n=18,cddcoldn_n=18,gddgrown_n=10))\n")
-
-                # close wrapper
-                print(" ".join(["Rscript", wrapper]))
-                subprocess.check_call(["Rscript", wrapper])
-                os.remove(wrapper)
-
-        except subprocess.CalledProcessError:
-            # handle errors in the called executable
-            raise Exception
-
-        except OSError:
-            # executable not found
-            print("Cannot find Rscript")
-            raise OSError
-
-        print("...... done")
+        if catalog.is_done("tile", tile=int(tile)):
+            tiles.put(tile)
+        else:
+            print("tile {} not made".format(tile))
+
+    if workers is None:
+        workers = utils.n_workers(tiles.qsize(), cores = cores, memory = memory)
+    print("running {} tiles, {} at once with {} cores each".format(tiles.qsize(), workers, cores))
+
+    failures = []
+    def worker():
+        climpact = None
+        while True:
+            try:
+                tile = tiles.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if climpact is None:
+                    climpact = ClimpactWorker()
+                run_tile(climpact, tile, cores = cores, new_thresholds = new_thresholds)
+            except Exception as err:
+                print(err)
+                failures.append(tile)
+                # start afresh in case the R session is in a bad state
+                if climpact is not None:
+                    climpact.close()
+                climpact = None
+        if climpact is not None:
+            climpact.close()
+
+    threads = [threading.Thread(target=worker) for w in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(failures) > 0:
+        raise Exception("Climpact failed on tiles {}".format(sorted(failures)))
 
     return # main
 
@@ -160,6 +204,12 @@ if __name__ == "__main__":
                         help='batch number')
     parser.add_argument('--total', dest='total', action='store', default=100, type=int,
                         help='total number of batches')
+    parser.add_argument('--workers', dest='workers', action='store', default=None, type=int,
+                        help='tiles to run at once [as many as CPUs and memory allow]')
+    parser.add_argument('--cores', dest='cores', action='store', default=utils.CLIMPACT_CORES, type=int,
+                        help='cores for each tile [{}]'.format(utils.CLIMPACT_CORES))
+    parser.add_argument('--new_thresholds', dest='new_thresholds', action='store_true', default=False,
+                        help='recalculate the base period thresholds even if stored, default = False')
 
     args = parser.parse_args()
 
@@ -173,7 +223,7 @@ if __name__ == "__main__":
 
     print("Batch {} of {}".format(args.batch, args.total))
     try:
-        main(tiles_to_run[args.batch])
+        main(tiles_to_run[args.batch], workers = args.workers, cores = args.cores, new_thresholds = args.new_thresholds)
     except IndexError:
         # account for rounding and imperfect division
         pass
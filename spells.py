@@ -0,0 +1,125 @@
+#!/bin/env python
+"""
+Array kernels for the spell duration indices (CDD, CWD, WSDI, CSDI)
+
+Run lengths are found for every grid point at once from cumulative sums along
+the time axis, with no loop over points or days.
+
+Conventions follow climdex.  CDD and CWD spells can span the ends of years (or
+months), and each spell counts towards the period in which it ends, with periods
+which lie entirely inside a spell set to missing.  WSDI and CSDI spells are
+broken at the start of each period.  Missing days end a spell.
+"""
+
+#*******************************************
+# START
+#*******************************************
+import numpy as np
+
+#****************************************
+def run_lengths(condition, breaks = None, initial = None):
+    '''
+    Length so far of the run of days meeting the condition, on each day
+
+    :param array condition: boolean (time, ...)
+    :param array breaks: indices of days on which runs are forced to restart (e.g. start of each year)
+    :param array initial: length of the run going on before the first day (shape of each day), to carry on
+
+    :returns: array of run lengths (0 where the condition is not met)
+    '''
+
+    counts = np.cumsum(condition, axis=0, dtype=np.int32)
+
+    # count at the last reset on or before each day
+    reset = np.where(condition, 0, counts)
+    if breaks is not None:
+        before = np.concatenate([np.zeros((1,) + counts.shape[1:], dtype=np.int32), counts[:-1]])
+        reset[breaks] = np.where(condition[breaks], before[breaks], counts[breaks])
+    reset = np.maximum.accumulate(reset, axis=0)
+
+    lengths = counts - reset
+    if initial is not None:
+        # the first run continues the one before
+        lengths += np.where(np.logical_and.accumulate(condition, axis=0), initial, 0).astype(np.int32)
+
+    return lengths # run_lengths
+
+#****************************************
+def run_ends(condition, breaks = None):
+    '''
+    Days on which a run ends (the condition is not met on the next day, or the next day is a break)
+
+    :param array condition: boolean (time, ...)
+    :param array breaks: indices of days on which runs are forced to restart
+
+    :returns: boolean array
+    '''
+
+    following = np.zeros(condition.shape, dtype=bool)
+    following[:-1] = condition[1:]
+    if breaks is not None:
+        ends = np.asarray(breaks)
+        ends = ends[ends > 0] - 1
+        following[ends] = False
+
+    return condition & ~following # run_ends
+
+#****************************************
+def spell_ends(data, condition, initial = None, running = None):
+    '''
+    Daily values for the longest spell in a period (reduce with "spell"), where spells
+    can span periods.  On the last day of each spell its length, other days in a spell 0,
+    days not in a spell -1, and missing days NaN.
+
+    :param array data: daily values (time, latitude, longitude), NaN where missing
+    :param array condition: boolean, days in a spell
+    :param array initial: length of the spell going on before the first day (latitude, longitude),
+                          e.g. at the end of the part of the record already calculated
+    :param int running: day on which to also return the length of the spells going on
+
+    :returns: array [, array (latitude, longitude) of spell lengths on the day running]
+    '''
+
+    condition = condition & ~np.isnan(data)
+    lengths = run_lengths(condition, initial = initial)
+
+    values = np.where(run_ends(condition), lengths, np.where(condition, 0, -1)).astype(np.float32)
+    values[np.isnan(data)] = np.nan
+
+    if running is not None:
+        return values, lengths[running]
+    return values # spell_ends
+
+#****************************************
+def days_in_spells(data, condition, min_length, breaks):
+    '''
+    Days which are part of a spell of at least min_length days, as 1/0 (reduce with "sum"),
+    with spells broken at the start of each period
+
+    :param array data: daily values (time, latitude, longitude), NaN where missing
+    :param array condition: boolean, days which could be part of a spell
+    :param int min_length: shortest spell to count
+    :param array breaks: index of the first day of each period
+
+    :returns: array
+    '''
+
+    condition = condition & ~np.isnan(data)
+    lengths = run_lengths(condition, breaks = breaks)
+    ends = run_ends(condition, breaks = breaks)
+
+    # length of the whole spell, from the next end of a spell on or after each day
+    ntimes = condition.shape[0]
+    shape = (ntimes,) + (1,) * (condition.ndim - 1)
+    next_end = np.where(ends, np.arange(ntimes).reshape(shape), ntimes - 1)
+    next_end = np.minimum.accumulate(next_end[::-1], axis=0)[::-1]
+    total = np.take_along_axis(lengths, next_end, axis=0)
+
+    values = (condition & (total >= min_length)).astype(np.float32)
+    values[np.isnan(data)] = np.nan
+
+    return values # days_in_spells
+
+#*******************************************
+# END
+#*******************************************
@@ -6,8 +6,10 @@ Utility routines and settings of these codes
 
 import os
 import numpy as np
+import netCDF4 as ncdf
 
-DATALOC = "/scratch/rdunn/reanalyses/era5"
+# can be set in the environment, e.g. to run on a copy or on synthetic data (benchmark_pipeline.py)
+DATALOC = os.environ.get("ERA5_DATALOC", "/scratch/rdunn/reanalyses/era5")
 
 DELTALAT = 8
 DELTALON = 8
@@ -20,12 +22,65 @@ MDI = -99.9
 base_period_start = 1961
 base_period_end = 1990
 
+# version of the input data - change when the base period data are reprocessed,
+#   so that the stored percentile thresholds are recalculated
+DATA_VERSION = "v1"
+
 STARTYEAR = 1940
 ENDYEAR = 2023
 
 LAND_FRACTION_THRESH = 0.6
 
-for newdir in ["raw", "hourlies", "dailies", "indices", "tiles", "final"]:
+# days of hourly data held in memory at once when making daily values
+DAILY_CHUNK_DAYS = 4
+
+# day definitions to make daily values for - "HHUTC" for a fixed start hour, or "solar" for the local solar day
+#   (all calculated from a single read of the hourly data)
+DAY_WINDOWS = ["00UTC"]
+
+# memory (MB) to use when rechunking the daily files into the tile-major store
+RECHUNK_MEMORY_MB = 4000
+
+# memory (MB) to use for each band of latitudes when calculating indices from the daily data
+INDEX_MEMORY_MB = 8000
+
+# grid points to do at once for the percentile thresholds and bootstrap
+PERCENTILE_CHUNK = 2000
+
+# years of daily data before the new one read when appending a year to the indices (for running
+#   windows, spells and SPI/SPEI accumulations which span the start of the year).  At least 2, as
+#   the year before the new one is calculated again for indices whose windows cross into the next year
+APPEND_LOOKBACK_YEARS = 2
+
+# CDS downloads - requests in flight at once, and retries with exponential backoff (s)
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_MAX_ATTEMPTS = 5
+DOWNLOAD_BACKOFF = 60
+DOWNLOAD_MAX_BACKOFF = 3600
+
+# Climpact - cores for each tile, and memory (MB) each tile needs, to set how many tiles run at once
+CLIMPACT_CORES = 1
+CLIMPACT_MEMORY_MB = 8000
+
+# memory (MB) each index needs when merging tiles, to set how many indices are merged at once
+MERGE_MEMORY_MB = 16000
+
+# memory (MB) to use for each block read when calculating the derived indices from the final files
+DERIVED_MEMORY_MB = 2000
+
+# netCDF storage profiles, used for every file written
+#   codec - "zlib", "zstd" (netCDF4 >= 1.6 with the HDF5 plugins, else falls back to zlib) or None
+#   complevel - compression level; shuffle - byte shuffle filter before compression
+#   chunks - chunk shape (time, latitude, longitude), -1 for the whole dimension, None for the library default
+#   digits - decimal places to keep (least_significant_digit quantization), None for lossless
+STORAGE_PROFILES = {"default" : {"codec" : "zlib", "complevel" : 4, "shuffle" : True, "chunks" : None, "digits" : None}, \
+                    "fast" : {"codec" : "zlib", "complevel" : 1, "shuffle" : True, "chunks" : (1, -1, -1), "digits" : None}, \
+                    "small" : {"codec" : "zlib", "complevel" : 6, "shuffle" : True, "chunks" : None, "digits" : 2}, \
+                    "zstd" : {"codec" : "zstd", "complevel" : 3, "shuffle" : True, "chunks" : None, "digits" : None}, \
+                    "none" : {"codec" : None, "complevel" : 0, "shuffle" : False, "chunks" : None, "digits" : None}}
+STORAGE_PROFILE = "default"
+
+for newdir in ["raw", "hourlies", "dailies", "indices", "thresholds", "tiles", "final"]:
     if not os.path.exists(os.path.join(DATALOC, newdir)):
         os.mkdir(os.path.join(DATALOC, newdir))
 
@@ -34,3 +89,134 @@ def chunks(l, n):
     """ Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
         yield l[i: i+n]
+
+#****************************************
+def available_memory():
+    '''
+    Memory (MB) that can be used without swapping, including the page cache which
+    the kernel would give up (MemAvailable), or just the free memory if not known
+
+    :returns: float
+    '''
+
+    try:
+        with open("/proc/meminfo", "r") as infile:
+            for line in infile:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+
+    # older kernels, or not Linux
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**2 # available_memory
+
+#****************************************
+def n_workers(ntasks, cores = 1, memory = 1000):
+    '''
+    Number of tasks to run at once, capped by the CPUs and memory available to this job
+
+    :param int ntasks: number of tasks to run
+    :param int cores: cores per task
+    :param int memory: memory (MB) per task
+
+    :returns: int
+    '''
+
+    # CPUs this process may use (respects the batch system's allocation)
+    ncpus = len(os.sched_getaffinity(0))
+    free_mb = available_memory()
+
+    return max(1, min(ntasks, ncpus // cores, int(free_mb // memory))) # n_workers
+
+#****************************************
+def final_filename(index, land = False, end = None):
+    '''
+    Final file of an index over the whole grid, from STARTYEAR to the end year
+
+    :param str index: index name
+    :param bool land: land-only version
+    :param int end: last year in the file (default ENDYEAR)
+
+    :returns: str
+    '''
+
+    if end is None:
+        end = ENDYEAR
+
+    return os.path.join(DATALOC, "final", "ERA5_{}_{}-{}{}.nc".format(index, STARTYEAR, end, "_land" if land else "")) # final_filename
+
+#****************************************
+def tile_index(lats, lons):
+    '''
+    Table of array slices for each tile, from the tile edges (lower edge inclusive,
+    upper edge exclusive).  Tiles are numbered from 1, running along the longitudes
+    for each band of latitude.  Works with latitudes in either order.
+
+    :param array lats: latitude coordinate points
+    :param array lons: longitude coordinate points
+
+    :returns: dictionary of tile : (latitude slice, longitude slice)
+    '''
+
+    def edge_slices(points, edges):
+        slices = []
+        for lower, upper in zip(edges[:-1], edges[1:]):
+            locs, = np.where((points >= lower) & (points < upper))
+            if len(locs) == 0:
+                slices += [slice(0, 0)]
+            else:
+                slices += [slice(locs[0], locs[-1] + 1)]
+        return slices
+
+    lat_slices = edge_slices(np.asarray(lats), box_edge_lats)
+    lon_slices = edge_slices(np.asarray(lons), box_edge_lons)
+
+    table = {}
+    tile = 1
+    for lat_slice in lat_slices:
+        for lon_slice in lon_slices:
+            table[tile] = (lat_slice, lon_slice)
+            tile += 1
+
+    return table # tile_index
+
+#****************************************
+def storage_options(shape, profile = STORAGE_PROFILE, chunks = None, for_iris = False):
+    '''
+    Keyword arguments for netCDF4 createVariable (or iris.save) from a storage profile
+
+    :param tuple shape: shape of the variable (chunks are clipped to this)
+    :param str profile: name of the profile in STORAGE_PROFILES
+    :param tuple chunks: chunk shape to use instead of the profile's (where the layout matters)
+    :param bool for_iris: iris.save only takes zlib, so use that for other codecs
+
+    :returns: dictionary
+    '''
+
+    settings = STORAGE_PROFILES[profile]
+
+    codec = settings["codec"]
+    if codec not in [None, "zlib"]:
+        if for_iris or not getattr(ncdf, "__has_{}_support__".format({"zstd" : "zstandard"}.get(codec, codec)), False):
+            print("{} not available, using zlib".format(codec))
+            codec = "zlib"
+
+    options = {"shuffle" : settings["shuffle"]}
+    if codec is None:
+        options["zlib"] = False
+    elif codec == "zlib":
+        options["zlib"] = True
+        options["complevel"] = settings["complevel"]
+    else:
+        options["compression"] = codec
+        options["complevel"] = settings["complevel"]
+
+    if chunks is None and settings["chunks"] is not None:
+        chunks = [n if c == -1 else c for c, n in zip(settings["chunks"], shape)]
+    if chunks is not None:
+        options["chunksizes"] = tuple([max(1, min(c, n)) for c, n in zip(chunks, shape)])
+
+    if settings["digits"] is not None:
+        options["least_significant_digit"] = settings["digits"]
+
+    return options # storage_options